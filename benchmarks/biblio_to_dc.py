@@ -0,0 +1,184 @@
+"""Benchmark converting biblio publications to Dublin Core.
+
+Write biblio exports with synthetic publications to a temporary
+directory, load them with the biblio metadata provider and measure how
+long it takes to convert all publications with biblio.to_dc. The time is
+compared with the previous implementation, which filled and substituted
+string templates for every record, and the outputs of the two are checked
+to be equal.
+
+Usage: python benchmarks/biblio_to_dc.py [--publications N]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'biblio'))
+
+from biblio_metadata_provider import StubTransport, biblio
+
+TYPES = ['Article', 'Inproceedings', 'Book', 'DataSW', 'Techreport']
+PUBLISHERS = [u'ACL', u'Springer', u'\xdaFAL MFF UK']
+AUTHORS = 1000
+GRANTS = 20
+
+
+def write_records(path, records):
+    """Write (id, [(label, value)]) pairs as a biblio export."""
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<Records>\n')
+        for id_str, fields in records:
+            f.write('<Record Id={0}>'.format(quoteattr(id_str)))
+            for label, value in fields:
+                f.write(u'<Field Label={0}>{1}</Field>'.format(
+                    quoteattr(label), escape(value)).encode('utf-8'))
+            f.write('</Record>\n')
+        f.write('</Records>\n')
+
+
+def populate(directory, count):
+    """Write synthetic biblio and openaire exports with `count`
+    publications."""
+    os.mkdir(os.path.join(directory, 'input_openaire'))
+    with open(os.path.join(directory, 'input_openaire',
+                           'openaire-cache.list'), 'w') as f:
+        f.write('<list>\n')
+        for i in xrange(GRANTS):
+            f.write('<pair><stored-value>info:eu-repo/grantAgreement/EC/'
+                    'FP7/{0}/EU</stored-value></pair>\n'.format(600000 + i))
+        f.write('</list>\n')
+
+    d = os.path.join(directory, 'input_biblio')
+    os.mkdir(d)
+    write_records(os.path.join(d, 'authors.xml'), (
+        ('a{0}'.format(i), [('First name', u'Jan'),
+                            ('Last name', u'Nov\xe1k {0}'.format(i))])
+        for i in xrange(AUTHORS)))
+    write_records(os.path.join(d, 'grants.xml'), (
+        ('g{0}'.format(i), [('Agency', u'EU'),
+                            ('Code', u'FP7-ICT-{0}'.format(600000 + i))])
+        for i in xrange(GRANTS)))
+    write_records(os.path.join(d, 'attachedfiles.xml'), [])
+    write_records(os.path.join(d, 'publications.xml'), (
+        (str(i), [
+            ('Title', u'Publication {0} & <more>'.format(i)),
+            ('Author(s)', u';'.join('a{0}'.format((i + k) % AUTHORS)
+                                    for k in xrange(3))),
+            ('Supported by', u'g{0}'.format(i % GRANTS)),
+            ('English abstract', u'Abstract of publication {0}.'.format(i)),
+            ('Publisher', PUBLISHERS[i % len(PUBLISHERS)]),
+            ('Year', u'{0}'.format(2000 + i % 20)),
+            ('Type', TYPES[i % len(TYPES)]),
+            ('Open access', u'1' if i % 2 else u'0'),
+        ]) for i in xrange(count)))
+    return d
+
+
+def fill_values(metadata_key, ftor_get, record_keys, subst_dict,
+                value_mapper=None):
+    values = [ftor_get(k).strip()
+              for k in record_keys if ftor_get(k) is not None]
+    if value_mapper is not None:
+        values = [value_mapper(x) for x in values]
+    subst_values = [subst_dict[metadata_key] % escape(x) for x in values]
+    subst_dict[metadata_key] = u'\n'.join(
+        [x for x in subst_values if 0 < len(x)]).strip()
+    return values
+
+
+def template_to_dc(b, identifier):
+    """The previous implementation of biblio.to_dc."""
+    record_template = u"""
+{ids}
+{title}
+{creators}
+{relations}
+{rights}
+{descriptions}
+{publishers}
+{dates}
+{type}
+"""
+    vals = {
+        "ids": u"<dc:identifier>%s</dc:identifier>",
+        "title": u"<dc:title>%s</dc:title>",
+        "creators": u"<dc:creator>%s</dc:creator>",
+        "relations": u"<dc:relation>%s</dc:relation>",
+        "rights": u"<dc:rights>%s</dc:rights>",
+        "descriptions": u"<dc:description>%s</dc:description>",
+        "publishers": u"<dc:publisher>%s</dc:publisher>",
+        "dates": u"<dc:date>%s</dc:date>",
+        "type": u"<dc:type>%s</dc:type>",
+    }
+    rec = b.publications.ids[identifier]
+    vals["ids"] %= "http://hdl.handle.net/11346/BIBLIO@id=" + identifier
+    for key_title in ["Title", "Original title", "English title",
+                      "Czech title"]:
+        if 0 < len(fill_values("title", rec.get, [key_title], vals)):
+            break
+    fill_values("creators", b.authors.ids.get, rec.get("Author(s)"), vals)
+    fill_values("relations", lambda k: b.grants.ids[k]["openaire_id"],
+                rec.get("Supported by"), vals)
+    access = b._find_access(rec, identifier)
+    vals["rights"] %= access
+    b._cnts[access] += 1
+    fill_values("descriptions", rec.get, ["English abstract"], vals)
+    fill_values("publishers", rec.get, ["Publisher"], vals)
+    fill_values("dates", rec.get, ["Year"], vals)
+    fill_values("type", rec.get, ["Type"], vals, biblio.map_to_type)
+    return biblio.dc_template % record_template.strip().format(**vals)
+
+
+def time_conversion(convert, identifiers, repeat):
+    """Return the best time of converting all publications in seconds."""
+    best = None
+    for _ in xrange(repeat):
+        begin = time.time()
+        for identifier in identifiers:
+            convert(identifier)
+        elapsed = time.time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--publications', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        print 'Writing {0} publications...'.format(args.publications)
+        d = populate(directory, args.publications)
+        # The provider reads and writes its state in the working directory.
+        os.chdir(directory)
+        b = biblio(d, StubTransport())
+        identifiers = sorted(b.identifiers)
+        b.prefetch_access()
+
+        for identifier in identifiers:
+            assert b.to_dc(identifier) == template_to_dc(b, identifier), \
+                identifier
+
+        print '{0:>10} {1:>10} {2:>12}'.format(
+            'method', 'total (s)', 'record (us)')
+        for name, convert in [
+                ('templates', lambda i: template_to_dc(b, i)),
+                ('compiled', b.to_dc)]:
+            elapsed = time_conversion(convert, identifiers, args.repeat)
+            print '{0:>10} {1:>10.2f} {2:>12.1f}'.format(
+                name, elapsed, elapsed / len(identifiers) * 1e6)
+        b._access_store.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
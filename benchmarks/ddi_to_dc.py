@@ -0,0 +1,124 @@
+"""Benchmark converting DDI Codebook files to Dublin Core.
+
+Convert a corpus of DDI files with the DDI file provider and report the
+time spent per record on parsing the files, converting them with
+convert_to_dc and serializing the result. Without --directory, synthetic
+DDI files are written to a temporary directory first.
+
+Usage: python benchmarks/ddi_to_dc.py [--directory PATH] [--files N]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kuha.importer.ddi_file_provider import DdiFileProvider, convert_to_dc
+
+DDI = u'''<?xml version="1.0" encoding="UTF-8"?>
+<codeBook>
+  <stdyDscr>
+    <citation>
+      <titlStmt>
+        <titl>Study {0}</titl>
+        <IDNo>FSD{0:05d}</IDNo>
+      </titlStmt>
+      <rspStmt>
+        <AuthEnty>Author {0}</AuthEnty>
+        <AuthEnty>Second Author</AuthEnty>
+        <othId><p>Contributor</p></othId>
+      </rspStmt>
+      <prodStmt>
+        <producer>Data Archive</producer>
+        <copyright>Free for research</copyright>
+        <prodDate>2014</prodDate>
+      </prodStmt>
+    </citation>
+    <stdyInfo>
+      <subject>
+        <keyword>survey</keyword>
+        <keyword>households</keyword>
+        <topcClas>Society</topcClas>
+      </subject>
+      <abstract><p>Abstract of study {0} &amp; its data.</p></abstract>
+      <sumDscr>
+        <timePrd>2013</timePrd>
+        <collDate>2013-05</collDate>
+        <nation>Finland</nation>
+        <geogCover>Helsinki</geogCover>
+        <dataKind>Quantitative</dataKind>
+      </sumDscr>
+    </stdyInfo>
+    <method>
+      <dataColl><sources><dataSrc>Interviews</dataSrc></sources></dataColl>
+    </method>
+    <othrStdyMat><relPubl>Report {0}</relPubl></othrStdyMat>
+  </stdyDscr>
+  <fileDscr><fileTxt><fileType>SPSS</fileType></fileTxt></fileDscr>
+</codeBook>
+'''
+
+
+def populate(directory, count):
+    """Write `count` synthetic DDI files to `directory`."""
+    for i in xrange(count):
+        path = os.path.join(directory, 'study{0:05d}.xml'.format(i))
+        with open(path, 'w') as f:
+            f.write(DDI.format(i).encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--directory',
+                        help='directory of DDI files to convert')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of synthetic files to convert')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    temporary = None
+    directory = args.directory
+    if directory is None:
+        temporary = directory = tempfile.mkdtemp()
+        print 'Writing {0} DDI files...'.format(args.files)
+        populate(directory, args.files)
+    try:
+        provider = DdiFileProvider('example.org', directory)
+        paths = [os.path.join(directory, provider.get_filename(identifier))
+                 for identifier in provider.identifiers()]
+        # (parse, convert, serialize) times of the best round.
+        best = None
+        for _ in xrange(args.repeat):
+            times = [0.0, 0.0, 0.0]
+            for path in paths:
+                begin = time.time()
+                tree = etree.parse(path)
+                parsed = time.time()
+                root = convert_to_dc(tree)
+                converted = time.time()
+                etree.tostring(root, encoding=unicode)
+                serialized = time.time()
+                times[0] += parsed - begin
+                times[1] += converted - parsed
+                times[2] += serialized - converted
+            if best is None or sum(times) < sum(best):
+                best = times
+    finally:
+        if temporary is not None:
+            shutil.rmtree(temporary)
+
+    print 'Converted {0} files'.format(len(paths))
+    print '{0:>10} {1:>10} {2:>12}'.format(
+        'phase', 'total (s)', 'record (us)')
+    for name, elapsed in zip(['parse', 'convert', 'serialize'], best):
+        print '{0:>10} {1:>10.3f} {2:>12.1f}'.format(
+            name, elapsed, elapsed / len(paths) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
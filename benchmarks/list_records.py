@@ -0,0 +1,124 @@
+"""Benchmark paging through a large repository with Record.list.
+
+Fill an SQLite database with synthetic records and measure how long it
+takes to fetch a page of records at different depths of a ListRecords
+harvest. With the composite indexes on the records table the time should
+not depend on the depth of the page.
+
+Usage: python benchmarks/list_records.py [--records N] [--database PATH]
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kuha import models
+from kuha.models import DBSession, Record
+
+PREFIX = u'oai_dc'
+XML = (u'<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/'
+       u'oai_dc/"/>')
+
+
+def identifier(i):
+    return u'oai:example.org:{0:08d}'.format(i)
+
+
+def populate(engine, count):
+    """Insert `count` items and records unless they already exist."""
+    existing = engine.execute('SELECT COUNT(*) FROM records').scalar()
+    if existing == count:
+        return
+    if existing != 0:
+        raise SystemExit('the database contains a different number of '
+                         'records; use another --database')
+
+    print 'Inserting {0} records...'.format(count)
+    engine.execute(
+        models.Format.__table__.insert(),
+        prefix=PREFIX,
+        namespace=u'http://www.openarchives.org/OAI/2.0/oai_dc/',
+        schema=u'http://www.openarchives.org/OAI/2.0/oai_dc.xsd',
+        deleted=False,
+    )
+    start = datetime.datetime(2000, 1, 1)
+    with engine.begin() as connection:
+        for first in xrange(0, count, 10000):
+            ids = [identifier(i)
+                   for i in xrange(first, min(first + 10000, count))]
+            connection.execute(
+                models.Item.__table__.insert(),
+                [{'identifier': id_, 'deleted': False} for id_ in ids],
+            )
+            connection.execute(
+                Record.__table__.insert(),
+                [{'identifier': id_,
+                  'prefix': PREFIX,
+                  'datestamp': start + datetime.timedelta(seconds=i),
+                  'xml': XML,
+                  # Every tenth record is deleted.
+                  'deleted': i % 10 == 0}
+                 for i, id_ in enumerate(ids, first)],
+            )
+
+
+def time_page(repeat, **kwargs):
+    """Return the best time of fetching a page in milliseconds."""
+    best = None
+    for _ in xrange(repeat):
+        DBSession.remove()
+        begin = time.time()
+        records = Record.list(**kwargs)
+        elapsed = time.time() - begin
+        assert records, 'no records'
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000000,
+                        help='number of records (default: 1000000)')
+    parser.add_argument('--database', default='benchmark.sqlite',
+                        help='path of the SQLite database to use')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='page size (default: 100)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions per measurement (default: 5)')
+    args = parser.parse_args(argv[1:])
+
+    models.create_engine({
+        'sqlalchemy.url': 'sqlite:///' + os.path.abspath(args.database),
+    })
+    populate(models._Base.metadata.bind, args.records)
+
+    print '{0:>10}  {1:>12}  {2:>12}  {3:>12}  {4:>12}'.format(
+        'depth', 'all (ms)', 'no deleted', 'from/until', 'headers')
+    for fraction in [0.0, 0.25, 0.5, 0.75, 0.99]:
+        position = int((args.records - args.limit - 1) * fraction)
+        offset = identifier(position)
+        start = datetime.datetime(2000, 1, 1)
+        results = [
+            time_page(args.repeat, metadata_prefix=PREFIX,
+                      offset=offset, limit=args.limit + 1),
+            time_page(args.repeat, metadata_prefix=PREFIX,
+                      ignore_deleted=True,
+                      offset=offset, limit=args.limit + 1),
+            time_page(args.repeat, metadata_prefix=PREFIX,
+                      ignore_deleted=True,
+                      from_date=start,
+                      until_date=start + datetime.timedelta(days=365),
+                      offset=offset, limit=args.limit + 1),
+            time_page(args.repeat, metadata_prefix=PREFIX,
+                      offset=offset, limit=args.limit + 1,
+                      defer_xml=True),
+        ]
+        print '{0:>10}  {1:>12.2f}  {2:>12.2f}  {3:>12.2f}  {4:>12.2f}'.format(
+            position, *results)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,95 @@
 # https://guidelines.openaire.eu/en/latest/literature/use_of_oai_pmh.html
 
 import os
+import hashlib
 import logging
 import xml.etree.ElementTree
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 logging.getLogger("requests").setLevel(logging.WARNING)
 from xml.sax.saxutils import escape
 from collections import defaultdict
+from operator import attrgetter
 
 _logger = logging.getLogger()
 
 
+def _intern(table, v):
+    # one shared copy of each repeated value in `table`
+    return v if v is None else table.setdefault(v, v)
+
+
+class compact_record(object):
+    """
+        The fields of a record which are used in the dissemination, with
+        dict-like access by their labels. The other fields are dropped.
+        The shared values are interned in `interned` when given.
+    """
+    __slots__ = ()
+    # label -> slot
+    labels = {}
+    # labels of the few distinct values repeated across records
+    shared = ()
+
+    def __init__(self, d, interned=None):
+        for label, slot in self.labels.items():
+            v = d.get(label)
+            if interned is not None and label in self.shared:
+                v = _intern(interned, v)
+            setattr(self, slot, v)
+
+    def get(self, label, default=None):
+        slot = self.labels.get(label)
+        v = getattr(self, slot) if slot is not None else None
+        return default if v is None else v
+
+    def __getitem__(self, label):
+        if label not in self.labels:
+            raise KeyError(label)
+        return getattr(self, self.labels[label])
+
+    def as_dict(self):
+        return dict((label, getattr(self, slot))
+                    for label, slot in self.labels.items())
+
+
+class publication_record(compact_record):
+    __slots__ = ("title", "original_title", "english_title", "czech_title",
+                 "authors", "supported_by", "english_abstract", "publisher",
+                 "year", "type", "open_access", "url")
+    labels = {
+        "Title": "title",
+        "Original title": "original_title",
+        "English title": "english_title",
+        "Czech title": "czech_title",
+        "Author(s)": "authors",
+        "Supported by": "supported_by",
+        "English abstract": "english_abstract",
+        "Publisher": "publisher",
+        "Year": "year",
+        "Type": "type",
+        "Open access": "open_access",
+        "URL": "url",
+    }
+    shared = ("Publisher", "Year", "Type", "Open access")
+
+
+class grant_record(compact_record):
+    __slots__ = ("openaire_id",)
+    labels = {"openaire_id": "openaire_id"}
+    shared = ("openaire_id",)
+
+
+class attachment_record(compact_record):
+    __slots__ = ("id", "file_ctype", "access")
+    labels = {"id": "id", "FileCType": "file_ctype", "Access": "access"}
+    shared = ("FileCType", "Access")
+
+
 class base_biblio(object):
 
     def __init__(self, f, ftor=None):
@@ -21,17 +99,32 @@ class base_biblio(object):
         self._parse(ftor)
 
     def _parse(self, ftor):
-        root = xml.etree.ElementTree.parse(self.f).getroot()
-        for pos, elem in enumerate(root.findall('Record')):
-            if ftor is None:
-                self.ids[elem.get('Id')] = {}
-            else:
-                v = ftor(elem)
-                if v is not None:
-                    # we want to use different ids e.g., in attachments
-                    id_str = elem.get('Id') if not isinstance(v, dict) \
-                        else v.get("id", elem.get('Id'))
-                    self.ids[id_str] = v
+        # read the top level records one by one and drop them when done
+        # so that the whole document is never held in memory
+        root = None
+        depth = 0
+        for event, elem in xml.etree.ElementTree.iterparse(
+                self.f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if elem.tag == 'Record':
+                if ftor is None:
+                    self.ids[elem.get('Id')] = {}
+                else:
+                    v = ftor(elem)
+                    if v is not None:
+                        # we want to use different ids e.g., in attachments
+                        id_str = elem.get('Id') \
+                            if not isinstance(v, (dict, compact_record)) \
+                            else v.get("id", elem.get('Id'))
+                        self.ids[id_str] = v
+            root.clear()
         _logger.info("Found [%d] entries in [%s]", len(self.ids), self.f)
 
 
@@ -66,7 +159,7 @@ class grants(base_biblio):
         "HORIZON-CL4-2021-DATA-01-03": "info:eu-repo/grantAgreement/EC/HE/101070350"
     }
 
-    def __init__(self, f, openaire):
+    def __init__(self, f, openaire, interned=None):
         def filter_ids(elem):
             d = dict((x.get("Label"), x.text) for x in elem)
             if d.get("Agency", "") in grants.supported:
@@ -76,8 +169,8 @@ class grants(base_biblio):
                         return None
                 openaire_code = grants._get_openaire_id(code, openaire)
                 if openaire_code is not None:
-                    d["openaire_id"] = grants._get_openaire_id(code, openaire)
-                    return d
+                    d["openaire_id"] = openaire_code
+                    return grant_record(d, interned)
             return None
 
         super(grants, self).__init__(f, filter_ids)
@@ -87,6 +180,13 @@ class grants(base_biblio):
         code = code.strip()
         if code is None:
             return None
+        if code not in openaire.resolved:
+            openaire.resolved[code] = grants._resolve_openaire_id(
+                code, openaire)
+        return openaire.resolved[code]
+
+    @staticmethod
+    def _resolve_openaire_id(code, openaire):
         ids = code.split('-')
         if ids[-1].isdigit():
             id_str = ids[-1]
@@ -95,10 +195,7 @@ class grants(base_biblio):
         else:
             _logger.error("Failed to parse grant code %s", code)
             return None
-        results = []
-        for openaire_id in openaire.ids.keys():
-            if id_str in openaire_id:
-                results.append(openaire_id)
+        results = openaire.by_grant_id.get(id_str, [])
 
         if len(results) == 1:
             return results[0]
@@ -113,12 +210,12 @@ class grants(base_biblio):
 
 class attachments(base_biblio):
 
-    def __init__(self, f):
+    def __init__(self, f, interned=None):
         def filter_ids(elem):
             d = dict((x.get("Name"), x.text) for x in elem)
             # publication id is in Parent
             d["id"] = elem.get('Parent')
-            return d
+            return attachment_record(d, interned)
         super(attachments, self).__init__(f, filter_ids)
 
 
@@ -131,8 +228,10 @@ class publications(base_biblio):
         #"-256585522970273362"
     ]
 
-    def __init__(self, f, grants_inst):
+    def __init__(self, f, grants_inst, interned=None):
         grant_ids = set(grants_inst.ids.keys())
+        if interned is None:
+            interned = {}
 
         def filter_ids(elem):
             if elem.get('Id') in publications.cannot_handle_yet:
@@ -142,10 +241,14 @@ class publications(base_biblio):
                     return None
             d = dict((x.get("Label"), x.text) for x in elem)
             supported = d.get("Supported by", "") or ""
-            d["Supported by"] = set(supported.split(";")) & grant_ids
+            d["Supported by"] = frozenset(
+                _intern(interned, x)
+                for x in supported.split(";") if x in grant_ids)
             authorz = d.get("Author(s)", "") or ""
-            d["Author(s)"] = set(authorz.split(";"))
-            return d if 0 < len(d["Supported by"]) else None
+            d["Author(s)"] = frozenset(
+                _intern(interned, x) for x in authorz.split(";"))
+            return publication_record(d, interned) \
+                if 0 < len(d["Supported by"]) else None
 
         super(publications, self).__init__(f, filter_ids)
 
@@ -155,16 +258,199 @@ class Openaire(object):
     def __init__(self, f):
         self.f = f
         self.ids = {}
+        # openaire ids by the numeric segments of the id (grant numbers)
+        self.by_grant_id = defaultdict(list)
+        # openaire ids by grant code, see grants._get_openaire_id
+        self.resolved = {}
         self._parse()
 
     def _parse(self):
-        root = xml.etree.ElementTree.parse(self.f).getroot()
-        for elem in root.findall('.//pair'):
+        # drop the pairs when done like base_biblio._parse does
+        root = None
+        for event, elem in xml.etree.ElementTree.iterparse(
+                self.f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag != 'pair':
+                continue
             id_str = elem.find("stored-value").text
             self.ids[id_str] = {}
+            for part in set(id_str.split("/")):
+                if part.isdigit():
+                    self.by_grant_id[part].append(id_str)
+            elem.clear()
+            root.clear()
         _logger.info("Found [%d] entries in [%s]", len(self.ids), self.f)
 
 
+class HttpTransport(object):
+    """
+        Fetch the status and content type of URLs with HEAD requests over
+        pooled connections.
+    """
+
+    def __init__(self, pool_size, timeout):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, url):
+        # fetching problems
+        # http://stackoverflow.com/questions/18337630/what-is-x-content-type-options-nosniff
+        r = self.session.head(url, timeout=self.timeout)
+        return r.status_code, r.headers.get("content-type", "")
+
+
+class StubTransport(object):
+    """
+        Answer probes from a fixed url -> (status, content type) mapping
+        without touching the network. Unknown URLs are not found.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.requested = []
+
+    def __call__(self, url):
+        self.requested.append(url)
+        return self.responses.get(url, (404, ""))
+
+
+class AccessProber(object):
+    """
+        Probe URLs concurrently in a bounded thread pool.
+    """
+
+    def __init__(self, transport=None, workers=8, timeout=10):
+        self.workers = workers
+        self.transport = transport if transport is not None \
+            else HttpTransport(workers, timeout)
+
+    def probe(self, urls):
+        """
+            Return a dict from url to (status, content type), status is -1
+            if the url could not be fetched.
+        """
+        urls = list(set(urls))
+        if self.workers < 2 or len(urls) < 2:
+            results = [self._probe(url) for url in urls]
+        else:
+            pool = ThreadPool(min(self.workers, len(urls)))
+            try:
+                results = pool.map(self._probe, urls)
+            finally:
+                pool.close()
+                pool.join()
+        return dict(zip(urls, results))
+
+    def _probe(self, url):
+        try:
+            return self.transport(url)
+        except Exception, e:
+            _logger.warn("Url [%s] problem [%s]", url, repr(e))
+            return -1, ""
+
+
+class AccessStore(object):
+    """
+        Access of records by id, persisted as json lines which are
+        appended as soon as an access is found. Entries expire after
+        `ttl` seconds.
+    """
+
+    def __init__(self, f, ttl, legacy_f=None):
+        self.f = f
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        now = time.time()
+        if legacy_f is not None and os.path.exists(legacy_f) \
+                and not os.path.exists(f):
+            for id_str, access in json.load(open(legacy_f, mode="r")).items():
+                self._entries[id_str] = (access, now)
+        if os.path.exists(f):
+            with open(f, mode="r") as fin:
+                for line in fin:
+                    if 0 == len(line.strip()):
+                        continue
+                    e = json.loads(line)
+                    self._entries[e["id"]] = (e["access"], e["time"])
+        # compact the file, later lines override the earlier ones
+        self._entries = dict(
+            (k, v) for k, v in self._entries.items() if now - v[1] <= ttl)
+        with open(f, mode="w+") as fout:
+            for id_str in sorted(self._entries):
+                fout.write(self._line(id_str, *self._entries[id_str]))
+        self._fout = open(f, mode="a")
+
+    @staticmethod
+    def _line(id_str, access, tstamp):
+        return json.dumps(
+            {"id": id_str, "access": access, "time": tstamp},
+            sort_keys=True) + "\n"
+
+    def get(self, id_str):
+        entry = self._entries.get(id_str)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def put(self, id_str, access):
+        tstamp = time.time()
+        with self._lock:
+            self._entries[id_str] = (access, tstamp)
+            self._fout.write(self._line(id_str, access, tstamp))
+            self._fout.flush()
+
+    def close(self):
+        self._fout.close()
+
+
+class HashStore(object):
+    """
+        Content hashes of records by id, persisted as json lines which
+        are appended as soon as the records are committed.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self._hashes = {}
+        if os.path.exists(f):
+            with open(f, mode="r") as fin:
+                for line in fin:
+                    if 0 == len(line.strip()):
+                        continue
+                    e = json.loads(line)
+                    self._hashes[e["id"]] = e["hash"]
+        # compact the file, later lines override the earlier ones
+        with open(f, mode="w+") as fout:
+            for id_str in sorted(self._hashes):
+                fout.write(self._line(id_str, self._hashes[id_str]))
+        self._fout = open(f, mode="a")
+
+    @staticmethod
+    def _line(id_str, content_hash):
+        return json.dumps(
+            {"id": id_str, "hash": content_hash}, sort_keys=True) + "\n"
+
+    def get(self, id_str):
+        return self._hashes.get(id_str)
+
+    def put_all(self, hashes):
+        for id_str, content_hash in hashes:
+            self._hashes[id_str] = content_hash
+            self._fout.write(self._line(id_str, content_hash))
+        self._fout.flush()
+
+    def close(self):
+        self._fout.close()
+
+
 class biblio(object):
     dc_template = u"""
 <oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:dc="http://purl.org/dc/elements/1.1/" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/oai_dc/ http://www.openarchives.org/OAI/2.0/oai_dc.xsd">
@@ -192,197 +478,293 @@ class biblio(object):
         "DataSW": "info:eu-repo/semantics/other",
     }
 
+    open_access = "info:eu-repo/semantics/openAccess"
+    closed_access = "info:eu-repo/semantics/closedAccess"
+
+    # URLs which are known to be open without fetching them
+    open_url_magic = (
+        "github.com",
+        "hdl.handle.net/",
+        "http://www.lrec-conf.org/",
+        "http://ufal.mff.cuni.cz/",
+    )
+
+    # access of the records found so far, see AccessStore
+    access_store_file = "accesses.jsonl"
+    # the store used to be written as a single json dict
     access_map_file = "accesses.json"
+    # probe the URLs again after this many seconds
+    access_ttl = 30 * 24 * 3600
+
+    # concurrent URL probes and the timeout of each probe in seconds
+    probe_workers = 8
+    probe_timeout = 10
 
-    def __init__(self, d):
+    # content hashes of the records as of the last commit, see HashStore
+    hash_store_file = "hashes.jsonl"
+
+    def __init__(self, d, transport=None):
         # List of openaire projects as used and fetched by dspace.
         # [dspace]/config/openaire-cache.list
-        self.attachments = attachments(os.path.join(d, "attachedfiles.xml"))
+        # the values repeated across the records of this instance only,
+        # so that they are freed together with it
+        interned = {}
+        self.attachments = attachments(
+            os.path.join(d, "attachedfiles.xml"), interned)
         self.openaire = Openaire(os.path.join(
             "input_openaire", "openaire-cache.list"))
         self.authors = authors(os.path.join(d, "authors.xml"))
-        self.grants = grants(os.path.join(d, "grants.xml"), self.openaire)
+        self.grants = grants(
+            os.path.join(d, "grants.xml"), self.openaire, interned)
         self.publications = publications(
-            os.path.join(d, "publications.xml"), self.grants
+            os.path.join(d, "publications.xml"), self.grants, interned
         )
         self.identifiers = self.publications.ids
+        self._dc_emitters = self._compile_dc()
         self._cnts = defaultdict(int)
-        self._access_map = json.load(open(biblio.access_map_file, mode="r")) \
-            if os.path.exists(biblio.access_map_file) else {}
+        self._access_store = AccessStore(
+            biblio.access_store_file, biblio.access_ttl,
+            biblio.access_map_file)
+        self._prober = AccessProber(
+            transport, biblio.probe_workers, biblio.probe_timeout)
+        self._hash_store = HashStore(biblio.hash_store_file)
 
     def __del__(self):
         print self._cnts
-        if 0 < len(self._access_map):
-            json.dump(
-                self._access_map,
-                open(biblio.access_map_file, mode="w+"),
-                indent=2, sort_keys=True
-            )
-
-    @staticmethod
-    def _fill_values(metadata_key, ftor_get, record_keys, subst_dict, value_mapper=None):
-        values = [ftor_get(k).strip()
-                  for k in record_keys if ftor_get(k) is not None]
-        if value_mapper is not None:
-            values = [value_mapper(x) for x in values]
-        subst_values = [subst_dict[metadata_key] % escape(x) for x in values]
-        subst_dict[metadata_key] = u'\n'.join(
-            [x for x in subst_values if 0 < len(x)]).strip()
-        return values
+        self._access_store.close()
+        self._hash_store.close()
 
-    def to_dc(self, identifier):
-        record_template = u"""
-{ids}
-{title}
-{creators}
-{relations}
-{rights}
-{descriptions}
-{publishers}
-{dates}
-{type}
-"""
-
-        # will be substituted afterwards
-        vals = {
-            "ids": u"<dc:identifier>%s</dc:identifier>",
-            "title": u"<dc:title>%s</dc:title>",
-            "creators": u"<dc:creator>%s</dc:creator>",
-            "relations": u"<dc:relation>%s</dc:relation>",
-            "rights": u"<dc:rights>%s</dc:rights>",
-            "descriptions": u"<dc:description>%s</dc:description>",
-            "publishers": u"<dc:publisher>%s</dc:publisher>",
-            "dates": u"<dc:date>%s</dc:date>",
-            "type":  u"<dc:type>%s</dc:type>",
+    def content_hash(self, identifier):
+        """
+            Hash of everything the record of `identifier` is built from:
+            the publication fields, the attachment, the resolved authors
+            and grants and the stored access, which prefetch_access finds
+            before the records are disseminated.
+        """
+        rec = self.publications.ids[identifier]
+        attachment = self.attachments.ids.get(identifier)
+        content = {
+            "publication": rec.as_dict(),
+            "attachment": attachment.as_dict()
+            if attachment is not None else None,
+            "authors": [self.authors.ids.get(k)
+                        for k in sorted(rec.get("Author(s)", ()))],
+            "grants": [self.grants.ids[k].get("openaire_id")
+                       for k in sorted(rec.get("Supported by", ()))],
+            "access": self._access_store.get(identifier),
         }
+        # sets are not serializable and have no stable order
+        dump = json.dumps(content, sort_keys=True, default=sorted)
+        return hashlib.sha1(dump.encode("utf-8")).hexdigest()
 
-        rec = self.publications.ids[identifier]
+    def has_changed(self, identifier):
+        """
+            Whether the inputs of the record differ from the ones it was
+            last disseminated with.
+        """
+        return self._hash_store.get(identifier) != \
+            self.content_hash(identifier)
 
-        # Mandatory fields
-        try:
-            vals["ids"] %= "http://hdl.handle.net/11346/BIBLIO@id=" + identifier
+    def store_hashes(self, identifiers):
+        """
+            Remember the inputs of records which have been committed, so
+            that they are disseminated again only when they change.
+        """
+        self._hash_store.put_all(
+            (identifier, self.content_hash(identifier))
+            for identifier in identifiers)
+
+    # the first of these fields which is set is used as the title
+    title_keys = ("Title", "Original title", "English title", "Czech title")
 
+    def _compile_dc(self):
+        """
+            Build the emitters of the dc fields, in the order of the
+            output. Each one returns the escaped values of its field for a
+            record. Values shared between records are escaped only once.
+        """
+        creator_names = dict(
+            (k, escape(v.strip())) for k, v in self.authors.ids.items())
+        grant_ids = dict(
+            (k, escape(v["openaire_id"].strip()))
+            for k, v in self.grants.ids.items())
+        escaped = {}
+
+        def escape_shared(v):
+            if v not in escaped:
+                escaped[v] = escape(v)
+            return escaped[v]
+
+        def ids(identifier, rec):
+            return [escape("http://hdl.handle.net/11346/BIBLIO@id=" +
+                           identifier)]
+
+        title_getters = [attrgetter(publication_record.labels[k])
+                         for k in biblio.title_keys]
+
+        def title(identifier, rec):
             # get first title
-            for key_title in ["Title", "Original title", "English title", "Czech title"]:
-                val = self._fill_values("title", rec.get, [key_title], vals)
-                if 0 < len(val):
-                    break
+            for get in title_getters:
+                v = get(rec)
+                if v is not None:
+                    return [escape(v.strip())]
+            return []
 
-            self._fill_values(
-                "creators", self.authors.ids.get, rec.get("Author(s)"), vals
-            )
-            # Project identifier info:eu-repo/grantAgreement
-            self._fill_values(
-                "relations",
-                lambda k: self.grants.ids[k]["openaire_id"],
-                rec.get("Supported by"),
-                vals
-            )
+        def creators(identifier, rec):
+            return [creator_names[k] for k in rec.authors
+                    if k in creator_names]
+
+        # Project identifier info:eu-repo/grantAgreement
+        def relations(identifier, rec):
+            return [grant_ids[k] for k in rec.supported_by]
 
-            # Access level info:eu-repo/semantics
-            # XXX: hardcoded openaccess
+        # Access level info:eu-repo/semantics
+        def rights(identifier, rec):
             access = self._find_access(rec, identifier)
-            vals["rights"] %= access
             self._cnts[access] += 1
-
+            return [escape_shared(access)]
+
+        def field(key, shared=False, value_mapper=None):
+            get = attrgetter(publication_record.labels[key])
+
+            def values(identifier, rec):
+                v = get(rec)
+                if v is None:
+                    return []
+                v = v.strip()
+                if value_mapper is not None:
+                    v = value_mapper(v)
+                return [escape_shared(v) if shared else escape(v)]
+            return values
+
+        emitters = [
+            ("identifier", ids),
+            ("title", title),
+            ("creator", creators),
+            ("relation", relations),
+            ("rights", rights),
             # XXX: subject/keywords nothing to map?
             #        #dc_subject
             # description...use english abstract
-            self._fill_values(
-                "descriptions", rec.get, ["English abstract"], vals
-            )
-
-            # Publisher
-            self._fill_values("publishers", rec.get, ["Publisher"], vals)
-
+            ("description", field("English abstract")),
+            ("publisher", field("Publisher", shared=True)),
             # publication date #Use Year for now, there is also a date field
-            self._fill_values("dates", rec.get, ["Year"], vals)
-
-            #
-            self._fill_values(
-                "type", rec.get, ["Type"], vals, biblio.map_to_type
-            )
+            ("date", field("Year", shared=True)),
+            ("type", field("Type", shared=True,
+                           value_mapper=biblio.map_to_type)),
+        ]
+        return [(u"<dc:%s>" % tag, u"</dc:%s>" % tag, values)
+                for tag, values in emitters]
 
+    def to_dc(self, identifier):
+        rec = self.publications.ids[identifier]
+        head, tail = biblio.dc_template.split("%s")
+        out = [head]
+        try:
+            # one line per field, one element per value
+            for pos, (open_tag, close_tag, values) in enumerate(
+                    self._dc_emitters):
+                if 0 < pos:
+                    out.append(u"\n")
+                for i, v in enumerate(values(identifier, rec)):
+                    if 0 < i:
+                        out.append(u"\n")
+                    out.append(open_tag)
+                    out.append(v)
+                    out.append(close_tag)
         except KeyError, e:
             _logger.error(
                 "Error fetching mandatory metadata for %s [%s]", identifier, repr(e))
             return None
+        out.append(tail)
+        return u"".join(out)
 
-        return biblio.dc_template % record_template.strip().format(**vals)
+    def prefetch_access(self):
+        """
+            Find the access of all records which are not in the access
+            store yet, probing their URLs concurrently.
+        """
+        pending = {}
+        for id_str, rec in self.publications.ids.items():
+            if self._access_store.get(id_str) is not None:
+                continue
+            access, urls = self._access_urls(rec, id_str)
+            if access is not None:
+                self._access_store.put(id_str, access)
+            else:
+                pending[id_str] = urls
+        if 0 == len(pending):
+            return
+        _logger.info("Probing URLs of [%d] records", len(pending))
+        probes = self._prober.probe(
+            url for urls in pending.values() for url in urls)
+        for id_str, urls in pending.items():
+            self._access_store.put(
+                id_str, self._access_from_probes(urls, probes))
 
     def _find_access(self, rec, id_str):
-        open_access = "info:eu-repo/semantics/openAccess"
-        closed_access = "info:eu-repo/semantics/closedAccess"
-
         # already done?
-        if id_str in self._access_map:
-            return self._access_map[id_str]
+        access = self._access_store.get(id_str)
+        if access is not None:
+            return access
 
-        access = None
+        access, urls = self._access_urls(rec, id_str)
+        if access is None:
+            access = self._access_from_probes(urls, self._prober.probe(urls))
 
+        # store info
+        self._access_store.put(id_str, access)
+        return access
+
+    def _access_urls(self, rec, id_str):
+        """
+            Return the access if it is known without fetching anything,
+            otherwise None and the URLs to probe.
+        """
         # based on the appropriate field if available
         oa = rec.get("Open access")
         if oa == '1':
-            access = open_access
+            return biblio.open_access, []
 
         # based on attachment
-        if access is None:
-            attach = self.attachments.ids.get(id_str, {})
-            if "pdf" in attach.get("FileCType", ""):
-                if "public" == attach.get("Access", ""):
-                    access = open_access
+        attach = self.attachments.ids.get(id_str, {})
+        if "pdf" in attach.get("FileCType", ""):
+            if "public" == attach.get("Access", ""):
+                return biblio.open_access, []
 
         # based on URL
-        if access is None:
-            urls = rec.get("URL")
-            access = closed_access
-            if urls is not None and 0 < len(urls):
-                self._cnts["urls"] += 1
-                if not ("[" == urls[0] and "]" == urls[-1]):
-                    _logger.warn("Invalid url: %s", urls)
-                    urls = []
-                elif "], [" in urls:
-                    _logger.warn("Multiple urls: %s", urls)
-                    # todo: use regexp
-                    urls = [x.lstrip("[").rstrip("]")
-                            for x in urls.split("], [")]
-                else:
-                    urls = [urls[1:-1]]
-
-                for url in urls:
-                    if access != closed_access:
-                        break
-                    is_magic = False
-                    for magic in (
-                            "github.com",
-                            "hdl.handle.net/",
-                            "http://www.lrec-conf.org/",
-                            "http://ufal.mff.cuni.cz/",
-                    ):
-                        if magic in url:
-                            access = open_access
-                            is_magic = True
-                            break
-
-                    status = -1
-                    if not is_magic:
-                        # fetching problems
-                        # http://stackoverflow.com/questions/18337630/what-is-x-content-type-options-nosniff
-                        try:
-                            r = requests.head(url)
-                            status = r.status_code
-                            if status == 200:
-                                if "/pdf" in r.headers['content-type']:
-                                    access = open_access
-                        except Exception, e:
-                            _logger.warn("Url [%s] problem [%s]", url, repr(e))
-
-                    print "%3d. URL: [%3s] [%15s] %s" % (
-                        self._cnts["urls"], status, access[-15:], url
-                    )
-
-        # store info
-        self._access_map[id_str] = access
+        urls = rec.get("URL")
+        if urls is None or 0 == len(urls):
+            return biblio.closed_access, []
+        self._cnts["urls"] += 1
+        if not ("[" == urls[0] and "]" == urls[-1]):
+            _logger.warn("Invalid url: %s", urls)
+            return biblio.closed_access, []
+        elif "], [" in urls:
+            _logger.warn("Multiple urls: %s", urls)
+            # todo: use regexp
+            urls = [x.lstrip("[").rstrip("]")
+                    for x in urls.split("], [")]
+        else:
+            urls = [urls[1:-1]]
+
+        for url in urls:
+            for magic in biblio.open_url_magic:
+                if magic in url:
+                    return biblio.open_access, []
+        return None, urls
+
+    def _access_from_probes(self, urls, probes):
+        access = biblio.closed_access
+        for url in urls:
+            status, content_type = probes[url]
+            if status == 200 and "/pdf" in content_type:
+                access = biblio.open_access
+            print "%3d. URL: [%3s] [%15s] %s" % (
+                self._cnts["urls"], status, access[-15:], url
+            )
+            if access != biblio.closed_access:
+                break
         return access
 
     @staticmethod
@@ -434,7 +816,8 @@ class Provider(object):
     Metadata provider for DDI Codebook XML files.
     """
 
-    def __init__(self, domain_name='biblio.ufal.mff.cuni.cz', directory='./input_biblio'):
+    def __init__(self, domain_name='biblio.ufal.mff.cuni.cz', directory='./input_biblio',
+                 transport=None):
         """
             Initialize the metadata provider.
 
@@ -444,9 +827,18 @@ class Provider(object):
                 Path of the directory to scan for DDI files.
             domain_name: str
                 The domain name part of the OAI identifiers.
+            transport: callable, str or None
+                Fetches the status and content type of a URL when finding
+                the access of a record, see HttpTransport. The string
+                "offline" does not fetch anything, so the records whose
+                access is not known otherwise are closed, see
+                StubTransport. By default the URLs are fetched over HTTP.
         """
         self.oai_identifier_prefix = 'oai:{0}:'.format(domain_name)
         self.directory = directory
+        if transport == "offline":
+            transport = StubTransport()
+        self.transport = transport
 
     def formats(self):
         """
@@ -473,11 +865,13 @@ class Provider(object):
             iterable of str:
                 OAI identifiers of all items
         """
-        logging.debug(
-            'Parsing directory {0} for biblio related files...', self.directory)
+        _logger.debug(
+            "Parsing directory %s for biblio related files...", self.directory)
 
         #
-        self.biblio = biblio(self.directory)
+        self.biblio = biblio(self.directory, self.transport)
+        # find the access of new records before they are disseminated
+        self.biblio.prefetch_access()
 
         for identifier in self.biblio.identifiers:
             yield self.make_identifier(identifier)
@@ -499,7 +893,10 @@ class Provider(object):
                 `True`, if metadata or sets of the item have change since the
                 given time. Otherwise `False`.
         """
-        return True
+        # The exports carry no modification times, so compare the record
+        # inputs with the ones stored when it was last disseminated.
+        return self.biblio.has_changed(
+            identifier[len(self.oai_identifier_prefix):])
 
     def get_sets(self, identifier):
         """
@@ -547,7 +944,27 @@ class Provider(object):
         if metadata_prefix != 'oai_dc':
             return None
 
-        return self.biblio.to_dc(identifier[len(self.oai_identifier_prefix):])
+        id_str = identifier[len(self.oai_identifier_prefix):]
+        return self.biblio.to_dc(id_str)
+
+    def records_committed(self, identifiers):
+        """
+            Store the content hashes of committed items.
+
+            Called by the importer in the harvesting process after the
+            records have been committed, so the hashes are neither stored
+            for records which failed nor in dry runs, and they are not lost
+            in dissemination worker processes.
+
+            Parameters
+            ----------
+            identifiers: list of unicode
+                The OAI identifiers (as returned by identifiers()) of the
+                items.
+        """
+        self.biblio.store_hashes(
+            [identifier[len(self.oai_identifier_prefix):]
+             for identifier in identifiers])
 
     def make_identifier(self, identifier):
         """
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The metadata provider is a module in the biblio directory, which is not
+# a package. The previous implementation of biblio.to_dc, which the tests
+# compare the output with, is kept in the benchmarks. The importer is run
+# from the repository like import.py does.
+_here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(_here, '..'))
+sys.path.insert(0, os.path.join(_here, '..', '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(_here, '..', '..'))
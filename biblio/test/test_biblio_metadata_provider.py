@@ -0,0 +1,615 @@
+# coding=utf-8
+import ConfigParser
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree
+from StringIO import StringIO
+
+import mock
+
+from biblio_metadata_provider import (
+    AccessProber,
+    AccessStore,
+    HashStore,
+    Openaire,
+    Provider,
+    StubTransport,
+    attachment_record,
+    attachments,
+    authors,
+    base_biblio,
+    biblio,
+    grants,
+    publication_record,
+)
+from biblio_to_dc import template_to_dc
+from kuha import importer, models
+
+BIBLIO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+
+OPEN = biblio.open_access
+CLOSED = biblio.closed_access
+
+
+def setUpModule():
+    # The provider logs the problems of the fixture data.
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class BiblioTestCase(unittest.TestCase):
+    """Run a test in a working directory holding the fixture exports.
+
+    The provider reads the OpenAIRE projects and keeps its state in the
+    working directory.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.work = os.path.join(self.directory, 'work')
+        shutil.copytree(DATA, self.work)
+        self.cwd = os.getcwd()
+        os.chdir(self.work)
+        # The provider prints its progress.
+        self.stdout = mock.patch('sys.stdout', new_callable=StringIO)
+        self.stdout.start()
+
+    def tearDown(self):
+        self.stdout.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        return biblio('input_biblio', StubTransport())
+
+    def edit(self, name, old, new):
+        """Replace text in a fixture export."""
+        path = os.path.join('input_biblio', name)
+        with open(path) as f:
+            data = f.read()
+        self.assertIn(old, data)
+        with open(path, 'w') as f:
+            f.write(data.replace(old, new))
+
+
+class TestAccessProber(unittest.TestCase):
+
+    def test_probe(self):
+        transport = StubTransport({
+            'http://a': (200, 'application/pdf'),
+            'http://b': (403, 'text/html'),
+        })
+        prober = AccessProber(transport, workers=1)
+        self.assertEqual(
+            prober.probe(['http://a', 'http://b', 'http://c', 'http://a']),
+            {'http://a': (200, 'application/pdf'),
+             'http://b': (403, 'text/html'),
+             'http://c': (404, '')})
+        # Each URL is fetched once.
+        self.assertItemsEqual(transport.requested,
+                              ['http://a', 'http://b', 'http://c'])
+
+    def test_probe_in_pool(self):
+        urls = ['http://example.org/{0}'.format(i) for i in xrange(20)]
+        transport = StubTransport(
+            dict((url, (200, 'application/pdf')) for url in urls[::2]))
+        prober = AccessProber(transport, workers=4)
+        probes = prober.probe(urls)
+        self.assertEqual(
+            [probes[url][0] for url in urls], [200, 404] * 10)
+        self.assertItemsEqual(transport.requested, urls)
+
+    def test_transport_fails(self):
+        def transport(url):
+            if url == 'http://a':
+                raise IOError('connection refused')
+            return 200, 'text/html'
+        for workers in [1, 2]:
+            prober = AccessProber(transport, workers=workers)
+            self.assertEqual(prober.probe(['http://a', 'http://b']),
+                             {'http://a': (-1, ''),
+                              'http://b': (200, 'text/html')})
+
+    def test_no_urls(self):
+        self.assertEqual(AccessProber(StubTransport()).probe([]), {})
+
+
+class TestAccessStore(BiblioTestCase):
+
+    def open_store(self, ttl=100, legacy_f=None, now=1000.0):
+        with mock.patch('time.time', return_value=now):
+            return AccessStore('accesses.jsonl', ttl, legacy_f)
+
+    def lines(self):
+        with open('accesses.jsonl') as f:
+            return [json.loads(line) for line in f]
+
+    def test_put(self):
+        store = self.open_store()
+        self.assertIsNone(store.get('p1'))
+        with mock.patch('time.time', return_value=1010.0):
+            store.put('p1', OPEN)
+            store.put('p2', CLOSED)
+            store.put('p1', CLOSED)
+        # The entries are written as soon as they are found.
+        self.assertEqual([e['access'] for e in self.lines()],
+                         [OPEN, CLOSED, CLOSED])
+        store.close()
+
+        store = self.open_store(now=1020.0)
+        with mock.patch('time.time', return_value=1020.0):
+            self.assertEqual(store.get('p1'), CLOSED)
+            self.assertEqual(store.get('p2'), CLOSED)
+        store.close()
+        # The file is compacted when opened.
+        self.assertEqual(self.lines(), [
+            {'id': 'p1', 'access': CLOSED, 'time': 1010.0},
+            {'id': 'p2', 'access': CLOSED, 'time': 1010.0},
+        ])
+
+    def test_expiry(self):
+        store = self.open_store()
+        with mock.patch('time.time', return_value=1000.0):
+            store.put('old', OPEN)
+        with mock.patch('time.time', return_value=1050.0):
+            store.put('new', OPEN)
+        with mock.patch('time.time', return_value=1100.0):
+            self.assertEqual(store.get('old'), OPEN)
+        with mock.patch('time.time', return_value=1101.0):
+            self.assertIsNone(store.get('old'))
+            self.assertEqual(store.get('new'), OPEN)
+        store.close()
+
+        # Expired entries are dropped from the file.
+        self.open_store(now=1101.0).close()
+        self.assertEqual([e['id'] for e in self.lines()], ['new'])
+
+    def test_legacy_import(self):
+        with open('accesses.json', 'w') as f:
+            json.dump({'p1': OPEN, 'p2': CLOSED}, f)
+        store = self.open_store(legacy_f='accesses.json')
+        with mock.patch('time.time', return_value=1000.0):
+            self.assertEqual(store.get('p1'), OPEN)
+            self.assertEqual(store.get('p2'), CLOSED)
+        store.close()
+        # The imported entries expire like the others.
+        self.assertEqual(self.lines(), [
+            {'id': 'p1', 'access': OPEN, 'time': 1000.0},
+            {'id': 'p2', 'access': CLOSED, 'time': 1000.0},
+        ])
+
+    def test_legacy_ignored(self):
+        """The legacy file should be imported only once."""
+        self.open_store().close()
+        with open('accesses.json', 'w') as f:
+            json.dump({'p1': OPEN}, f)
+        store = self.open_store(legacy_f='accesses.json')
+        self.assertIsNone(store.get('p1'))
+        store.close()
+
+
+class TestProviderTransport(BiblioTestCase):
+
+    def identifiers(self, provider):
+        return sorted(i[len('oai:biblio.example.org:'):]
+                      for i in provider.identifiers())
+
+    def rights(self, provider, id_str):
+        dc = provider.get_record('oai:biblio.example.org:' + id_str,
+                                 'oai_dc')
+        return dc.split('<dc:rights>')[1].split('</dc:rights>')[0]
+
+    def test_transport(self):
+        transport = StubTransport({
+            'http://example.org/p2.pdf': (200, 'application/pdf'),
+        })
+        provider = Provider('biblio.example.org', 'input_biblio', transport)
+        self.assertEqual(self.identifiers(provider),
+                         ['p1', 'p2', 'p4', 'p5', 'p6'])
+
+        # Only the URLs of the records whose access is not known otherwise
+        # are probed, before the records are disseminated.
+        self.assertItemsEqual(transport.requested, [
+            'http://example.org/p2.pdf',
+            'http://example.org/p4',
+            'http://example.org/p4.pdf',
+        ])
+        self.assertEqual(
+            dict((i, self.rights(provider, i))
+                 for i in ['p1', 'p2', 'p4', 'p5', 'p6']),
+            {'p1': OPEN, 'p2': OPEN, 'p4': CLOSED, 'p5': OPEN, 'p6': OPEN})
+        self.assertEqual(len(transport.requested), 3)
+
+    def test_offline(self):
+        provider = Provider('biblio.example.org', 'input_biblio', 'offline')
+        self.assertIsInstance(provider.transport, StubTransport)
+        self.assertEqual(len(self.identifiers(provider)), 5)
+        self.assertEqual(self.rights(provider, 'p2'), CLOSED)
+
+
+class TestChangeDetection(BiblioTestCase):
+
+    def test_content_hash(self):
+        hashes = dict((i, self.load().content_hash(i))
+                      for i in ['p1', 'p2', 'p4'])
+        self.assertEqual(len(set(hashes.values())), 3)
+        # The hash is stable across loads although the ids of the authors
+        # and grants are held in sets.
+        b = self.load()
+        self.assertEqual(dict((i, b.content_hash(i)) for i in hashes),
+                         hashes)
+
+        # Fields which are not disseminated are ignored.
+        self.edit('publications.xml', '<Field Label="Pages">1-10</Field>',
+                  '<Field Label="Pages">1-12</Field>')
+        self.assertEqual(self.load().content_hash('p1'), hashes['p1'])
+
+        # The authors and the grants are part of the record.
+        self.edit('authors.xml', 'Smith &amp; Sons', 'Smith')
+        b = self.load()
+        self.assertNotEqual(b.content_hash('p1'), hashes['p1'])
+        self.assertEqual(b.content_hash('p2'), hashes['p2'])
+        self.edit('publications.xml', '<Field Label="Supported by">g2;g3',
+                  '<Field Label="Supported by">g2;g1')
+        self.assertNotEqual(self.load().content_hash('p2'), hashes['p2'])
+
+    def test_access_changes(self):
+        """A record should change when its access does."""
+        b = self.load()
+        b.prefetch_access()
+        b.store_hashes(['p2'])
+        self.assertFalse(b.has_changed('p2'))
+
+        # The access is probed again after it has expired.
+        b._access_store.put('p2', OPEN)
+        self.assertTrue(b.has_changed('p2'))
+
+    def test_has_changed(self):
+        b = self.load()
+        self.assertTrue(b.has_changed('p1'))
+        b.store_hashes(['p1', 'p2'])
+        self.assertFalse(b.has_changed('p1'))
+        self.assertTrue(b.has_changed('p4'))
+
+        # The hashes are persisted as soon as they are stored.
+        self.edit('publications.xml', '<Field Label="Year">2016</Field>',
+                  '<Field Label="Year">2017</Field>')
+        b = self.load()
+        self.assertFalse(b.has_changed('p1'))
+        self.assertTrue(b.has_changed('p2'))
+        self.assertTrue(b.has_changed('p4'))
+
+    def test_provider(self):
+        """The hashes should be stored only for committed records."""
+        provider = Provider('biblio.example.org', 'input_biblio',
+                            StubTransport())
+        identifiers = list(provider.identifiers())
+        for identifier in identifiers:
+            self.assertTrue(provider.has_changed(identifier, None))
+            provider.get_record(identifier, 'oai_dc')
+        self.assertTrue(provider.has_changed(identifiers[0], None))
+
+        provider.records_committed(identifiers[:2])
+        self.assertEqual(
+            [provider.has_changed(identifier, None)
+             for identifier in identifiers],
+            [False, False] + [True] * (len(identifiers) - 2))
+
+
+class TestHashStore(BiblioTestCase):
+
+    def test_put_all(self):
+        store = HashStore('hashes.jsonl')
+        store.put_all([('p1', 'a'), ('p2', 'b')])
+        store.put_all([('p1', 'c')])
+        store.close()
+
+        store = HashStore('hashes.jsonl')
+        self.assertEqual(store.get('p1'), 'c')
+        self.assertEqual(store.get('p2'), 'b')
+        self.assertIsNone(store.get('p3'))
+        store.close()
+        # The file is compacted when opened.
+        with open('hashes.jsonl') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+class TestOpenaire(BiblioTestCase):
+
+    project = 'info:eu-repo/grantAgreement/EC/{0}/{1}/EU/Project {2}/{3}'
+
+    def test_index(self):
+        openaire = Openaire(os.path.join('input_openaire',
+                                         'openaire-cache.list'))
+        self.assertEqual(len(openaire.ids), 4)
+        self.assertEqual(openaire.by_grant_id['600001'],
+                         [self.project.format('FP7', 600001, 'One', 'ONE')])
+        self.assertEqual(openaire.by_grant_id['800003'], [
+            self.project.format('FP7', 800003, 'Three', 'THREE'),
+            self.project.format('H2020', 800003, 'Four', 'FOUR'),
+        ])
+        # Only the numeric segments are indexed.
+        self.assertItemsEqual(openaire.by_grant_id.keys(),
+                              ['600001', '700002', '800003'])
+        self.assertEqual(openaire.resolved, {})
+
+    def test_parse_drops_pairs(self):
+        """Parsed pairs should not be held in the document."""
+        roots = []
+        iterparse = xml.etree.ElementTree.iterparse
+
+        def parse(*args, **kwargs):
+            for event, elem in iterparse(*args, **kwargs):
+                if not roots:
+                    roots.append(elem)
+                yield event, elem
+
+        with mock.patch.object(xml.etree.ElementTree, 'iterparse', parse):
+            openaire = Openaire(os.path.join('input_openaire',
+                                             'openaire-cache.list'))
+        self.assertEqual(len(openaire.ids), 4)
+        self.assertEqual(roots[0].tag, 'list')
+        self.assertEqual(list(roots[0]), [])
+
+    def test_grants(self):
+        with mock.patch.object(grants, '_resolve_openaire_id',
+                               wraps=grants._resolve_openaire_id) as resolve:
+            b = self.load()
+
+        self.assertEqual(
+            dict((k, v['openaire_id']) for k, v in b.grants.ids.items()),
+            {'g1': self.project.format('FP7', 600001, 'One', 'ONE'),
+             # The number is not the last segment of the code.
+             'g2': self.project.format('H2020', 700002, 'Two', 'TWO'),
+             'g5': grants.fallback_mapping['HORIZON-CL4-2021-DATA-01-03'],
+             'g7': self.project.format('FP7', 600001, 'One', 'ONE')})
+        # Each code is resolved once, and failures are remembered too.
+        self.assertItemsEqual(
+            [c[0][0] for c in resolve.call_args_list],
+            ['FP7-ICT-600001', 'H2020-ICT-700002-RIA',
+             'HORIZON-CL4-2021-DATA-01-03', 'FP7-SEC-800003'])
+        self.assertIsNone(b.openaire.resolved['FP7-SEC-800003'])
+
+
+class TestParse(BiblioTestCase):
+
+    def write(self, data):
+        with open('export.xml', 'w') as f:
+            f.write(data)
+        return 'export.xml'
+
+    def test_records_dropped(self):
+        """Parsed records should not be held in the document."""
+        roots = []
+        iterparse = xml.etree.ElementTree.iterparse
+
+        def parse(*args, **kwargs):
+            for event, elem in iterparse(*args, **kwargs):
+                if not roots:
+                    roots.append(elem)
+                yield event, elem
+
+        parsed = []
+
+        def ftor(elem):
+            # The parser reads ahead, so the following records may be in
+            # the document already, but the preceding ones are not.
+            for previous in parsed:
+                self.assertNotIn(previous, list(roots[0]))
+            parsed.append(elem)
+            return {'title': elem.findtext('Field')}
+
+        with mock.patch.object(xml.etree.ElementTree, 'iterparse', parse):
+            exported = base_biblio(os.path.join('input_biblio',
+                                                'publications.xml'), ftor)
+        self.assertEqual(len(parsed), 7)
+        self.assertEqual(len(exported.ids), 7)
+        self.assertEqual(list(roots[0]), [])
+
+    def test_top_level_records(self):
+        """Only the records at the top level should be parsed."""
+        path = self.write(
+            '<Records>'
+            '<Record Id="1"><Record Id="nested"/></Record>'
+            '<Other Id="2"/>'
+            '<Record Id="3"><Field Label="Title">Three</Field></Record>'
+            '</Records>')
+        self.assertEqual(base_biblio(path).ids, {'1': {}, '3': {}})
+        self.assertEqual(
+            base_biblio(path, lambda e: len(e) or None).ids, {'1': 1, '3': 1})
+
+    def test_authors(self):
+        parsed = authors(os.path.join('input_biblio', 'authors.xml'))
+        self.assertEqual(parsed.ids, {'a1': u'Nov\xe1k, Jan',
+                                      'a2': 'Smith & Sons',
+                                      'a3': 'Anna'})
+
+    def test_attachments(self):
+        """Attachments should be found by the id of the publication."""
+        parsed = attachments(os.path.join('input_biblio',
+                                          'attachedfiles.xml'))
+        self.assertItemsEqual(parsed.ids.keys(), ['p4', 'p5'])
+        self.assertEqual(parsed.ids['p5'].get('Access'), 'public')
+
+    def test_publications(self):
+        b = self.load()
+        # Publications without supported grants are left out.
+        self.assertItemsEqual(b.identifiers, ['p1', 'p2', 'p4', 'p5', 'p6'])
+        self.assertEqual(b.publications.ids['p2'].get('Supported by'),
+                         frozenset(['g2']))
+        self.assertEqual(b.publications.ids['p2'].get('Author(s)'),
+                         frozenset(['a3', 'unknown']))
+
+
+class TestCompactRecord(BiblioTestCase):
+
+    def test_fields(self):
+        rec = publication_record({'Title': u'A title', 'Year': u'2015',
+                                  'Pages': u'1-10'})
+        self.assertFalse(hasattr(rec, '__dict__'))
+        self.assertEqual(rec['Title'], u'A title')
+        self.assertEqual(rec.get('Year'), u'2015')
+        # Unused fields are dropped.
+        self.assertIsNone(rec.get('Pages'))
+        self.assertRaises(KeyError, lambda: rec['Pages'])
+        self.assertIsNone(rec['Publisher'])
+        self.assertEqual(rec.get('Publisher', u'none'), u'none')
+        expected = dict((label, None) for label in publication_record.labels)
+        expected.update({'Title': u'A title', 'Year': u'2015'})
+        self.assertEqual(rec.as_dict(), expected)
+
+    def test_shared_values(self):
+        """Values repeated in many records should be stored once."""
+        interned = {}
+        recs = [attachment_record({'id': 'p{0}'.format(i),
+                                   'FileCType': ''.join(['application/',
+                                                         'pdf'])},
+                                  interned)
+                for i in xrange(2)]
+        self.assertIs(recs[0].get('FileCType'), recs[1].get('FileCType'))
+        # the ids are unique to the records and are not kept in the table
+        self.assertEqual(interned.keys(), ['application/pdf'])
+
+        b = self.load()
+        publisher = [b.publications.ids[i].get('Publisher')
+                     for i in ['p1', 'p4']]
+        self.assertEqual(publisher[0], 'ACL')
+        self.assertIs(publisher[0], publisher[1])
+
+    def test_shared_per_instance(self):
+        """The shared values should not outlive their biblio instance."""
+        publisher = [self.load().publications.ids['p1'].get('Publisher')
+                     for _ in xrange(2)]
+        self.assertEqual(publisher[0], publisher[1])
+        self.assertIsNot(publisher[0], publisher[1])
+
+
+class TestToDc(BiblioTestCase):
+
+    dc_ns = '{http://purl.org/dc/elements/1.1/}'
+
+    def setUp(self):
+        super(TestToDc, self).setUp()
+        self.b = biblio('input_biblio', StubTransport({
+            'http://example.org/p4.pdf': (200, 'application/pdf'),
+        }))
+
+    def fields(self, identifier):
+        dc = self.b.to_dc(identifier)
+        root = xml.etree.ElementTree.fromstring(dc.encode('utf-8'))
+        return [(e.tag[len(self.dc_ns):], e.text) for e in root]
+
+    def test_fields(self):
+        fields = self.fields('p1')
+        self.assertEqual(
+            [tag for tag, _ in fields],
+            ['identifier', 'title', 'creator', 'creator', 'relation',
+             'rights', 'description', 'publisher', 'date', 'type'])
+        self.assertItemsEqual(fields, [
+            ('identifier', 'http://hdl.handle.net/11346/BIBLIO@id=p1'),
+            ('title', 'First & <best>'),
+            ('creator', u'Nov\xe1k, Jan'),
+            ('creator', 'Smith & Sons'),
+            ('relation', 'info:eu-repo/grantAgreement/EC/FP7/600001/EU/'
+                         'Project One/ONE'),
+            ('rights', OPEN),
+            ('description', 'An abstract.'),
+            ('publisher', 'ACL'),
+            ('date', '2015'),
+            ('type', 'info:eu-repo/semantics/article'),
+        ])
+
+    def test_missing_fields(self):
+        fields = self.fields('p4')
+        self.assertEqual(
+            [tag for tag, _ in fields],
+            ['identifier', 'title', 'creator', 'creator', 'relation',
+             'relation', 'rights', 'publisher', 'date', 'type'])
+        self.assertItemsEqual(fields, [
+            ('identifier', 'http://hdl.handle.net/11346/BIBLIO@id=p4'),
+            # The first title which is set is used.
+            ('title', u'\u010ctvrt\xe1'),
+            ('creator', u'Nov\xe1k, Jan'),
+            ('creator', 'Anna'),
+            ('relation', 'info:eu-repo/grantAgreement/EC/HE/101070350'),
+            ('relation', 'info:eu-repo/grantAgreement/EC/FP7/600001/EU/'
+                         'Project One/ONE'),
+            # The second URL is an open PDF.
+            ('rights', OPEN),
+            ('publisher', 'ACL'),
+            ('date', '2022'),
+            ('type', 'info:eu-repo/semantics/other'),
+        ])
+        # Unknown authors are left out.
+        self.assertEqual(
+            [f for f in self.fields('p2') if f[0] in ['title', 'creator']],
+            [('title', 'Second'), ('creator', 'Anna')])
+
+    def test_templates(self):
+        """The output should equal the previous implementation."""
+        # It failed for the records without the first title field.
+        identifiers = ['p1', 'p5', 'p6']
+        self.b.prefetch_access()
+        for identifier in identifiers:
+            self.assertEqual(self.b.to_dc(identifier),
+                             template_to_dc(self.b, identifier))
+
+
+class TestImport(BiblioTestCase):
+    """Import the fixture exports with the shipped configuration."""
+
+    def tearDown(self):
+        models.DBSession.remove()
+        super(TestImport, self).tearDown()
+
+    def settings(self):
+        parser = ConfigParser.SafeConfigParser({'here': BIBLIO})
+        parser.read(os.path.join(BIBLIO, 'biblio.ini'))
+        settings = dict(parser.items('app:main'))
+        # Keep the state of the import in the working directory and do
+        # not fetch any URLs.
+        settings.update({
+            'sqlalchemy.url': 'sqlite:///' + os.path.join(self.work,
+                                                          'kuha.sqlite'),
+            'timestamp_file': os.path.join(self.work, 'last_update'),
+            'metadata_provider_args':
+                'biblio.example.org input_biblio offline',
+        })
+        return settings
+
+    def run_import(self):
+        """Run the importer and return the disseminated identifiers."""
+        disseminated = []
+        get_record = Provider.get_record
+
+        def spy(provider, identifier, metadata_prefix):
+            disseminated.append(identifier[len('oai:biblio.example.org:'):])
+            return get_record(provider, identifier, metadata_prefix)
+
+        # Each run configures a new database session like a new process.
+        models.DBSession.remove()
+        with mock.patch.object(importer, 'get_appsettings',
+                               return_value=self.settings()):
+            with mock.patch.object(importer, 'setup_logging'):
+                with mock.patch.object(Provider, 'get_record', spy):
+                    importer.main(['import.py', 'biblio.ini'])
+        return sorted(disseminated)
+
+    def test_unchanged_records_skipped(self):
+        self.assertEqual(self.run_import(), ['p1', 'p2', 'p4', 'p5', 'p6'])
+        self.assertEqual(self.run_import(), [])
+
+        self.edit('publications.xml', '<Field Label="Year">2016</Field>',
+                  '<Field Label="Year">2017</Field>')
+        self.assertEqual(self.run_import(), ['p2'])
+        records = models.Record.list(identifier=u'oai:biblio.example.org:p2')
+        self.assertIn(u'<dc:date>2017</dc:date>', records[0].xml)
+        models.rollback()
@@ -19,6 +19,10 @@ def clean_oai_settings(settings):
         repository_name
         sqlalchemy.url
 
+    Optional settings and their defaults are:
+        datestamp_cache_ttl = 0
+        response_cache_size = 0
+
     Parameters
     ----------
     settings: dict from str to str
@@ -31,14 +35,21 @@ def clean_oai_settings(settings):
     """
     cleaners = {
         'admin_emails': _clean_admin_emails,
+        'datestamp_cache_ttl': _clean_non_negative_integer,
         'deleted_records': _clean_deleted_records,
         'item_list_limit': _clean_item_list_limit,
         'logging_config': _clean_unicode,
         'repository_descriptions': _load_repository_descriptions,
         'repository_name': _clean_unicode,
+        'response_cache_size': _clean_non_negative_integer,
         'sqlalchemy.url': _clean_unicode,
     }
-    _clean_settings(settings, cleaners)
+    defaults = {
+        # Without the caches every request reads the database.
+        'datestamp_cache_ttl': '0',
+        'response_cache_size': '0',
+    }
+    _clean_settings(settings, cleaners, defaults)
 
 
 def clean_importer_settings(settings):
@@ -56,6 +67,12 @@ def clean_importer_settings(settings):
         metadata_provider_class
         metadata_provider_args
 
+    Optional settings and their defaults are:
+        bulk_import = no
+        commit_batch_size = 1
+        dissemination_pool = thread
+        dissemination_workers = 1
+
     Parameters
     ----------
     settings: dict from str to str
@@ -67,7 +84,11 @@ def clean_importer_settings(settings):
         If some setting is missing or has an invalid value.
     """
     cleaners = {
+        'bulk_import': _clean_boolean,
+        'commit_batch_size': _clean_positive_integer,
         'deleted_records': _clean_deleted_records,
+        'dissemination_pool': _clean_pool_type,
+        'dissemination_workers': _clean_positive_integer,
         'dry_run': _clean_boolean,
         'force_update': _clean_boolean,
         'logging_config': _clean_unicode,
@@ -76,17 +97,53 @@ def clean_importer_settings(settings):
         'metadata_provider_args': _clean_unicode,
         'metadata_provider_class': _clean_provider_class,
     }
+    defaults = {
+        # Write and commit the records one by one in a single process.
+        'bulk_import': 'no',
+        'commit_batch_size': '1',
+        'dissemination_pool': 'thread',
+        'dissemination_workers': '1',
+    }
+    return _clean_settings(settings, cleaners, defaults)
+
+
+def clean_exporter_settings(settings):
+    """Parse and validate record exporter settings in a dictionary.
+
+    Check that the settings required by the record exporter are in the
+    settings dictionary and have valid values. Convert them to correct
+    types. Required settings are:
+        deleted_records
+        logging_config
+        sqlalchemy.url
+
+    Parameters
+    ----------
+    settings: dict from str to str
+        The settings dictionary.
+
+    Raises
+    ------
+    ConfigurationError:
+        If some setting is missing or has an invalid value.
+    """
+    cleaners = {
+        'deleted_records': _clean_deleted_records,
+        'logging_config': _clean_unicode,
+        'sqlalchemy.url': _clean_unicode,
+    }
     return _clean_settings(settings, cleaners)
 
 
-def _clean_settings(settings, cleaners):
+def _clean_settings(settings, cleaners, defaults={}):
     """Check that settings are ok.
 
     The parameter `cleaners` is a dict from setting names to functions.
     Each cleaner function is called with the value of the corresponding
     setting. The cleaners should raise an exception if the value is invalid
     and otherwise return a cleaned value. The old value gets replaced by
-    the cleaned value.
+    the cleaned value. A missing setting with a default value gets the
+    cleaned default value.
 
     Parameters
     ----------
@@ -94,6 +151,8 @@ def _clean_settings(settings, cleaners):
         The settings dictionary.
     cleaners: dict from str to callable
         Mapping from setting names to cleaner functions.
+    defaults: dict from str to str
+        Values of optional settings, cleaned like values in the settings.
 
     Raises
     ------
@@ -101,11 +160,15 @@ def _clean_settings(settings, cleaners):
         If any setting is missing or invalid.
     """
     for name, func in cleaners.iteritems():
-        if name not in settings:
+        if name in settings:
+            value = settings[name]
+        elif name in defaults:
+            value = defaults[name]
+        else:
             raise ConfigurationError('missing setting {0}'.format(name))
 
         try:
-            cleaned = func(settings[name])
+            cleaned = func(value)
             settings[name] = cleaned
         except Exception as error:
             raise ConfigurationError(
@@ -140,6 +203,16 @@ def _clean_deleted_records(value):
     return unicode(value)
 
 
+def _clean_pool_type(value):
+    """Check that value is either "thread" or "process"."""
+    allowed_values = ['thread', 'process']
+    if value not in allowed_values:
+        raise ValueError('pool type must be one of {0}'.format(
+            allowed_values
+        ))
+    return str(value)
+
+
 def _clean_boolean(value):
     """Return the value as a bool."""
     return asbool(value)
@@ -153,6 +226,22 @@ def _clean_item_list_limit(value):
     return int_value
 
 
+def _clean_positive_integer(value):
+    """Check that value is a positive integer."""
+    int_value = int(value)
+    if int_value <= 0:
+        raise ValueError('value must be positive')
+    return int_value
+
+
+def _clean_non_negative_integer(value):
+    """Check that value is a non-negative integer."""
+    int_value = int(value)
+    if int_value < 0:
+        raise ValueError('value must not be negative')
+    return int_value
+
+
 def _clean_unicode(value):
     """Return the value as a unicode."""
     if isinstance(value, str):
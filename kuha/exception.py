@@ -8,6 +8,10 @@ class HarvestError(Exception):
     """Error while updating formats, items, sets or records."""
 
 
+class ExportError(Exception):
+    """Error while exporting records."""
+
+
 class OaiException(Exception):
     """Base class for exceptions representing an OAI-PMH error."""
 
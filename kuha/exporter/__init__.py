@@ -0,0 +1,119 @@
+import argparse
+import datetime
+import logging
+import sys
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..config import clean_exporter_settings
+from ..exception import ExportError
+from ..models import create_engine, rollback
+from ..util import parse_date
+from .export import export_records
+
+
+def parse_args(argv):
+    """Parse the command line arguments of the exporter.
+
+    Parameters
+    ----------
+    argv: list of str
+        The command line, including the name of the program.
+
+    Return
+    ------
+    argparse.Namespace:
+        The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        usage='%(prog)s [options] config_uri prefix directory '
+              '[var=value]...',
+        description='Export records from the Kuha database to '
+                    'gzip-compressed OAI-PMH ListRecords responses.',
+        epilog='See the sample configuration file for details.',
+    )
+    parser.add_argument('config_uri', help='the configuration file')
+    parser.add_argument('prefix', type=_unicode,
+                        help='metadata prefix of the records')
+    parser.add_argument('directory', help='directory to write the files to')
+    parser.add_argument('--set', dest='set_', type=_unicode,
+                        help='export only the records in the set')
+    parser.add_argument('--from', dest='from_date',
+                        type=lambda text: _date(text,
+                                                datetime.time(0, 0, 0)),
+                        help='minimum datestamp, YYYY-MM-DD or '
+                             'YYYY-MM-DDThh:mm:ssZ')
+    parser.add_argument('--until', dest='until_date',
+                        type=lambda text: _date(text,
+                                                datetime.time(23, 59, 59)),
+                        help='maximum datestamp, YYYY-MM-DD or '
+                             'YYYY-MM-DDThh:mm:ssZ')
+    parser.add_argument('--records-per-file', type=_positive_integer,
+                        default=10000,
+                        help='maximum number of records in a file '
+                             '(default: %(default)s)')
+    parser.add_argument('--base-url', type=_unicode, default=u'',
+                        help='base URL of the repository, written to the '
+                             'request element of the files')
+    # Settings overriding the configuration file may be given after the
+    # options like for the importer.
+    args, extra = parser.parse_known_args(argv[1:])
+    for var in extra:
+        if '=' not in var:
+            parser.error('unrecognized argument: {0}'.format(var))
+    args.vars = extra
+    return args
+
+
+def _unicode(text):
+    return text.decode('utf-8')
+
+
+def _date(text, default_time):
+    try:
+        return parse_date(text, default_time)[0]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid datestamp: {0}'.format(text))
+
+
+def _positive_integer(text):
+    value = int(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('value must be positive')
+    return value
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    options = parse_vars(args.vars)
+
+    settings = get_appsettings(args.config_uri, options=options)
+    clean_exporter_settings(settings)
+
+    setup_logging(settings['logging_config'])
+    log = logging.getLogger(__name__)
+
+    log.info('Starting record export...')
+    create_engine(settings)
+    try:
+        export_records(
+            args.directory,
+            args.prefix,
+            from_date=args.from_date,
+            until_date=args.until_date,
+            set_=args.set_,
+            ignore_deleted=settings['deleted_records'] == 'no',
+            records_per_file=args.records_per_file,
+            base_url=args.base_url,
+        )
+    except ExportError as error:
+        log.critical('Failed to export records: {0}'.format(error))
+        raise
+    finally:
+        # Nothing is written to the database.
+        rollback()
+
+    log.info('Done.')
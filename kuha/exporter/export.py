@@ -0,0 +1,198 @@
+import gzip
+import logging
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+from .. import models
+from ..exception import ExportError
+from ..serialization import serialize_records
+from ..util import chunks, datestamp_now, format_datestamp
+
+# Number of records read from the database at a time.
+_BATCH_SIZE = 500
+
+# Compression level of the written files. The highest levels are several
+# times slower but make the files only slightly smaller.
+_COMPRESS_LEVEL = 6
+
+_HEAD = u'''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/
+         http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">
+<responseDate>{0}</responseDate>
+<request{1}>{2}</request>
+<ListRecords>
+'''
+
+_TAIL = u'''</ListRecords>
+</OAI-PMH>
+'''
+
+
+def export_records(directory,
+                   prefix,
+                   from_date=None,
+                   until_date=None,
+                   set_=None,
+                   ignore_deleted=False,
+                   records_per_file=10000,
+                   base_url=u''):
+    """Write records to gzip-compressed OAI-PMH XML files.
+
+    The records are read with a streaming cursor and written to numbered
+    files named after the metadata prefix, e.g. ``oai_dc-00000.xml.gz``.
+    Each file is a complete ListRecords response without a resumption
+    token. A file is written under a temporary name and renamed when it
+    is complete.
+
+    Parameters
+    ----------
+    directory: str
+        The directory to write the files to.
+    prefix: unicode
+        Prefix of the metadata format of the records.
+    from_date: datetime.datetime or None
+        Minimum datestamp of the records.
+    until_date: datetime.datetime or None
+        Maximum datestamp of the records.
+    set_: unicode or None
+        Set spec of the records.
+    ignore_deleted: bool
+        If `True`, leave deleted records out.
+    records_per_file: int
+        Maximum number of records in a file.
+    base_url: unicode
+        Base URL of the repository, written to the ``request`` element.
+
+    Return
+    ------
+    list of str:
+        Paths of the written files.
+
+    Raises
+    ------
+    ExportError:
+        If the metadata format does not exist or writing a file fails.
+    """
+    log = logging.getLogger(__name__)
+    if records_per_file <= 0:
+        raise ValueError('records_per_file must be positive')
+    if not models.Format.exists(prefix, ignore_deleted):
+        raise ExportError(
+            'unsupported metadata format: {0}'.format(prefix))
+
+    attributes = [(u'verb', u'ListRecords'), (u'metadataPrefix', prefix)]
+    if from_date is not None:
+        attributes.append((u'from', format_datestamp(from_date)))
+    if until_date is not None:
+        attributes.append((u'until', format_datestamp(until_date)))
+    if set_ is not None:
+        attributes.append((u'set', set_))
+    head = _HEAD.format(
+        format_datestamp(datestamp_now()),
+        u''.join(u' {0}={1}'.format(name, quoteattr(value))
+                 for name, value in attributes),
+        escape(base_url),
+    ).encode('utf-8')
+
+    records = models.Record.iter(
+        metadata_prefix=prefix,
+        from_date=from_date,
+        until_date=until_date,
+        set_=set_,
+        ignore_deleted=ignore_deleted,
+        defer_xml=True,
+        batch_size=_BATCH_SIZE,
+        # Only the identifiers are read, see serialize_records.
+        load_sets=False,
+    )
+    paths = []
+    file_ = None
+    try:
+        for batch in chunks(records, _BATCH_SIZE):
+            fragments = list(serialize_records(
+                prefix, [record.identifier for record in batch],
+                _BATCH_SIZE))
+            while fragments:
+                if file_ is not None and file_.records == records_per_file:
+                    paths.append(file_.complete())
+                    file_ = None
+                if file_ is None:
+                    path = os.path.join(directory, '{0}-{1:05d}.xml.gz'
+                                                   ''.format(prefix,
+                                                             len(paths)))
+                    file_ = _ResponseFile(path, head)
+                count = min(len(fragments),
+                            records_per_file - file_.records)
+                file_.write(fragments[:count])
+                del fragments[:count]
+        if file_ is not None:
+            paths.append(file_.complete())
+            file_ = None
+    except (IOError, OSError) as error:
+        raise ExportError('failed to write records: {0}'.format(error))
+    finally:
+        if file_ is not None:
+            file_.discard()
+
+    if not paths:
+        log.warning('No records to export.')
+    return paths
+
+
+class _ResponseFile(object):
+    """A compressed ListRecords response being written.
+
+    The data is written to a temporary file, which is renamed when the
+    response is complete.
+
+    Parameters
+    ----------
+    path: str
+        Path of the complete file.
+    head: str
+        The beginning of the response up to the first record.
+    """
+
+    def __init__(self, path, head):
+        self.path = path
+        self.records = 0
+        self._file = open(path + '.tmp', 'wb')
+        self._gzip = gzip.GzipFile(os.path.basename(path), 'wb',
+                                   _COMPRESS_LEVEL, self._file)
+        self._gzip.write(head)
+
+    def write(self, fragments):
+        """Write serialized records.
+
+        Parameters
+        ----------
+        fragments: list of unicode
+            The ``record`` elements.
+        """
+        self._gzip.write(u''.join(fragments).encode('utf-8'))
+        self.records += len(fragments)
+
+    def complete(self):
+        """End the response and give the file its final name.
+
+        Return
+        ------
+        str:
+            Path of the file.
+        """
+        self._gzip.write(_TAIL.encode('utf-8'))
+        self._gzip.close()
+        self._file.close()
+        os.rename(self._file.name, self.path)
+        logging.getLogger(__name__).info(
+            'Wrote {0} records to {1}'.format(self.records, self.path))
+        return self.path
+
+    def discard(self):
+        """Remove an incomplete file."""
+        self._gzip.close()
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.remove(self._file.name)
@@ -82,6 +82,10 @@ def main(argv=sys.argv):
 
     purge = settings['deleted_records'] == 'no'
     dry_run = settings['dry_run']
+    bulk = settings['bulk_import']
+    commit_batch_size = settings['commit_batch_size']
+    workers = settings['dissemination_workers']
+    pool_type = settings['dissemination_pool']
 
     if dry_run:
         log.info('Starting metadata import (dry run)...')
@@ -118,7 +122,8 @@ def main(argv=sys.argv):
 
     log.debug('Harvesting metadata...')
     try:
-        update(metadata_provider, old_timestamp, purge, dry_run)
+        update(metadata_provider, old_timestamp, purge, dry_run, bulk,
+               commit_batch_size, workers, pool_type)
     except HarvestError as error:
         log.critical(
             'Failed to harvest metadata: {0}'
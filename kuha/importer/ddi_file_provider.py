@@ -1,6 +1,8 @@
 import os
 import logging
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import stat
 
 from lxml import etree
 
@@ -12,7 +14,8 @@ class DdiFileProvider(object):
     DDI Codebook to OAI DC.
     """
 
-    def __init__(self, domain_name='example.org', directory='.'):
+    def __init__(self, domain_name='example.org', directory='.',
+                 scan_workers=1):
         """
         Initialize the metadata provider.
 
@@ -22,9 +25,15 @@ class DdiFileProvider(object):
             Path of the directory to scan for DDI files.
         domain_name: str
             The domain name part of the OAI identifiers.
+        scan_workers: int or str
+            Number of subdirectories of `directory` to scan concurrently.
         """
         self.oai_identifier_prefix = 'oai:{0}:'.format(domain_name)
         self.directory = directory
+        self.scan_workers = int(scan_workers)
+        # Modification times of the files found by the last scan by
+        # identifier.
+        self._mtimes = {}
 
     def formats(self):
         """
@@ -51,19 +60,22 @@ class DdiFileProvider(object):
         iterable of str:
             OAI identifiers of all items
         """
-        logging.debug('Scanning directory {0} for XML files...'
-                      ''.format(self.directory))
-        # List all xml files and turn the filenames into identifiers.
+        log = logging.getLogger(__name__)
+        log.debug('Scanning directory {0} for XML files...'
+                  ''.format(self.directory))
+        # List all xml files and turn the filenames into identifiers. The
+        # modification times are taken from the stat results of the scan
+        # for has_changed().
+        self._mtimes = {}
         file_count = 0
-        for subdir, _, files in os.walk(self.directory):
-            for filename in files:
-                if filename.lower().endswith('.xml'):
-                    path = os.path.join(subdir, filename)
-                    yield self.make_identifier(path)
-                    file_count += 1
+        for path, mtime in _scan(self.directory, self.scan_workers):
+            identifier = self.make_identifier(path)
+            self._mtimes[identifier] = mtime
+            yield identifier
+            file_count += 1
         if file_count == 0:
-            logging.warning('No XML files found in {0}'
-                            ''.format(self.directory))
+            log.warning('No XML files found in {0}'
+                        ''.format(self.directory))
 
     def has_changed(self, identifier, since):
         """
@@ -82,11 +94,11 @@ class DdiFileProvider(object):
             `True`, if metadata or sets of the item have change since the
             given time. Otherwise `False`.
         """
-        filename = self.get_filename(identifier)
-        path = os.path.join(self.directory, filename)
-        mtime = os.path.getmtime(path)
-        ctime = os.path.getctime(path)
-        datestamp = datetime.utcfromtimestamp(max(mtime, ctime))
+        mtime = self._mtimes.get(identifier)
+        if mtime is None:
+            filename = self.get_filename(identifier)
+            mtime = _mtime(os.stat(os.path.join(self.directory, filename)))
+        datestamp = datetime.utcfromtimestamp(mtime)
         return datestamp >= since
 
     def get_sets(self, identifier):
@@ -122,10 +134,10 @@ class DdiFileProvider(object):
 
         Return
         ------
-        str or NoneType:
-            An XML fragment containing the metadata of the item in the
-            given format. If the format is not available for the item
-            return `None`.
+        lxml.etree._Element or NoneType:
+            The root element of the metadata of the item in the given
+            format. If the format is not available for the item return
+            `None`.
 
         Raises
         ------
@@ -139,7 +151,9 @@ class DdiFileProvider(object):
         path = os.path.join(self.directory, filename)
         with open(path, 'r') as file_:
             xmltree = etree.parse(file_)
-        return etree.tostring(convert_to_dc(xmltree))
+        # Return the tree, so that the importer does not need to parse
+        # the serialized record again.
+        return convert_to_dc(xmltree)
 
     def make_identifier(self, filename):
         """
@@ -158,64 +172,156 @@ class DdiFileProvider(object):
         return identifier[len(self.oai_identifier_prefix):] + '.xml'
 
 
+def _mtime(st):
+    """Return the time of the last change of a file from its stat result."""
+    return max(st.st_mtime, st.st_ctime)
+
+
+def _scan(directory, workers=1):
+    """List the XML files under a directory.
+
+    Like `os.walk`, the directory is listed top-down and symbolic links to
+    directories are not followed, but each entry is stat'ed only once and
+    the stat result is kept. The subdirectories of `directory` are scanned
+    in a pool of `workers` threads.
+
+    Return
+    ------
+    iterable of (str, float):
+        (path, modification time) pairs of the files.
+    """
+    files, subdirs = _list_directory(directory)
+    for item in files:
+        yield item
+    if workers > 1 and len(subdirs) > 1:
+        pool = ThreadPool(min(workers, len(subdirs)))
+        try:
+            # The results come back in the order of the subdirectories.
+            for shard in pool.imap(_scan_all, subdirs):
+                for item in shard:
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for subdir in subdirs:
+            for item in _scan(subdir):
+                yield item
+
+
+def _scan_all(directory):
+    return list(_scan(directory))
+
+
+def _list_directory(directory):
+    """Return the (path, modification time) pairs of the XML files and the
+    paths of the subdirectories in a directory."""
+    files = []
+    subdirs = []
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        # os.walk ignores unreadable directories as well.
+        logging.getLogger(__name__).warning(
+            'Cannot list {0}: {1}'.format(directory, e))
+        return files, subdirs
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                is_link = True
+                st = os.stat(path)
+            else:
+                is_link = False
+        except OSError:
+            # A broken link or a file removed during the scan.
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not is_link:
+                subdirs.append(path)
+        elif name.lower().endswith('.xml'):
+            files.append((path, _mtime(st)))
+    return files, subdirs
+
+
+# Namespaces.
+_NSMAP = {
+    'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+}
+
+# Mapping from DDI Version 2 to Dublin Core
+# (http://www.ddialliance.org/resources/tools/dc).
+_MAPPING = {
+    'title': ['stdyDscr/citation/titlStmt/titl'],
+    'creator': ['stdyDscr/citation/rspStmt/AuthEnty'],
+    'subject': [
+        'stdyDscr/stdyInfo/subject/keyword',
+        'stdyDscr/stdyInfo/subject/topcClas',
+    ],
+    'description': ['stdyDscr/stdyInfo/abstract/p'],
+    'publisher': ['stdyDscr/citation/prodStmt/producer'],
+    'contributor': ['stdyDscr/citation/rspStmt/othId/p'],
+    'date': ['stdyDscr/citation/prodStmt/prodDate'],
+    'type': ['stdyDscr/stdyInfo/sumDscr/dataKind'],
+    'format': ['fileDscr/fileTxt/fileType'],
+    'identifier': ['stdyDscr/citation/titlStmt/IDNo'],
+    'source': ['stdyDscr/method/dataColl/sources/dataSrc'],
+    'language': [],
+    'relation': [
+        'stdyDscr/othrStdyMat/relMat',
+        'stdyDscr/othrStdyMat/relStdy',
+        'stdyDscr/othrStdyMat/relPubl',
+    ],
+    'coverage': [
+        'stdyDscr/stdyInfo/sumDscr/timePrd',
+        'stdyDscr/stdyInfo/sumDscr/collDate',
+        'stdyDscr/stdyInfo/sumDscr/nation',
+        'stdyDscr/stdyInfo/sumDscr/geogCover',
+    ],
+    'rights': ['stdyDscr/citation/prodStmt/copyright'],
+}
+
+# (DC element name, compiled DDI path) pairs in the order of the output.
+_COMPILED_MAPPING = [
+    ('{{{dc}}}{name}'.format(name=dc_tag, **_NSMAP), etree.XPath(ddi_path))
+    for dc_tag, ddi_paths in _MAPPING.iteritems()
+    for ddi_path in ddi_paths
+]
+
+_DC_TAG = '{{{oai_dc}}}dc'.format(**_NSMAP)
+_SCHEMA_LOCATION_ATTRIBUTE = '{{{xsi}}}schemaLocation'.format(**_NSMAP)
+
+
 def convert_to_dc(record):
-    # Namespaces.
-    nsmap = {
-        'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
-        'dc': 'http://purl.org/dc/elements/1.1/',
-        'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-    }
-
-    # Mapping from DDI Version 2 to Dublin Core
-    # (http://www.ddialliance.org/resources/tools/dc).
-    mapping = {
-        'title': ['stdyDscr/citation/titlStmt/titl'],
-        'creator': ['stdyDscr/citation/rspStmt/AuthEnty'],
-        'subject': [
-            'stdyDscr/stdyInfo/subject/keyword',
-            'stdyDscr/stdyInfo/subject/topcClas',
-        ],
-        'description': ['stdyDscr/stdyInfo/abstract/p'],
-        'publisher': ['stdyDscr/citation/prodStmt/producer'],
-        'contributor': ['stdyDscr/citation/rspStmt/othId/p'],
-        'date': ['stdyDscr/citation/prodStmt/prodDate'],
-        'type': ['stdyDscr/stdyInfo/sumDscr/dataKind'],
-        'format': ['fileDscr/fileTxt/fileType'],
-        'identifier': ['stdyDscr/citation/titlStmt/IDNo'],
-        'source': ['stdyDscr/method/dataColl/sources/dataSrc'],
-        'language': [],
-        'relation': [
-            'stdyDscr/othrStdyMat/relMat',
-            'stdyDscr/othrStdyMat/relStdy',
-            'stdyDscr/othrStdyMat/relPubl',
-        ],
-        'coverage': [
-            'stdyDscr/stdyInfo/sumDscr/timePrd',
-            'stdyDscr/stdyInfo/sumDscr/collDate',
-            'stdyDscr/stdyInfo/sumDscr/nation',
-            'stdyDscr/stdyInfo/sumDscr/geogCover',
-        ],
-        'rights': ['stdyDscr/citation/prodStmt/copyright'],
-    }
-
-    root = etree.Element('{{{oai_dc}}}dc'.format(**nsmap), nsmap=nsmap)
-    root.set('{{{xsi}}}schemaLocation'.format(**nsmap),
+    """Convert a DDI Codebook document to OAI DC.
+
+    Parameters
+    ----------
+    record: lxml.etree._ElementTree or lxml.etree._Element
+        The DDI document or its root element.
+
+    Return
+    ------
+    lxml.etree._Element:
+        The root element of the OAI DC document.
+    """
+    if hasattr(record, 'getroot'):
+        record = record.getroot()
+
+    root = etree.Element(_DC_TAG, nsmap=_NSMAP)
+    root.set(_SCHEMA_LOCATION_ATTRIBUTE,
         ('http://www.openarchives.org/OAI/2.0/oai_dc/ '
          'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
     )
 
-    def add_field(name, text):
-        """Add a field to the DC XML tree."""
-        if text is not None and len(text) > 0 and not text.isspace():
-            element = root.makeelement(
-                '{{{dc}}}{name}'.format(name=name, **nsmap)
-            )
-            element.text = text
-            root.append(element)
-
-    for dc_tag, ddi_paths in mapping.iteritems():
-        for ddi_path in ddi_paths:
-            for element in record.findall(ddi_path):
-                add_field(dc_tag, element.text)
+    for dc_tag, ddi_path in _COMPILED_MAPPING:
+        for element in ddi_path(record):
+            text = element.text
+            # Add a field to the DC XML tree.
+            if text is not None and len(text) > 0 and not text.isspace():
+                etree.SubElement(root, dc_tag).text = text
 
     return root
@@ -1,9 +1,26 @@
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import traceback
+
+from lxml import etree
 
 from .. import models
 from ..exception import HarvestError
-
-def update(provider, since=None, purge=False, dry_run=False):
+from ..serialization import render_record
+
+# Number of items submitted at a time per dissemination worker.
+_TASKS_PER_WORKER = 16
+
+def update(provider,
+           since=None,
+           purge=False,
+           dry_run=False,
+           bulk=False,
+           commit_batch_size=1,
+           workers=1,
+           pool_type='thread'):
     """Update metadata formats, items, records and sets.
 
     Parameters
@@ -27,11 +44,23 @@ def update(provider, since=None, purge=False, dry_run=False):
                 iterable of (set spec, set name) tuples.
 
             get_record(identifier: unicode, prefix: unicode):
-                    unicode or None
+                    unicode, lxml element, (unicode, bool) or None
                 Disseminate the metadata of the specified item in the
-                specified format. Return an XML fragment. If the item
-                cannot be disseminated in the specified format, return
-                None.
+                specified format. Return an XML fragment, or the root
+                element of the metadata, which is then serialized without
+                being parsed again. A (fragment, True) tuple marks a
+                fragment known to be well-formed, of which only the
+                root element is checked. If the item cannot be
+                disseminated in the specified format, return None.
+
+        and optionally the following method:
+
+            records_committed(identifiers: list of unicode)
+                Called after the records of the items with the given
+                identifiers have been committed to the database. Not
+                called in dry runs or for items which failed. Always
+                called in the harvesting process, even if the items are
+                disseminated in a process pool.
 
     since: datetime.datetime or None
         Time of the last update in UTC, or `None`.
@@ -41,6 +70,18 @@ def update(provider, since=None, purge=False, dry_run=False):
     dry_run: bool
         If `True`, fetch records as usual but do not actually change the
         database.
+    bulk: bool
+        If `True`, write records in batches with `models.RecordWriter`
+        instead of one by one.
+    commit_batch_size: int
+        Number of records to write in a single transaction.
+    workers: int
+        Number of items to disseminate concurrently. The database is
+        still written by a single writer in the order of the items.
+    pool_type: str
+        Either ``'thread'`` or ``'process'``. Whether the items are
+        disseminated in a thread pool or in a process pool. A process pool
+        requires a provider that can be used in forked processes.
 
     Raises
     ------
@@ -50,7 +91,9 @@ def update(provider, since=None, purge=False, dry_run=False):
     """
     prefixes = update_formats(provider, purge, dry_run)
     identifiers = update_items(provider, purge, dry_run)
-    update_records(provider, identifiers, prefixes, since, dry_run)
+    update_records(provider, identifiers, prefixes, since, dry_run, bulk,
+                   commit_batch_size, workers, pool_type)
+    update_fragments(dry_run, commit_batch_size)
 
 
 def update_formats(provider, purge=False, dry_run=False):
@@ -83,7 +126,7 @@ def update_formats(provider, purge=False, dry_run=False):
                 added += 1
 
         if purge and not dry_run:
-            models.purge_deleted()
+            models.purge_deleted(commit_chunks=True)
     except Exception as e:
         models.rollback()
         log.exception('Failed to update metadata formats: {0}'.format(e))
@@ -112,30 +155,23 @@ def update_items(provider, purge=False, dry_run=False):
 
     try:
         new_identifiers = frozenset(map(unicode, provider.identifiers()))
+        old_identifiers = models.Item.list_identifiers(ignore_deleted=True)
 
-        old_items = dict(
-            (item.identifier, item)
-            for item in models.Item.list(ignore_deleted=True)
-        )
-
-        removed = 0
-        for identifier, item in old_items.iteritems():
-            if identifier not in new_identifiers:
-                if not dry_run:
-                    item.mark_as_deleted()
-                log.debug('deleted {0}'.format(identifier))
-                removed += 1
+        removed = old_identifiers - new_identifiers
+        for identifier in removed:
+            log.debug('deleted {0}'.format(identifier))
+        # Added items may also be deleted ones which have reappeared.
+        added = new_identifiers - old_identifiers
+        for identifier in added:
+            log.debug('added {0}'.format(identifier))
 
-        added = 0
-        for identifier in new_identifiers:
-            if not dry_run:
-                models.Item.create_or_update(identifier)
-            if identifier not in old_items:
-                log.debug('added {0}'.format(identifier))
-                added += 1
+        if not dry_run:
+            if removed:
+                models.Item.mark_as_deleted_except(new_identifiers)
+            models.Item.create_or_update_all(added)
 
         if purge and not dry_run:
-            models.purge_deleted()
+            models.purge_deleted(commit_chunks=True)
     except Exception as e:
         models.rollback()
         log.exception('Failed to update items: {0}'.format(e))
@@ -148,41 +184,59 @@ def update_items(provider, purge=False, dry_run=False):
         log.info(
             'Removed {0} item{1} and added {2} item{3}.'
             ''.format(
-                removed, '' if removed == 1 else 's',
-                added,   '' if added   == 1 else 's',
+                len(removed), '' if len(removed) == 1 else 's',
+                len(added),   '' if len(added)   == 1 else 's',
             )
         )
 
         return new_identifiers
 
 
-def update_sets(provider, identifier, dry_run=False):
+def update_sets(provider, identifier, dry_run=False, writer=None):
+    """Update the set memberships of an item.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider.
+    identifier: unicode
+        The OAI identifier of the item.
+    dry_run: bool
+        If `True`, fetch the sets but do not change the database.
+    writer: models.SetWriter or None
+        The writer to buffer the changes in. The caller must flush it.
+        If `None`, a writer is created and flushed for this item only.
+    """
     log = logging.getLogger(__name__)
     log.debug('Updating sets...')
 
-    # Remove the item from old sets.
-    item = None
-    if not dry_run:
-        item = models.Item.get(identifier)
-        item.clear_sets()
-
     sets = provider.get_sets(identifier)
-    if len(sets) == 0:
-        return
     # Sort set specs by level.
     sets.sort(key=lambda (spec, _): spec.count(u':'))
     # TODO: make sure that sets contain the parent sets of all sets
-    for spec, name in sets:
-        if not dry_run:
-            set_ = models.Set.create_or_update(spec, name)
-            item.add_to_set(set_)
+    if dry_run:
+        return
+
+    flush = writer is None
+    if flush:
+        writer = models.SetWriter()
+    if writer.write(identifier, sets):
+        # The set specs are part of the serialized records.
+        models.Record.invalidate_fragments(
+            models.Record.identifier == identifier)
+    if flush:
+        writer.flush()
 
 
 def update_records(provider,
                    identifiers,
                    prefixes,
                    since=None,
-                   dry_run=False):
+                   dry_run=False,
+                   bulk=False,
+                   commit_batch_size=1,
+                   workers=1,
+                   pool_type='thread'):
     log = logging.getLogger(__name__)
     if since is not None:
         log.info('Updating records modified since {0} UTC...'
@@ -190,48 +244,116 @@ def update_records(provider,
     else:
         log.info('Updating all records...')
 
+    # In bulk mode the records are buffered and written in batches.
+    writer = None
+    if bulk and not dry_run:
+        writer = models.RecordWriter()
+    # The set memberships of all items are diffed against one snapshot
+    # and written with the records.
+    set_writer = None
+    if not dry_run:
+        set_writer = models.SetWriter()
+
     updated = 0
-    for identifier in identifiers:
-        try:
-            if (since is not None and
-                    not provider.has_changed(identifier, since)):
-                log.debug('Skipping item "{0}"'.format(identifier))
-                continue
-            log.debug('Updating item "{0}"'.format(identifier))
+    # Number of records processed since the last commit.
+    uncommitted = 0
+    # Items processed successfully since the last commit.
+    processed = []
+
+    def commit():
+        committed = _commit_records(writer, dry_run, set_writer)
+        if committed and processed:
+            _notify_committed(provider, processed)
+        del processed[:]
+        return committed
+
+    # The records are disseminated concurrently if there are many
+    # workers, but they are written here one by one in order.
+    results = _disseminate_all(
+        provider, identifiers, prefixes, since, workers, pool_type)
+    for identifier, records, error in results:
+        if error is not None:
+            log.error(
+                'Failed to update item "{0}": {1}'
+                ''.format(identifier, error))
+            continue
+        if records is None:
+            log.debug('Skipping item "{0}"'.format(identifier))
+            continue
+        log.debug('Updating item "{0}"'.format(identifier))
 
-            update_sets(provider, identifier, dry_run)
+        savepoint = _begin_savepoint(dry_run)
+        snapshot = None
+        if set_writer is not None:
+            snapshot = set_writer.snapshot(identifier)
+        try:
+            update_sets(provider, identifier, dry_run, set_writer)
+            _end_savepoint(savepoint)
         except Exception as e:
+            _end_savepoint(savepoint, failed=True)
+            # The changes buffered in the writer are rolled back as well.
+            if snapshot is not None:
+                set_writer.restore(snapshot)
             log.exception(
                 'Failed to update item "{0}": {1}'
                 ''.format(identifier, e))
             continue
 
-        for prefix in prefixes:
+        failed = False
+        for prefix, xml, error in records:
+            if error is not None:
+                failed = True
+                log.error(
+                    'Failed to disseminate format "{0}" '
+                    'for item "{1}": {2}'
+                    ''.format(prefix, identifier, error))
+                continue
+
+            savepoint = _begin_savepoint(dry_run or writer is not None)
             try:
-                xml = provider.get_record(identifier, prefix)
                 if xml is None:
-                    if not dry_run:
+                    if writer is not None:
+                        writer.mark_as_deleted(identifier, prefix)
+                    elif not dry_run:
                         models.Record.mark_as_deleted(identifier, prefix)
                 else:
-                    if not dry_run:
+                    if writer is not None:
+                        writer.write(identifier, prefix, xml)
+                    elif not dry_run:
                         models.Record.create_or_update(
                             identifier, prefix, xml
                         )
                     updated += 1
+                _end_savepoint(savepoint)
             except Exception as e:
-                models.rollback()
+                # Roll back only the failed record. The writer validates
+                # a record before buffering it, so there is nothing to
+                # roll back in bulk mode.
+                _end_savepoint(savepoint, failed=True)
+                failed = True
                 log.exception(
                     'Failed to disseminate format "{0}" '
                     'for item "{1}": {2}'
                     ''.format(prefix, identifier, e))
             else:
-                # Commit after each record so that the (esp. SQLite)
-                # database does not get locked for a long time.
-                if dry_run:
-                    models.rollback()
-                else:
-                    models.commit()
                 log.debug('Processed item "{0}"'.format(identifier))
+                uncommitted += 1
+                # Commit in batches so that the (esp. SQLite) database
+                # does not get locked for a long time.
+                if uncommitted >= commit_batch_size:
+                    if not commit():
+                        # The records of the item written so far were
+                        # not committed.
+                        failed = True
+                    uncommitted = 0
+        if not failed:
+            processed.append(identifier)
+
+    if uncommitted > 0 or (set_writer is not None and len(set_writer) > 0):
+        commit()
+    elif processed and not dry_run:
+        # The records of the items were committed with the last batch.
+        _notify_committed(provider, processed)
 
     # End the transaction in case no records were updated.
     models.rollback()
@@ -239,3 +361,248 @@ def update_records(provider,
     # TODO: log number of added records
     log.info('Updated {0} record{1}.'
              ''.format(updated, '' if updated == 1 else 's'))
+
+
+def update_fragments(dry_run=False, batch_size=100):
+    """Serialize the records which have changed since they were last
+    serialized.
+
+    The views send the serialized records instead of rendering them. A
+    failure is logged but not raised, since the views can render the
+    records themselves. A record which fails to serialize is skipped.
+
+    Parameters
+    ----------
+    dry_run: bool
+        If `True`, do nothing.
+    batch_size: int
+        Number of records to serialize in a single transaction.
+    """
+    log = logging.getLogger(__name__)
+    if dry_run:
+        return
+    log.debug('Serializing records...')
+
+    serialized = 0
+    failed = 0
+    last = None
+    try:
+        while True:
+            records = models.Record.list_unserialized(batch_size, last)
+            if not records:
+                break
+            last = (records[-1].identifier, records[-1].prefix)
+            fragments = []
+            for record in records:
+                try:
+                    fragments.append((record, render_record(record)))
+                except Exception as e:
+                    failed += 1
+                    log.exception('Failed to serialize record "{0}" in '
+                                  'format "{1}": {2}'
+                                  ''.format(record.identifier,
+                                            record.prefix, e))
+            models.Record.store_fragments(fragments)
+            models.commit()
+            serialized += len(fragments)
+    except Exception as e:
+        models.rollback()
+        log.exception('Failed to serialize records: {0}'.format(e))
+
+    log.info('Serialized {0} record{1}.'
+             ''.format(serialized, '' if serialized == 1 else 's'))
+    if failed > 0:
+        log.warning('Failed to serialize {0} record{1}.'
+                    ''.format(failed, '' if failed == 1 else 's'))
+
+
+def disseminate(provider, identifier, prefixes, since=None):
+    """Fetch the records of an item from the provider.
+
+    Exceptions raised by the provider are caught and returned as
+    formatted error messages, so that the function can be run in a worker
+    process.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider.
+    identifier: unicode
+        The OAI identifier of the item.
+    prefixes: iterable of unicode
+        The metadata prefixes of the records to fetch.
+    since: datetime.datetime or None
+        Fetch the records only if the item has changed since this time.
+
+    Return
+    ------
+    unicode:
+        The identifier.
+    list of (unicode, str or None, unicode or None) or None:
+        (metadata prefix, XML fragment, error message) tuples for each
+        prefix, or None if the item has not changed.
+    unicode or None:
+        An error message, if checking the item failed.
+    """
+    try:
+        if since is not None and not provider.has_changed(identifier, since):
+            return identifier, None, None
+    except Exception as e:
+        return identifier, None, _format_error(e)
+
+    records = []
+    for prefix in prefixes:
+        try:
+            records.append((
+                prefix,
+                _serialize_metadata(provider.get_record(identifier, prefix)),
+                None,
+            ))
+        except Exception as e:
+            records.append((prefix, None, _format_error(e)))
+    return identifier, records, None
+
+
+def _serialize_metadata(metadata):
+    """Turn metadata returned by the provider into XML data.
+
+    Elements are serialized and fragments marked as well-formed are
+    wrapped in `models.CheckedXml`, so that they are not parsed again when
+    the records are written.
+    """
+    if etree.iselement(metadata):
+        return models.CheckedXml(etree.tostring(metadata, encoding=unicode))
+    if isinstance(metadata, tuple):
+        xml, checked = metadata
+        if checked and isinstance(xml, unicode):
+            return models.CheckedXml(xml)
+        # Byte strings may declare any encoding, so they are checked as
+        # usual.
+        return xml
+    return metadata
+
+
+def _format_error(error):
+    """Format an exception and the traceback being handled."""
+    return '{0}\n{1}'.format(error, traceback.format_exc().rstrip())
+
+
+def _disseminate_all(provider,
+                     identifiers,
+                     prefixes,
+                     since=None,
+                     workers=1,
+                     pool_type='thread'):
+    """Fetch the records of many items, in parallel if possible.
+
+    Yield the results of `disseminate` in the order of the identifiers.
+    If `workers` is greater than one, the items are disseminated in a pool
+    of `workers` threads or processes, depending on `pool_type`.
+    """
+    if workers <= 1:
+        for identifier in identifiers:
+            yield disseminate(provider, identifier, prefixes, since)
+        return
+
+    if pool_type == 'process':
+        pool = multiprocessing.Pool(workers, _init_worker, (provider,))
+    else:
+        pool = ThreadPool(workers, _init_worker, (provider,))
+    # At most this many items are submitted but not yet consumed, so that
+    # the results waiting to be written do not pile up in memory. The
+    # pool is kept busy as long as there are items left.
+    slots = threading.Semaphore(workers * _TASKS_PER_WORKER)
+    stopped = threading.Event()
+
+    def tasks():
+        # Run in the task handler thread of the pool.
+        for identifier in identifiers:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield identifier, prefixes, since
+
+    try:
+        for result in pool.imap(_disseminate_in_worker, tasks()):
+            yield result
+            slots.release()
+    finally:
+        # Let the task handler finish, so that the pool can be joined.
+        stopped.set()
+        slots.release()
+        pool.terminate()
+        pool.join()
+
+
+# The metadata provider of a dissemination worker.
+_worker_provider = None
+
+
+def _init_worker(provider):
+    global _worker_provider
+    _worker_provider = provider
+
+
+def _disseminate_in_worker(task):
+    identifier, prefixes, since = task
+    return disseminate(_worker_provider, identifier, prefixes, since)
+
+
+def _begin_savepoint(skip):
+    """Start a nested transaction unless `skip` is `True`."""
+    if skip:
+        return None
+    return models.savepoint()
+
+
+def _end_savepoint(savepoint, failed=False):
+    """Commit or roll back a nested transaction if there is one."""
+    if savepoint is None:
+        return
+    if failed:
+        savepoint.rollback()
+    else:
+        savepoint.commit()
+
+
+def _commit_records(writer, dry_run, set_writer=None):
+    """End the transaction of a batch of records.
+
+    Write the records and set memberships buffered in the writers, if
+    there are any, and commit. Return `True` if the records were
+    committed.
+    """
+    log = logging.getLogger(__name__)
+    if dry_run:
+        models.rollback()
+        return False
+    try:
+        if set_writer is not None:
+            written = set_writer.flush()
+            log.debug('Wrote set memberships of {0} items.'.format(written))
+        if writer is not None:
+            written = writer.flush()
+            log.debug('Wrote {0} records.'.format(written))
+    except Exception as e:
+        models.rollback()
+        for w in [set_writer, writer]:
+            if w is not None:
+                w.discard()
+        log.exception('Failed to write records: {0}'.format(e))
+        return False
+    models.commit()
+    return True
+
+
+def _notify_committed(provider, identifiers):
+    """Pass the identifiers of committed items to the provider, if it
+    wants them."""
+    records_committed = getattr(provider, 'records_committed', None)
+    if records_committed is None:
+        return
+    try:
+        records_committed(list(identifiers))
+    except Exception as e:
+        logging.getLogger(__name__).exception(
+            'Failed to notify the provider of committed records: {0}'
+            ''.format(e))
@@ -92,10 +92,14 @@ class SkeletonProvider(object):
 
         Return
         ------
-        str or NoneType:
+        str, lxml.etree._Element, (unicode, bool) or NoneType:
             An XML fragment containing the metadata of the item in the
             given format. If the format is not available for the item
-            return `None`.
+            return `None`. A provider which builds the metadata as an
+            lxml tree can return its root element instead, and a provider
+            which knows that a unicode fragment is well-formed can return
+            it in a (fragment, True) tuple. Only the root element of such
+            metadata is checked when the record is written.
 
         Raises
         ------
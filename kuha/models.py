@@ -1,14 +1,31 @@
+from collections import defaultdict
+import hashlib
 import logging
 import re
+import time
 
 from lxml import etree
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.ext.declarative import declarative_base
 import transaction
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
-from .util import datestamp_now
+from .util import chunks, datestamp_now
+
+# Maximum number of values bound to a single IN clause. SQLite does not
+# allow more than 999 variables in a statement.
+_IN_CLAUSE_SIZE = 500
+
+# Number of rows read or written at a time by bulk operations.
+_BULK_SIZE = 10000
+
+# Number of records whose XML is held in memory at a time when streaming.
+_STREAM_CHUNK_SIZE = 20
+
+# Number of bytes fed to the parser at a time when reading the root
+# element of XML data.
+_ROOT_CHUNK_SIZE = 1024
 
 _Base = declarative_base()
 DBSession = orm.scoped_session(orm.sessionmaker(
@@ -29,9 +46,41 @@ class _CreateMixin(object):
 def create_engine(settings):
     """Connect to the database."""
     engine = sa.engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name == 'sqlite':
+        _enable_sqlite_savepoints(engine)
     DBSession.configure(bind=engine)
     _Base.metadata.bind = engine
     _Base.metadata.create_all(engine)
+    _create_missing_indexes(engine)
+
+
+def _create_missing_indexes(engine):
+    """Add indexes to tables created before the indexes were defined."""
+    inspector = sa.inspect(engine)
+    for table in _Base.metadata.sorted_tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.getLogger(__name__).info(
+                    'Creating index {0}'.format(index.name))
+                index.create(engine)
+
+
+def _enable_sqlite_savepoints(engine):
+    """Make SAVEPOINT work with the pysqlite driver.
+
+    By default pysqlite begins transactions lazily and commits them
+    before a SAVEPOINT statement. Disable that and emit BEGIN ourselves.
+    """
+
+    @sa.event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sa.event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
 
 
 def ensure_oai_dc_exists():
@@ -43,15 +92,89 @@ def ensure_oai_dc_exists():
         commit()
 
 
-def purge_deleted():
-    """Remove items, records and formats marked as deleted."""
-    purged = 0
-    for Class in [Record, Format, Item]:
-        purged += (DBSession.query(Class)
-                            .filter(Class.deleted.is_(True))
-                            .delete(synchronize_session='fetch'))
+def purge_deleted(chunk_size=_IN_CLAUSE_SIZE, commit_chunks=False):
+    """Remove items, records and formats marked as deleted.
+
+    The rows are deleted in chunks of items without loading them into
+    the session. The serialized records and the set memberships of the
+    purged records and items are removed with them. Progress is logged
+    after each chunk.
+
+    Parameters
+    ----------
+    chunk_size: int
+        Maximum number of items whose rows are deleted at a time.
+    commit_chunks: bool
+        If `True`, commit the transaction after each chunk, so that the
+        database is not locked for the whole purge.
+
+    Return
+    ------
+    int:
+        The number of purged records, formats and items.
+    """
+    log = logging.getLogger(__name__)
+    # Nothing in the session may refer to the purged rows.
+    DBSession.flush()
+
+    def purge(name, Class, key, delete_chunk):
+        """Delete deleted rows of `Class` by chunks of `key` values."""
+        total = (DBSession.query(sa.func.count())
+                          .select_from(Class)
+                          .filter(Class.deleted.is_(True))
+                          .scalar())
+        purged = 0
+        while purged < total:
+            keys = [k for (k,) in DBSession.query(key)
+                                           .filter(Class.deleted.is_(True))
+                                           .distinct()
+                                           .limit(chunk_size)]
+            if not keys:
+                break
+            deleted = delete_chunk(keys)
+            if deleted == 0:
+                break
+            purged += deleted
+            Datestamp.update()
+            mark_changed(DBSession())
+            if commit_chunks:
+                commit()
+            log.info('Purged {0} of {1} deleted {2}.'
+                     ''.format(purged, total, name))
+        return purged
+
+    def delete_records(identifiers):
+        deleted = [Record.deleted.is_(True),
+                   Record.identifier.in_(identifiers)]
+        Record.invalidate_fragments(*deleted)
+        return DBSession.execute(
+            Record.__table__.delete().where(sa.and_(*deleted))).rowcount
+
+    def delete_formats(prefixes):
+        return DBSession.execute(
+            Format.__table__.delete()
+                  .where(Format.deleted.is_(True))
+                  .where(Format.prefix.in_(prefixes))
+        ).rowcount
+
+    def delete_items(identifiers):
+        DBSession.execute(
+            item_set_association.delete()
+                .where(item_set_association.c.item_identifier
+                                            .in_(identifiers)))
+        return DBSession.execute(
+            Item.__table__.delete()
+                .where(Item.deleted.is_(True))
+                .where(Item.identifier.in_(identifiers))
+        ).rowcount
+
+    purged = (purge('records', Record, Record.identifier, delete_records) +
+              purge('formats', Format, Format.prefix, delete_formats) +
+              purge('items', Item, Item.identifier, delete_items))
     if purged > 0:
-        Datestamp.update()
+        # The purged objects in the session are gone.
+        DBSession.expire_all()
+    return purged
 
 
 def commit():
@@ -64,6 +187,18 @@ def rollback():
     transaction.abort()
 
 
+def savepoint():
+    """Start a nested transaction within the ongoing transaction.
+
+    Return
+    ------
+    sqlalchemy.orm.SessionTransaction:
+        The nested transaction. Call its ``commit`` or ``rollback``
+        method to end it.
+    """
+    return DBSession.begin_nested()
+
+
 item_set_association = sa.Table(
     'item_set_association',
     _Base.metadata,
@@ -77,6 +212,11 @@ item_set_association = sa.Table(
         sa.String,
         sa.ForeignKey('items.identifier')
     ),
+    # For listing the items of a set and the sets of an item.
+    sa.Index('ix_item_set_association_set_item',
+             'set_spec', 'item_identifier'),
+    sa.Index('ix_item_set_association_item_set',
+             'item_identifier', 'set_spec'),
 )
 
 
@@ -91,15 +231,29 @@ class Set(_Base, _CreateMixin):
         "^([A-Za-z0-9\-_\.!~\*'\(\)])+(:[A-Za-z0-9\-_\.!~\*'\(\)]+)*$")
 
     def __init__(self, spec, name):
-        if self._spec_pattern.match(spec) is None:
-            raise ValueError('invalid set spec: {0}'.format(spec))
+        self.check_spec(spec)
         # TODO: check that all parent sets exist
         self.spec = spec
         self.name = name
 
+    @classmethod
+    def check_spec(cls, spec):
+        """Raise ValueError if the set spec is not valid."""
+        if cls._spec_pattern.match(spec) is None:
+            raise ValueError('invalid set spec: {0}'.format(spec))
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        # Override create() to update the database datestamp.
+        obj = super(Set, cls).create(*args, **kwargs)
+        Datestamp.update()
+        return obj
+
     def update(self, name):
         """Change the name of this set."""
-        self.name = name
+        if self.name != name:
+            self.name = name
+            Datestamp.update()
 
     @classmethod
     def create_or_update(cls, spec, name):
@@ -115,7 +269,7 @@ class Set(_Base, _CreateMixin):
         except orm.exc.NoResultFound:
             return cls.create(spec, name)
         else:
-            set_.name = name
+            set_.update(name)
             return set_
 
     @classmethod
@@ -134,6 +288,9 @@ class Format(_Base, _CreateMixin):
     # Function to find characters that are not URL unreserved.
     _invalid_characters = re.compile(r'[^a-zA-Z0-9\-_.!~*\'()]').search
 
+    # (database datestamp, {prefix: deleted}) tuple of the format registry.
+    _cached_registry = None
+
     def __init__(self, prefix, namespace, schema):
         if self._invalid_characters(prefix) is not None:
             raise ValueError('invalid metadata prefix: %s' % prefix)
@@ -144,7 +301,7 @@ class Format(_Base, _CreateMixin):
         self.deleted = False
 
     @classmethod
-    def exists(cls, prefix, ignore_deleted=False):
+    def exists(cls, prefix, ignore_deleted=False, cached=False):
         """Check wheter a metadata format is supported.
 
         Parameters
@@ -153,6 +310,11 @@ class Format(_Base, _CreateMixin):
             A metadata prefix.
         ignore_deleted: bool
             If `True`, consider deleted formats as not existing.
+        cached: bool
+            If `True`, look the format up in an in-memory registry of all
+            formats. The registry is reloaded when the cached database
+            datestamp (see `Datestamp.get_cached`) changes, so changes to
+            formats without records may be seen late.
 
         Return
         ------
@@ -160,14 +322,26 @@ class Format(_Base, _CreateMixin):
             ``True`` if the metadata format is supported, ``False``
             otherwise.
         """
-        query = DBSession.query(cls).filter_by(prefix=prefix)
+        if cached:
+            deleted = cls._registry().get(prefix)
+            return deleted is not None and not (ignore_deleted and deleted)
+
+        query = (DBSession.query(sa.literal(1))
+                          .filter(cls.prefix == prefix))
         if ignore_deleted:
             query = query.filter(cls.deleted.is_(False))
-        try:
-            query.one()
-            return True
-        except orm.exc.NoResultFound:
-            return False
+        return query.limit(1).first() is not None
+
+    @classmethod
+    def _registry(cls):
+        """Return a dict mapping all prefixes to their deletion flags."""
+        version = Datestamp.get_cached()
+        registry = cls._cached_registry
+        if registry is None or registry[0] != version:
+            formats = dict(DBSession.query(cls.prefix, cls.deleted).all())
+            registry = (version, formats)
+            cls._cached_registry = registry
+        return registry[1]
 
     @classmethod
     def list(cls, identifier=None, ignore_deleted=False):
@@ -201,6 +375,13 @@ class Format(_Base, _CreateMixin):
             query = query.filter(cls.deleted.is_(False))
         return query.all()
 
+    @classmethod
+    def create(cls, *args, **kwargs):
+        # Override create() to update the database datestamp.
+        obj = super(Format, cls).create(*args, **kwargs)
+        Datestamp.update()
+        return obj
+
     def update(self, namespace, schema):
         """Change the namespace and schema of this format."""
         if self.namespace != namespace or self.schema != schema:
@@ -208,6 +389,9 @@ class Format(_Base, _CreateMixin):
             # associated records might no longer be valid. Mark
             # them as deleted.
             self.mark_as_deleted()
+        if self.deleted:
+            # The format changed or is listed again.
+            Datestamp.update()
 
         self.namespace = namespace
         self.schema = schema
@@ -242,6 +426,8 @@ class Format(_Base, _CreateMixin):
     def mark_as_deleted(self):
         """Mark this format and associated records as deleted."""
         Record.mark_as_deleted(prefix=self.prefix)
+        if not self.deleted:
+            Datestamp.update()
         self.deleted = True
 
 
@@ -301,14 +487,11 @@ class Item(_Base, _CreateMixin):
             ``True`` if an item with the identifier exists, ``False``
             otherwise.
         """
-        query = DBSession.query(cls).filter_by(identifier=identifier)
+        query = (DBSession.query(sa.literal(1))
+                          .filter(cls.identifier == identifier))
         if ignore_deleted:
             query = query.filter(cls.deleted.is_(False))
-        try:
-            query.one()
-            return True
-        except orm.exc.NoResultFound:
-            return False
+        return query.limit(1).first() is not None
 
     @classmethod
     def list(cls, ignore_deleted=False):
@@ -334,6 +517,144 @@ class Item(_Base, _CreateMixin):
         Record.mark_as_deleted(identifier=self.identifier)
         self.deleted = True
 
+    @classmethod
+    def list_identifiers(cls, ignore_deleted=False):
+        """Return the identifiers of all existing items.
+
+        Only the identifier column is read, so this is much cheaper than
+        `list` for large repositories.
+
+        Parameters
+        ----------
+        ignore_deleted: bool
+            If `True`, exclude deleted items from the result.
+
+        Return
+        ------
+        set of unicode:
+            The identifiers.
+        """
+        query = DBSession.query(cls.identifier)
+        if ignore_deleted:
+            query = query.filter(cls.deleted.is_(False))
+        return set(identifier for (identifier,)
+                   in query.yield_per(_BULK_SIZE))
+
+    @classmethod
+    def create_or_update_all(cls, identifiers):
+        """Add items or undelete existing ones in bulk.
+
+        Unlike `create_or_update`, this makes a few statements per
+        hundreds of identifiers instead of one per identifier.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifiers of the items.
+        """
+        DBSession.flush()
+        changed = False
+        for chunk in chunks(identifiers, _IN_CLAUSE_SIZE):
+            existing = set(
+                identifier for (identifier,)
+                in DBSession.query(cls.identifier)
+                            .filter(cls.identifier.in_(chunk))
+            )
+            if existing:
+                DBSession.execute(
+                    cls.__table__.update()
+                       .where(cls.identifier.in_(existing))
+                       .where(cls.deleted.is_(True))
+                       .values(deleted=False)
+                )
+            missing = [{'identifier': identifier, 'deleted': False}
+                       for identifier in chunk
+                       if identifier not in existing]
+            if missing:
+                DBSession.execute(cls.__table__.insert(), missing)
+            changed = True
+        if changed:
+            # The items in the session may be out of date.
+            DBSession.expire_all()
+            mark_changed(DBSession())
+
+    @classmethod
+    def mark_as_deleted_except(cls, identifiers):
+        """Mark all items but the given ones and their records as deleted.
+
+        The identifiers to keep are written to a temporary table, and the
+        items and records are then updated with one statement each, no
+        matter how many of them are deleted.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifiers of the items to keep.
+
+        Return
+        ------
+        int:
+            The number of items marked as deleted.
+        """
+        DBSession.flush()
+        connection = DBSession.connection()
+        live = sa.Table(
+            'live_identifiers',
+            sa.MetaData(),
+            sa.Column('identifier', sa.String, primary_key=True),
+            prefixes=['TEMPORARY'],
+        )
+        # The table is dropped only on success. On failure it is
+        # discarded when the transaction is rolled back, whereas dropping
+        # it in an aborted PostgreSQL transaction would fail and hide the
+        # original error.
+        live.create(connection)
+        for chunk in chunks(identifiers, _BULK_SIZE):
+            connection.execute(
+                live.insert(),
+                [{'identifier': identifier} for identifier in chunk]
+            )
+        removed = ~cls.identifier.in_(sa.select([live.c.identifier]))
+        removed_records = ~Record.identifier.in_(
+            sa.select([live.c.identifier]))
+
+        Record.invalidate_fragments(Record.deleted.is_(False),
+                                    removed_records)
+        records = connection.execute(
+            Record.__table__.update()
+                  .where(Record.deleted.is_(False))
+                  .where(removed_records)
+                  .values(deleted=True, datestamp=datestamp_now())
+        ).rowcount
+        items = connection.execute(
+            cls.__table__.update()
+               .where(cls.deleted.is_(False))
+               .where(removed)
+               .values(deleted=True)
+        ).rowcount
+
+        live.drop(connection)
+
+        if records > 0:
+            Datestamp.update()
+        if items > 0 or records > 0:
+            # The items and records in the session may be out of date.
+            DBSession.expire_all()
+            mark_changed(DBSession())
+        return items
+
+
+# Serialized <record> elements of the records, see `Record.fragment`.
+record_fragments = sa.Table(
+    'record_fragments',
+    _Base.metadata,
+    sa.Column('identifier', sa.String, primary_key=True),
+    sa.Column('prefix', sa.String, primary_key=True),
+    sa.Column('fragment', sa.Text, nullable=False),
+    sa.ForeignKeyConstraint(['identifier', 'prefix'],
+                            ['records.identifier', 'records.prefix']),
+)
+
 
 class Record(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI record."""
@@ -352,6 +673,16 @@ class Record(_Base, _CreateMixin):
     xml = sa.Column(sa.Text)
     deleted = sa.Column(sa.Boolean, nullable=False)
 
+    __table_args__ = (
+        # For listing records of a format in the order of identifiers
+        # starting from a resumption token offset.
+        sa.Index('ix_records_prefix_identifier', 'prefix', 'identifier'),
+        sa.Index('ix_records_prefix_deleted_identifier',
+                 'prefix', 'deleted', 'identifier'),
+        # For selective harvesting by date.
+        sa.Index('ix_records_prefix_datestamp', 'prefix', 'datestamp'),
+    )
+
     def __init__(self, identifier, prefix, xml, datestamp=None):
         try:
             format_ = (DBSession.query(Format)
@@ -381,7 +712,7 @@ class Record(_Base, _CreateMixin):
         self.deleted = False
 
         if self.xml is not None:
-            self._check_xml(self.xml, format_)
+            self._check_xml(self.xml, format_.namespace, format_.schema)
 
     @classmethod
     def earliest_datestamp(cls, ignore_deleted=False):
@@ -419,7 +750,8 @@ class Record(_Base, _CreateMixin):
              set_=None,
              ignore_deleted=False,
              offset=None,
-             limit=None):
+             limit=None,
+             defer_xml=False):
         """Return records that fulfill the conditions.
 
         Parameters
@@ -440,6 +772,9 @@ class Record(_Base, _CreateMixin):
             Minimum allowed identifier.
         limit: int or None
             Maxmimum number of results.
+        defer_xml: bool
+            If `True`, do not load the XML data of the records. Use
+            `iter_fragments` to read it later.
 
         Return
         ------
@@ -447,7 +782,62 @@ class Record(_Base, _CreateMixin):
             The matching records. If no records match, an empty list is
             returned.
         """
+        return cls._query(identifier, metadata_prefix, from_date,
+                          until_date, set_, ignore_deleted, offset, limit,
+                          defer_xml).all()
+
+    @classmethod
+    def iter(cls,
+             identifier=None,
+             metadata_prefix=None,
+             from_date=None,
+             until_date=None,
+             set_=None,
+             ignore_deleted=False,
+             offset=None,
+             limit=None,
+             defer_xml=False,
+             batch_size=_IN_CLAUSE_SIZE,
+             load_sets=True):
+        """Iterate over records that fulfill the conditions.
+
+        Like `list`, but the result is read from a streaming cursor
+        `batch_size` records at a time, so any number of records can be
+        walked with bounded memory. The set specs of each batch are
+        loaded with `load_set_specs` unless `load_sets` is false. The
+        records should not be kept after they have been processed.
+
+        Parameters
+        ----------
+        batch_size: int
+            Number of records fetched from the database at a time.
+        load_sets: bool
+            If `False`, the set specs are not loaded in advance. Callers
+            which do not read `set_specs` can skip the extra query.
+
+        See `list` for the other parameters.
+
+        Return
+        ------
+        iterator of Record:
+            The matching records ordered by identifier.
+        """
+        query = cls._query(identifier, metadata_prefix, from_date,
+                           until_date, set_, ignore_deleted, offset, limit,
+                           defer_xml)
+        for batch in chunks(query.yield_per(batch_size), batch_size):
+            if load_sets:
+                cls.load_set_specs(batch)
+            for record in batch:
+                yield record
+
+    @classmethod
+    def _query(cls, identifier, metadata_prefix, from_date, until_date,
+               set_, ignore_deleted, offset, limit, defer_xml):
+        """Build the query of `list` and `iter`."""
         query = DBSession.query(cls)
+        if defer_xml:
+            query = query.options(orm.defer(cls.xml))
 
         if identifier is not None:
             query = query.filter_by(identifier=identifier)
@@ -471,8 +861,167 @@ class Record(_Base, _CreateMixin):
             if limit < 0:
                 raise ValueError('negative limit: %d' % limit)
             query = query.limit(limit)
+        return query
 
-        return query.all()
+    @classmethod
+    def iter_fragments(cls, prefix, identifiers, chunk_size=None):
+        """Read the serialized records a few records at a time.
+
+        The data is read with a session of its own, so the generator can
+        be consumed after the ongoing transaction has ended, e.g. while a
+        response is sent to the client. Each chunk is read in a
+        transaction of its own, which ends before the records of the
+        chunk are returned, so that the database is not kept locked while
+        the records are consumed.
+
+        The records may change after the caller has read them. A fragment
+        is always consistent with itself, but a record without a fragment
+        must be serialized from its current state, so the header fields
+        of such records are read together with the XML data.
+
+        Parameters
+        ----------
+        prefix: unicode
+            Prefix of the metadata format.
+        identifiers: iterable of unicode
+            Identifiers of the items.
+        chunk_size: int or None
+            Number of records read at a time. By default only a few
+            records are held in memory.
+
+        Return
+        ------
+        iterator of (unicode, unicode or None, tuple or None):
+            The identifier, the fragment and the current state of each
+            record in the order of `identifiers`. The state is a tuple of
+            the datestamp, the deleted flag, the set specs and the XML
+            data, and it is read only if the record has no fragment. Both
+            the fragment and the state are ``None`` if the record does not
+            exist anymore.
+        """
+        session = orm.Session(bind=DBSession.bind)
+        if chunk_size is None:
+            chunk_size = _STREAM_CHUNK_SIZE
+        try:
+            for chunk in chunks(identifiers, chunk_size):
+                try:
+                    fragments = dict(session.execute(
+                        sa.select([record_fragments.c.identifier,
+                                   record_fragments.c.fragment])
+                          .where(record_fragments.c.prefix == prefix)
+                          .where(record_fragments.c.identifier.in_(chunk))
+                    ).fetchall())
+                    missing = [i for i in chunk if i not in fragments]
+                    states = {}
+                    if missing:
+                        memberships = (
+                            session.query(
+                                item_set_association.c.item_identifier,
+                                item_set_association.c.set_spec)
+                                   .filter(item_set_association
+                                           .c.item_identifier.in_(missing))
+                        )
+                        specs = defaultdict(list)
+                        for identifier, spec in memberships:
+                            specs[identifier].append(spec)
+                        rows = (session.query(cls.identifier,
+                                              cls.datestamp,
+                                              cls.deleted,
+                                              cls.xml)
+                                       .filter(cls.prefix == prefix)
+                                       .filter(cls.identifier.in_(missing)))
+                        for identifier, datestamp, deleted, xml in rows:
+                            states[identifier] = (
+                                datestamp, deleted,
+                                _leaf_set_specs(specs[identifier]), xml)
+                finally:
+                    # End the transaction and return the connection to
+                    # the pool before the chunk is consumed.
+                    session.close()
+                for identifier in chunk:
+                    yield (identifier,
+                           fragments.get(identifier),
+                           states.get(identifier))
+        finally:
+            session.close()
+
+    @classmethod
+    def list_unserialized(cls, limit, after=None):
+        """Return records which do not have a fragment.
+
+        The set specs of the returned records are loaded with
+        `load_set_specs`. The results are paged by passing the identifier
+        and prefix of the last record of a page as `after`, so that the
+        records which could not be serialized are not read again.
+
+        Parameters
+        ----------
+        limit: int
+            Maxmimum number of results.
+        after: tuple of unicode or None
+            Return only the records after this identifier and prefix.
+
+        Return
+        ------
+        list of Record:
+            The records ordered by identifier and prefix.
+        """
+        serialized = (sa.exists()
+                        .where(record_fragments.c.identifier ==
+                               cls.identifier)
+                        .where(record_fragments.c.prefix == cls.prefix))
+        query = DBSession.query(cls).filter(~serialized)
+        if after is not None:
+            identifier, prefix = after
+            query = query.filter(sa.or_(
+                cls.identifier > identifier,
+                sa.and_(cls.identifier == identifier, cls.prefix > prefix),
+            ))
+        records = (query.order_by(cls.identifier, cls.prefix)
+                        .limit(limit)
+                        .all())
+        cls.load_set_specs(records)
+        return records
+
+    @classmethod
+    def store_fragments(cls, fragments):
+        """Store serialized records.
+
+        Parameters
+        ----------
+        fragments: list of (Record, unicode)
+            The records and their serialized ``record`` elements.
+        """
+        if not fragments:
+            return
+        DBSession.execute(record_fragments.insert(), [
+            {'identifier': record.identifier,
+             'prefix': record.prefix,
+             'fragment': fragment}
+            for record, fragment in fragments
+        ])
+        mark_changed(DBSession())
+
+    @classmethod
+    def invalidate_fragments(cls, *criteria):
+        """Remove the fragments of the records matching the criteria.
+
+        Must be called whenever a record or the set memberships of its
+        item change.
+
+        Parameters
+        ----------
+        criteria: SQL expressions
+            Conditions on the columns of the records. Without criteria
+            all fragments are removed.
+        """
+        matching = (sa.exists()
+                      .where(cls.identifier == record_fragments.c.identifier)
+                      .where(cls.prefix == record_fragments.c.prefix))
+        for criterion in criteria:
+            matching = matching.where(criterion)
+        DBSession.execute(record_fragments.delete().where(matching))
+        mark_changed(DBSession())
 
     @classmethod
     def create(cls, *args, **kwargs):
@@ -488,44 +1037,57 @@ class Record(_Base, _CreateMixin):
             format_ = (DBSession.query(Format)
                                 .filter_by(prefix=self.prefix)
                                 .one())
-            self._check_xml(xml, format_)
+            self._check_xml(xml, format_.namespace, format_.schema)
 
             self.xml = xml
             self.deleted = False
             self.datestamp = datestamp_now()
             Datestamp.update()
+            Record.invalidate_fragments(Record.identifier == self.identifier,
+                                        Record.prefix == self.prefix)
 
     @property
     def set_specs(self):
         """Return a list of specs for sets which contain this record.
 
         Sets which are parent sets of sets that contain the record are
-        excluded from the result.
+        excluded from the result. If the specs have been fetched with
+        `load_set_specs`, no database query is made.
         """
-        result = []
+        specs = getattr(self, '_set_specs', None)
+        if specs is not None:
+            return specs
         # Fetch all set specs.
         specs = (DBSession.query(Set.spec).join(Item.sets)
                           .filter(Item.identifier==self.identifier)
                           .all())
-        specs = [s for (s,) in specs]
-        # Sort to descending order by level.
-        specs.sort(key=lambda x: -x.count(':'))
-        # A set containing the specs of sets whose subsets have already
-        # been processed.
-        processed = set()
-        for spec in specs:
-            if spec not in processed:
-                result.append(spec)
-                # Mark all parent sets of the set as processed.
-                i = 0
-                try:
-                    while True:
-                        i = spec.index(':', i)
-                        processed.add(spec[:i])
-                        i += 1
-                except ValueError:
-                    pass
-        return result
+        return _leaf_set_specs([s for (s,) in specs])
+
+    @classmethod
+    def load_set_specs(cls, records):
+        """Fetch set specs of many records at once.
+
+        The set memberships of all the records are fetched with a single
+        query, and the `set_specs` property of each record returns the
+        fetched specs instead of querying the database again.
+
+        Parameters
+        ----------
+        records: list of Record
+            The records whose set specs to fetch.
+        """
+        identifiers = set(record.identifier for record in records)
+        specs = defaultdict(list)
+        for chunk in chunks(sorted(identifiers), _IN_CLAUSE_SIZE):
+            rows = (DBSession.query(item_set_association.c.item_identifier,
+                                    item_set_association.c.set_spec)
+                             .filter(item_set_association.c.item_identifier
+                                     .in_(chunk))
+                             .all())
+            for identifier, spec in rows:
+                specs[identifier].append(spec)
+        for record in records:
+            record._set_specs = _leaf_set_specs(specs[record.identifier])
 
     @classmethod
     def create_or_update(cls, identifier, prefix, xml):
@@ -558,24 +1120,30 @@ class Record(_Base, _CreateMixin):
     @classmethod
     def mark_as_deleted(cls, identifier=None, prefix=None):
         """Mark records matching the identifier and prefix as deleted."""
-        query = DBSession.query(cls)
+        criteria = [cls.deleted.is_(False)]
         if identifier is not None:
-            query = query.filter_by(identifier=identifier)
+            criteria.append(cls.identifier == identifier)
         if prefix is not None:
-            query = query.filter_by(prefix=prefix)
-        query = query.filter(cls.deleted.is_(False))
-        updated = query.update(
+            criteria.append(cls.prefix == prefix)
+        cls.invalidate_fragments(*criteria)
+        updated = DBSession.query(cls).filter(*criteria).update(
             {'deleted': True, 'datestamp': datestamp_now()},
             synchronize_session='fetch'
         )
         if updated > 0:
             Datestamp.update()
 
-    def _check_xml(self, xml, format_):
-        # Check that the xml is well-formed.
-        tree = etree.fromstring(xml)
+    @staticmethod
+    def _check_xml(xml, namespace, schema):
+        if isinstance(xml, CheckedXml):
+            # The xml is known to be well-formed, so only the start tag
+            # of the root element needs to be read.
+            tree = _read_root(xml)
+        else:
+            # Check that the xml is well-formed.
+            tree = etree.fromstring(xml)
 
-        if etree.QName(tree.tag).namespace != format_.namespace:
+        if etree.QName(tree.tag).namespace != namespace:
             raise ValueError('wrong xml namespace')
 
         # Check that the xml has the correct schema location.
@@ -586,17 +1154,459 @@ class Record(_Base, _CreateMixin):
             raise ValueError('no schema location')
 
         for s in xml_schemas.split():
-            if s == format_.schema:
+            if s == schema:
                 break
         else:
             raise ValueError('wrong schema location')
 
 
+class CheckedXml(unicode):
+    """XML data which is known to be well-formed.
+
+    Metadata providers can mark the data they have serialized from a tree
+    with this type. Only the start tag of the root element of such data is
+    parsed when a record is created or updated.
+    """
+
+
+def _read_root(xml):
+    """Parse the start tag of the root element of XML data.
+
+    Return
+    ------
+    lxml.etree._Element:
+        The root element with its attributes but without children.
+
+    Raises
+    ------
+    lxml.etree.XMLSyntaxError:
+        If the start tag is not well-formed.
+    ValueError:
+        If there is no root element.
+    """
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    parser = etree.XMLPullParser(events=('start',))
+    for pos in xrange(0, len(xml), _ROOT_CHUNK_SIZE):
+        parser.feed(xml[pos:pos + _ROOT_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            return element
+    raise ValueError('no root element')
+
+
+# The serialized <record> element of the record, or None if the record
+# has not been serialized since it last changed.
+Record.fragment = orm.column_property(
+    sa.select([record_fragments.c.fragment])
+      .where(record_fragments.c.identifier == Record.identifier)
+      .where(record_fragments.c.prefix == Record.prefix)
+      .as_scalar(),
+    deferred=True,
+)
+
+
+class RecordWriter(object):
+    """Create, update and delete records in batches.
+
+    The keys of the existing items and records are loaded once when the
+    writer is created. Changes are buffered until `flush` writes them with
+    one executemany statement for the inserts and one for the updates.
+    Unlike `Record.create_or_update`, writing a record does not query the
+    database. The XML data of the existing records is not loaded up front;
+    `flush` reads it only for the updated records and leaves out the
+    records whose data has not changed.
+    """
+
+    def __init__(self):
+        self._formats = dict(
+            (prefix, (namespace, schema))
+            for prefix, namespace, schema
+            in DBSession.query(Format.prefix, Format.namespace, Format.schema)
+        )
+        self._items = frozenset(
+            identifier for (identifier,) in DBSession.query(Item.identifier)
+        )
+        # Mapping from (identifier, prefix) to (deleted, digest of xml).
+        # The digest is None until the writer knows the data.
+        self._records = {}
+        query = (DBSession.query(Record.identifier,
+                                 Record.prefix,
+                                 Record.deleted)
+                          .yield_per(_BULK_SIZE))
+        for identifier, prefix, deleted in query:
+            self._records[(identifier, prefix)] = (deleted, None)
+        # Buffered changes and the states they replace.
+        self._pending = {}
+        self._previous = {}
+
+    def __len__(self):
+        """Return the number of buffered changes."""
+        return len(self._pending)
+
+    def write(self, identifier, prefix, xml):
+        """Add a record or change the XML data of an existing one.
+
+        Raises
+        ------
+        ValueError:
+            If some value is not valid.
+        """
+        try:
+            namespace, schema = self._formats[prefix]
+        except KeyError:
+            raise ValueError(
+                'non-existent metadata prefix: "{0}"'
+                ''.format(prefix)
+            )
+        if identifier not in self._items:
+            raise ValueError(
+                'non-existent identifier: "{0}"'
+                ''.format(identifier)
+            )
+
+        key = (identifier, prefix)
+        digest = _digest(xml)
+        if self._records.get(key) == (False, digest):
+            # Nothing has changed since the data was last written.
+            return
+        Record._check_xml(xml, namespace, schema)
+
+        self._buffer(key, (False, digest), {
+            'identifier': identifier,
+            'prefix': prefix,
+            'xml': xml,
+            'deleted': False,
+            'datestamp': datestamp_now(),
+        })
+
+    def mark_as_deleted(self, identifier, prefix):
+        """Mark the record as deleted if it exists."""
+        key = (identifier, prefix)
+        state = self._records.get(key)
+        if state is None or state[0]:
+            return
+        self._buffer(key, (True, state[1]), {
+            'identifier': identifier,
+            'prefix': prefix,
+            'deleted': True,
+            'datestamp': datestamp_now(),
+        })
+
+    def flush(self):
+        """Write the buffered changes to the database.
+
+        Return
+        ------
+        int:
+            The number of inserted and updated records.
+        """
+        inserts = []
+        updates = []
+        unknown = []
+        for key, values in self._pending.iteritems():
+            previous = self._previous[key]
+            if previous is None:
+                inserts.append(values)
+            elif previous == (False, None) and 'xml' in values:
+                # The data may be the same as the stored data.
+                unknown.append(key)
+            else:
+                updates.append(values)
+        unchanged = self._unchanged(unknown)
+        updates.extend(self._pending[key] for key in unknown
+                       if key not in unchanged)
+        if inserts:
+            DBSession.bulk_insert_mappings(Record, inserts)
+        if updates:
+            DBSession.bulk_update_mappings(Record, updates)
+            _invalidate_fragments_of(
+                (values['identifier'], values['prefix'])
+                for values in updates
+            )
+        written = len(inserts) + len(updates)
+        if written > 0:
+            Datestamp.update()
+            mark_changed(DBSession())
+        self._pending = {}
+        self._previous = {}
+        return written
+
+    def _unchanged(self, keys):
+        """Return the keys of the records whose buffered XML data is the
+        same as the stored data."""
+        identifiers = defaultdict(list)
+        for identifier, prefix in keys:
+            identifiers[prefix].append(identifier)
+        unchanged = set()
+        for prefix, ids in identifiers.iteritems():
+            for chunk in chunks(ids, _IN_CLAUSE_SIZE):
+                stored = (DBSession.query(Record.identifier, Record.xml)
+                                   .filter(Record.prefix == prefix)
+                                   .filter(Record.identifier.in_(chunk)))
+                for identifier, xml in stored:
+                    key = (identifier, prefix)
+                    if _digest(xml) == self._records[key][1]:
+                        unchanged.add(key)
+        return unchanged
+
+    def discard(self):
+        """Forget the buffered changes."""
+        for key, state in self._previous.iteritems():
+            if state is None:
+                del self._records[key]
+            else:
+                self._records[key] = state
+        self._pending = {}
+        self._previous = {}
+
+    def _buffer(self, key, state, values):
+        if key in self._pending:
+            if self._previous[key] is None:
+                # Still an insert; the row does not exist yet.
+                values = dict(self._pending[key], **values)
+        else:
+            self._previous[key] = self._records.get(key)
+        self._pending[key] = values
+        self._records[key] = state
+
+
+class SetWriter(object):
+    """Update the set memberships of items in batches.
+
+    The sets and the memberships of all items are loaded once when the
+    writer is created. New memberships are diffed against them in memory,
+    and only the association rows which change are buffered until `flush`
+    writes them. Writing the sets of an item whose memberships have not
+    changed does not query the database.
+    """
+
+    def __init__(self):
+        self._names = dict(DBSession.query(Set.spec, Set.name))
+        memberships = defaultdict(set)
+        query = (DBSession.query(item_set_association.c.item_identifier,
+                                 item_set_association.c.set_spec)
+                          .yield_per(_BULK_SIZE))
+        for identifier, spec in query:
+            memberships[identifier].add(spec)
+        self._specs = dict((identifier, frozenset(specs))
+                           for identifier, specs in memberships.iteritems())
+        # The written specs of the items with buffered changes.
+        self._previous = {}
+        # The names of the sets changed since the last snapshot, or None
+        # for created sets.
+        self._old_names = {}
+
+    def __len__(self):
+        """Return the number of items with buffered changes."""
+        return len(self._previous)
+
+    def snapshot(self, identifier):
+        """Save the state of the writer before writing the sets of an item.
+
+        Must be called when the sets are written in a savepoint, so that
+        the writer can be restored if the savepoint is rolled back.
+
+        Parameters
+        ----------
+        identifier: unicode
+            OAI identifier of the item.
+
+        Return
+        ------
+        object:
+            The state to pass to `restore`.
+        """
+        self._old_names = {}
+        return (identifier,
+                identifier in self._previous,
+                self._previous.get(identifier),
+                self._specs.get(identifier))
+
+    def restore(self, snapshot):
+        """Forget the changes since a snapshot was taken.
+
+        Parameters
+        ----------
+        snapshot: object
+            The state returned by `snapshot`.
+        """
+        identifier, buffered, previous, specs = snapshot
+        if buffered:
+            self._previous[identifier] = previous
+        else:
+            self._previous.pop(identifier, None)
+        if specs is None:
+            self._specs.pop(identifier, None)
+        else:
+            self._specs[identifier] = specs
+        for spec, name in self._old_names.iteritems():
+            if name is None:
+                del self._names[spec]
+            else:
+                self._names[spec] = name
+        self._old_names = {}
+
+    def write(self, identifier, sets):
+        """Set the sets of an item.
+
+        Sets which do not exist are created and the names of existing
+        sets are updated.
+
+        Parameters
+        ----------
+        identifier: unicode
+            OAI identifier of the item.
+        sets: iterable of (unicode, unicode)
+            (set spec, set name) pairs of all sets of the item.
+
+        Return
+        ------
+        bool:
+            `True` if the item was added to or removed from some set.
+
+        Raises
+        ------
+        ValueError:
+            If some set spec is not valid.
+        """
+        sets = list(sets)
+        for spec, _ in sets:
+            Set.check_spec(spec)
+        for spec, name in sets:
+            old_name = self._names.get(spec)
+            if old_name is None:
+                Set.create(spec, name)
+            elif old_name != name:
+                DBSession.query(Set).get(spec).update(name)
+            else:
+                continue
+            self._old_names.setdefault(spec, old_name)
+            self._names[spec] = name
+
+        specs = frozenset(spec for spec, _ in sets)
+        old_specs = self._specs.get(identifier, frozenset())
+        if specs == old_specs:
+            return False
+        if identifier not in self._previous:
+            self._previous[identifier] = old_specs
+        self._specs[identifier] = specs
+        return True
+
+    def flush(self):
+        """Write the buffered membership changes to the database.
+
+        Return
+        ------
+        int:
+            The number of items whose memberships changed.
+        """
+        # Write the new sets first.
+        DBSession.flush()
+        inserts = []
+        deletes = []
+        for identifier, previous in self._previous.iteritems():
+            specs = self._specs[identifier]
+            inserts.extend({'item_identifier': identifier, 'set_spec': spec}
+                           for spec in specs - previous)
+            deletes.extend({'identifier': identifier, 'spec': spec}
+                           for spec in previous - specs)
+        if deletes:
+            DBSession.execute(
+                item_set_association.delete()
+                    .where(item_set_association.c.item_identifier ==
+                           sa.bindparam('identifier'))
+                    .where(item_set_association.c.set_spec ==
+                           sa.bindparam('spec')),
+                deletes
+            )
+        if inserts:
+            DBSession.execute(item_set_association.insert(), inserts)
+        written = len(self._previous)
+        if written > 0:
+            mark_changed(DBSession())
+        self._previous = {}
+        self._old_names = {}
+        return written
+
+    def discard(self):
+        """Forget the buffered changes."""
+        for identifier, previous in self._previous.iteritems():
+            self._specs[identifier] = previous
+        self._previous = {}
+        self._old_names = {}
+        # Sets created or renamed since the last flush are gone as well.
+        self._names = dict(DBSession.query(Set.spec, Set.name))
+
+
+def _invalidate_fragments_of(keys):
+    """Remove the fragments of records given as (identifier, prefix)."""
+    identifiers = defaultdict(list)
+    for identifier, prefix in keys:
+        identifiers[prefix].append(identifier)
+    for prefix, ids in identifiers.iteritems():
+        for chunk in chunks(ids, _IN_CLAUSE_SIZE):
+            Record.invalidate_fragments(Record.prefix == prefix,
+                                        Record.identifier.in_(chunk))
+
+
+def _digest(xml):
+    """Return a digest of an XML document for change detection."""
+    if xml is None:
+        return None
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return hashlib.sha1(xml).digest()
+
+
+def _leaf_set_specs(specs):
+    """Exclude the parent sets of other sets from a list of set specs.
+
+    Parameters
+    ----------
+    specs: list of unicode
+        Set specs.
+
+    Return
+    ------
+    list of unicode:
+        The specs which are not parent sets of other specs in the list,
+        in descending order by level.
+    """
+    result = []
+    # Sort to descending order by level.
+    specs = sorted(specs, key=lambda x: -x.count(':'))
+    # A set containing the specs of sets whose subsets have already
+    # been processed.
+    processed = set()
+    for spec in specs:
+        if spec not in processed:
+            result.append(spec)
+            # Mark all parent sets of the set as processed.
+            i = 0
+            try:
+                while True:
+                    i = spec.index(':', i)
+                    processed.add(spec[:i])
+                    i += 1
+            except ValueError:
+                pass
+    return result
+
+
 class Datestamp(_Base, _CreateMixin):
     """The SQLAlchemy model class for the datestamp of the database."""
     __tablename__ = 'datestamp'
     datestamp = sa.Column(sa.DateTime, primary_key=True)
 
+    # Number of seconds for which `get_cached` may return a previously
+    # fetched datestamp.
+    cache_ttl = 0
+    # (expiry time, datestamp) tuple of the cached datestamp.
+    _cache = None
+
+    # Key of the pending datestamp in the session info dictionary.
+    _PENDING = 'kuha.pending_datestamp'
+
     def __init__(self, datestamp):
         self.datestamp = datestamp
 
@@ -610,21 +1620,71 @@ class Datestamp(_Base, _CreateMixin):
             The datestamp of the latest database modification. If the
             database has never been modified, return None.
         """
+        pending = DBSession().info.get(cls._PENDING)
+        if pending is not None:
+            return pending
         result = DBSession.query(cls.datestamp).first()
         if result is not None:
             # The query returns a 1-tuple.
             return result[0]
         return None
 
+    @classmethod
+    def get_cached(cls):
+        """Fetch the database modification datestamp through a cache.
+
+        The datestamp is fetched from the database at most once in
+        `cache_ttl` seconds per process.
+
+        Return
+        ------
+        datetime.datetime or None:
+            The datestamp of the latest database modification, or None.
+        """
+        now = time.time()
+        cached = cls._cache
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        datestamp = cls.get()
+        cls._cache = (now + cls.cache_ttl, datestamp)
+        return datestamp
+
     @classmethod
     def update(cls):
-        """Set the database datestamp to the current time."""
+        """Set the database datestamp to the current time.
+
+        The datestamp is written when the ongoing transaction is
+        committed, so that it is written only once per transaction no
+        matter how many times it is updated.
+        """
+        DBSession().info[cls._PENDING] = datestamp_now()
+
+    @classmethod
+    def write(cls):
+        """Write a pending datestamp to the database."""
+        pending = DBSession().info.pop(cls._PENDING, None)
+        if pending is None:
+            return
         try:
             datestamp = DBSession.query(cls).one()
-            datestamp.datestamp = datestamp_now()
+            datestamp.datestamp = pending
         except orm.exc.NoResultFound:
-            DBSession.add(cls(datestamp_now()))
+            DBSession.add(cls(pending))
         except orm.exc.MultipleResultsFound:
             logging.getLogger(__name__).warning('Multiple datestamps')
             DBSession.query(cls).delete(synchronize_session='fetch')
-            DBSession.add(cls(datestamp_now()))
+            DBSession.add(cls(pending))
+
+
+@sa.event.listens_for(DBSession, 'before_commit')
+def _write_datestamp(session):
+    # Savepoints are committed as well; wait for the whole transaction.
+    if session.transaction.nested:
+        return
+    Datestamp.write()
+
+
+@sa.event.listens_for(DBSession, 'after_transaction_end')
+def _discard_datestamp(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(Datestamp._PENDING, None)
@@ -4,7 +4,7 @@ from pyramid.config import Configurator
 from pyramid.paster import setup_logging
 
 from ..config import clean_oai_settings
-from ..models import create_engine, ensure_oai_dc_exists
+from ..models import create_engine, ensure_oai_dc_exists, Datestamp
 
 def main(global_config, **app_config):
     """ This function returns a Pyramid WSGI application.
@@ -17,10 +17,13 @@ def main(global_config, **app_config):
     setup_logging(settings['logging_config'])
     create_engine(settings)
     ensure_oai_dc_exists()
+    Datestamp.cache_ttl = settings['datestamp_cache_ttl']
 
     config = Configurator(settings=settings)
     config.include('pyramid_tm')
     config.include('pyramid_chameleon')
+    config.add_renderer('listrecords',
+                        'kuha.oai.renderers.ListRecordsRenderer')
     config.add_route('oai', '/oai', request_method=('GET', 'POST'))
     config.add_static_view( name='static', path='./static' )
     config.scan()
@@ -0,0 +1,52 @@
+from pyramid.renderers import render
+
+from ..serialization import serialize_records
+
+
+# Placeholder for the records in the rendered envelope.
+_RECORDS_MARKER = u'<!-- records -->'
+
+
+class ListRecordsRenderer(object):
+    """Render a ListRecords response as a stream.
+
+    The envelope of the response is rendered with the ``listrecords.pt``
+    template. The records are read from the database while the response
+    is being sent, so only a few records are held in memory at a time
+    regardless of the size of the page. Records serialized by the
+    importer are sent as is and the rest are rendered with `render_record`.
+
+    The view should return the records with their XML data deferred, see
+    `Record.list`. The records are sent as they are when they are read,
+    see `serialize_records`.
+    """
+
+    envelope_template = 'kuha.oai:templates/listrecords.pt'
+
+    def __init__(self, info):
+        pass
+
+    def __call__(self, value, system):
+        request = system['request']
+        records = value['records']
+
+        # Copy the identifiers, since the records are not usable after
+        # the request transaction has ended.
+        identifiers = [record.identifier for record in records]
+        prefix = records[0].prefix if records else None
+
+        envelope = dict(value, records=[], records_marker=_RECORDS_MARKER)
+        head, tail = render(self.envelope_template, envelope,
+                            request).split(_RECORDS_MARKER)
+        return self._stream(head, tail, prefix, identifiers)
+
+    def _stream(self, head, tail, prefix, identifiers):
+        yield head.encode('utf-8')
+        serialized = serialize_records(prefix, identifiers)
+        try:
+            for fragment in serialized:
+                yield fragment.encode('utf-8')
+        finally:
+            # Release the database session if the client disconnects.
+            serialized.close()
+        yield tail.encode('utf-8')
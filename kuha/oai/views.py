@@ -1,7 +1,10 @@
+from collections import OrderedDict
 import datetime
 import json
 import functools
+import threading
 
+from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.renderers import get_renderer
 
@@ -51,6 +54,98 @@ def oai_view(wrapped):
     return wrapper
 
 
+class _ResponseCache(object):
+    """Rendered response bodies by request URL and parameters.
+
+    A body is stored split around the content of its ``responseDate``
+    element, which is filled in again for each response. The least
+    recently used responses are dropped when the cache is full. A
+    response is valid only as long as the repository datestamp does not
+    change.
+    """
+
+    _date_start = b'<responseDate>'
+    _date_end = b'</responseDate>'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, datestamp, time):
+        """Return the cached body with `time` as the response date or
+        ``None``."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != datestamp:
+                return None
+            # Mark as the most recently used.
+            self._entries[key] = entry
+        head, tail = entry[1]
+        return head + format_datestamp(time).encode('utf-8') + tail
+
+    def put(self, key, datestamp, body, size):
+        """Cache a body and drop old entries to hold at most `size`.
+
+        A body without a response date is not cached.
+        """
+        start = body.find(self._date_start)
+        end = body.find(self._date_end, start)
+        if start < 0 or end < 0:
+            return
+        parts = (body[:start + len(self._date_start)], body[end:])
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (datestamp, parts)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_response_cache = _ResponseCache()
+
+
+def cached_response(view):
+    """Cache the rendered responses of a view until the repository
+    changes.
+
+    The responses are cached by the URL and the parameters of the
+    request, since the response contains both, and the response date is
+    updated for each response.
+
+    The responses get ETag and Last-Modified headers derived from the
+    repository datestamp, so conditional requests are answered with
+    ``304 Not Modified``. Errors are neither cached nor given the headers.
+    """
+
+    def wrapper(context, request):
+        datestamp = Datestamp.get_cached()
+        if datestamp is None:
+            # Nothing has been imported yet.
+            return view(context, request)
+
+        size = request.registry.settings['response_cache_size']
+        key = (request.path_url,) + tuple(sorted(request.params.items()))
+        body = _response_cache.get(key, datestamp, datestamp_now())
+        if body is None:
+            response = view(context, request)
+            if size > 0:
+                _response_cache.put(key, datestamp, response.body, size)
+        else:
+            response = Response(body=body,
+                                content_type='text/xml',
+                                charset='utf-8')
+
+        response.conditional_response = True
+        response.etag = datestamp.strftime('%Y%m%d%H%M%S%f')
+        response.last_modified = datestamp
+        return response
+
+    return wrapper
+
+
 @view_config(context=exception.OaiException,
              renderer='templates/error.pt')
 @oai_view
@@ -70,7 +165,8 @@ def invalid_verb_view(request):
 
 @view_config(route_name='oai',
              request_param='verb=Identify',
-             renderer='templates/identify.pt')
+             renderer='templates/identify.pt',
+             decorator=cached_response)
 @oai_view
 def handle_identify(request):
     _check_params(request.params)
@@ -91,7 +187,8 @@ def handle_identify(request):
 
 @view_config(route_name='oai',
              request_param='verb=ListSets',
-             renderer='templates/listsets.pt')
+             renderer='templates/listsets.pt',
+             decorator=cached_response)
 @oai_view
 def handle_list_sets(request):
     try:
@@ -112,7 +209,8 @@ def handle_list_sets(request):
 
 @view_config(route_name='oai',
              request_param='verb=ListMetadataFormats',
-             renderer='templates/listformats.pt')
+             renderer='templates/listformats.pt',
+             decorator=cached_response)
 @oai_view
 def handle_list_metadata_formats(request):
     _check_params(request.params, allowed=[u'identifier'])
@@ -136,7 +234,7 @@ def handle_list_metadata_formats(request):
              renderer='templates/listidentifiers.pt')
 @view_config(route_name='oai',
              request_param='verb=ListRecords',
-             renderer='templates/listrecords.pt')
+             renderer='listrecords')
 @oai_view
 def handle_list_items(request):
     limit = request.registry.settings[u'item_list_limit']
@@ -157,10 +255,14 @@ def handle_list_items(request):
       required = [u'metadataPrefix']
       allowed = [u'from', u'until', u'set']
 
+    # Only the headers of ListIdentifiers show the sets of the records.
+    load_sets = (request.params.get(u'verb') == u'ListIdentifiers')
+
     try:
         _check_params(params, required=required, allowed=allowed)
         ignore_deleted = _get_ignore_deleted(request)
-        records, next_offset = _get_records(params, ignore_deleted, limit)
+        records, next_offset = _get_records(params, ignore_deleted, limit,
+                                            load_sets)
     except exception.OaiException:
         if has_token:
             # Raise a BadResumptionToken instead since the parameters were
@@ -209,10 +311,12 @@ def handle_get_record(request):
     identifier = _get_identifier(request.params, ignore_deleted)
     prefix = _get_metadata_prefix(request.params, ignore_deleted)
 
+    # The XML data is loaded only if the record has not been serialized.
     records = Record.list(
         identifier=identifier,
         metadata_prefix=prefix,
         ignore_deleted=ignore_deleted,
+        defer_xml=True,
     )
 
     if not records:
@@ -350,7 +454,7 @@ def _check_resumption_token_date(token):
         date, _ = parse_date(token[u'date'])
     except:
         raise exception.InvalidResumptionToken()
-    latest = Datestamp.get()
+    latest = Datestamp.get_cached()
     if (latest is not None) and (latest >= date):
         raise exception.ExpiredResumptionToken()
 
@@ -366,7 +470,7 @@ def _get_metadata_prefix(params, ignore_deleted):
     ``UnsupportedMetadataFormat``. Otherwise return the prefix.
     """
     prefix = params[u'metadataPrefix']
-    if not Format.exists(prefix, ignore_deleted):
+    if not Format.exists(prefix, ignore_deleted, cached=True):
         raise exception.UnsupportedMetadataFormat(prefix)
     return prefix
 
@@ -398,7 +502,7 @@ def _get_identifier(params, ignore_deleted):
     return identifier
 
 
-def _get_records(params, ignore_deleted, limit):
+def _get_records(params, ignore_deleted, limit, load_sets=True):
     """Fetch records from the model.
 
     Parameters
@@ -409,6 +513,9 @@ def _get_records(params, ignore_deleted, limit):
         If `True`, filter out deleted records.
     limit: int
         Maximum number of records to fetch.
+    load_sets: bool
+        If `True`, the set specs of the records are loaded with a
+        single query. Not needed when the headers are not rendered.
 
     Return
     ------
@@ -438,27 +545,36 @@ def _get_records(params, ignore_deleted, limit):
     if u'set' in params and len(Set.list()) == 0:
         raise exception.NoSetHierarchy()
 
-    records = Record.list(
+    # The set specs of the whole page are fetched with a single query
+    # instead of one query per rendered header, if they are needed.
+    records = list(Record.iter(
         metadata_prefix=prefix,
         from_date=from_date,
         until_date=until_date,
         set_=params.get(u'set'),
         ignore_deleted=ignore_deleted,
         offset=params.get(u'offset'),
+        # ListIdentifiers needs only the headers, and the ListRecords
+        # renderer reads the XML data of the records while streaming.
+        defer_xml=True,
 
         # Try to fetch one extra record to see wheter there are records
         # left, i.e. wheter we need to send a resumption token.
         limit=limit + 1,
-    )
+        batch_size=limit + 1,
+        load_sets=load_sets,
+    ))
 
     if not records:
         raise exception.NoRecordsMatch()
 
+    next_offset = None
     if len(records) == limit + 1:
         # More records left.
-        return records[:-1], records[-1].identifier
-    # Got all records.
-    return records, None
+        next_offset = records[-1].identifier
+        records = records[:-1]
+
+    return records, next_offset
 
 
 def _parse_from_and_until(from_date_str, until_date_str):
@@ -0,0 +1,79 @@
+from collections import namedtuple
+import os
+
+from chameleon import PageTemplateFile
+
+from .models import Record
+from .util import format_datestamp
+
+
+# The current state of a record being streamed.
+_StreamedRecord = namedtuple(
+    '_StreamedRecord',
+    ['identifier', 'datestamp', 'deleted', 'set_specs', 'xml'],
+)
+
+# The template is shared with the views, but the importer and the exporter
+# use it without the web application.
+_record_template = PageTemplateFile(
+    os.path.join(os.path.dirname(__file__), 'oai', 'templates', 'record.pt')
+)
+
+
+def render_record(record):
+    """Serialize a record as an OAI-PMH ``record`` element.
+
+    Parameters
+    ----------
+    record: Record
+        The record. Its header fields, set specs and XML data are used.
+
+    Return
+    ------
+    unicode:
+        The serialized element.
+    """
+    return _record_template(record=record, format_date=format_datestamp)
+
+
+def serialize_records(prefix, identifiers, chunk_size=None):
+    """Serialize records as OAI-PMH ``record`` elements.
+
+    Records serialized by the importer are read from the database as is
+    and the rest are rendered with `render_record`. The data is read with
+    `Record.iter_fragments`, so only a chunk of records is held in memory
+    at a time.
+
+    The records are serialized as they are when they are read, which
+    may differ from the state in which the caller listed them if the
+    importer has changed them in between. The header and the metadata of
+    a record are always read together, so a record is never serialized
+    with the header of one version and the metadata of another.
+
+    Parameters
+    ----------
+    prefix: unicode
+        Prefix of the metadata format of the records.
+    identifiers: list of unicode
+        Identifiers of the items.
+    chunk_size: int or None
+        Number of records read from the database at a time.
+
+    Return
+    ------
+    iterator of unicode:
+        The serialized elements. Records removed after they were listed
+        are skipped.
+    """
+    serialized = Record.iter_fragments(prefix, identifiers, chunk_size)
+    try:
+        for identifier, fragment, state in serialized:
+            if fragment is None:
+                if state is None:
+                    # The record was removed after it was listed.
+                    continue
+                fragment = render_record(_StreamedRecord(identifier,
+                                                         *state))
+            yield fragment
+    finally:
+        serialized.close()
@@ -0,0 +1,139 @@
+from datetime import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+import mock
+
+from ... import models
+from ...exception import ExportError
+from ...exporter import export, parse_args
+from ...models import DBSession, Item, Record, Set
+from ..oai.test_templates import OAI_NS, parse_response
+from ..oai.test_templates import Record as DummyRecord
+from ..test_models import ModelTestCase, make_format
+
+
+class TestExportRecords(ModelTestCase):
+
+    def setUp(self):
+        super(TestExportRecords, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        make_format(u'oai_dc')
+        set_ = Set.create(u'a', u'Set A')
+        for i in xrange(5):
+            identifier = u'item{0}'.format(i)
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc',
+                          DummyRecord(identifier).xml,
+                          datetime(2014, 1, i + 1))
+            if i % 2 == 0:
+                Item.get(identifier).add_to_set(set_)
+        Record.mark_as_deleted(identifier=u'item4')
+        DBSession.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestExportRecords, self).tearDown()
+
+    def read(self, path):
+        """Parse and validate an exported file."""
+        with gzip.open(path, 'rb') as f:
+            return parse_response(f.read().decode('utf-8'))
+
+    def identifiers(self, tree):
+        return tree.xpath('//oai:record/oai:header/oai:identifier/text()',
+                          namespaces={'oai': OAI_NS})
+
+    def test_export(self):
+        Record.store_fragments([(Record.list(identifier=u'item1')[0],
+                                 u'<record><header><identifier>item1'
+                                 u'</identifier><datestamp>'
+                                 u'2014-01-02T00:00:00Z</datestamp>'
+                                 u'</header></record>')])
+        with mock.patch.object(Record, 'load_set_specs') as load:
+            paths = export.export_records(self.directory, u'oai_dc',
+                                          records_per_file=2,
+                                          base_url=u'http://example.org/oai')
+        # The set specs are read with the records while serializing.
+        self.assertFalse(load.called)
+
+        self.assertEqual(
+            paths,
+            [os.path.join(self.directory, 'oai_dc-0000{0}.xml.gz'.format(i))
+             for i in xrange(3)])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         [os.path.basename(p) for p in paths])
+        trees = [self.read(path) for path in paths]
+        self.assertEqual([self.identifiers(t) for t in trees],
+                         [['item0', 'item1'], ['item2', 'item3'],
+                          ['item4']])
+
+        request = trees[0].find('{{{0}}}request'.format(OAI_NS))
+        self.assertEqual(request.text, 'http://example.org/oai')
+        self.assertEqual(dict(request.attrib),
+                         {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
+        self.assertEqual(
+            trees[2].xpath('//oai:header/@status',
+                           namespaces={'oai': OAI_NS}),
+            ['deleted'])
+        self.assertEqual(
+            trees[0].xpath('//oai:setSpec/text()',
+                           namespaces={'oai': OAI_NS}),
+            ['a'])
+
+    def test_filters(self):
+        paths = export.export_records(self.directory, u'oai_dc',
+                                      from_date=datetime(2014, 1, 2),
+                                      set_=u'a',
+                                      ignore_deleted=True)
+        tree = self.read(paths[0])
+        self.assertEqual(self.identifiers(tree), ['item2'])
+        request = tree.find('{{{0}}}request'.format(OAI_NS))
+        self.assertEqual(request.get('from'), '2014-01-02T00:00:00Z')
+        self.assertEqual(request.get('set'), 'a')
+
+    def test_no_records(self):
+        paths = export.export_records(self.directory, u'oai_dc',
+                                      set_=u'invalid')
+        self.assertEqual(paths, [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_unsupported_format(self):
+        self.assertRaises(ExportError, export.export_records,
+                          self.directory, u'invalid')
+
+    def test_write_error(self):
+        """Incomplete files should be removed."""
+        with mock.patch.object(export._ResponseFile, 'complete',
+                               side_effect=IOError('disk full')):
+            self.assertRaises(ExportError, export.export_records,
+                              self.directory, u'oai_dc')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestParseArgs(unittest.TestCase):
+
+    def test_parse_args(self):
+        args = parse_args(['kuha_export', 'config.ini', 'oai_dc', 'dump',
+                           '--set', 'a:b', '--from', '2014-01-01',
+                           '--until', '2014-02-01',
+                           'sqlalchemy.url=sqlite://'])
+        self.assertEqual(args.config_uri, 'config.ini')
+        self.assertEqual(args.prefix, u'oai_dc')
+        self.assertEqual(args.directory, 'dump')
+        self.assertEqual(args.set_, u'a:b')
+        self.assertEqual(args.from_date, datetime(2014, 1, 1))
+        self.assertEqual(args.until_date, datetime(2014, 2, 1, 23, 59, 59))
+        self.assertEqual(args.records_per_file, 10000)
+        self.assertEqual(args.vars, ['sqlalchemy.url=sqlite://'])
+
+    def test_invalid_args(self):
+        for extra in [['--from', '2014'], ['--records-per-file', '0']]:
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, parse_args,
+                                  ['kuha_export', 'config.ini', 'oai_dc',
+                                   'dump'] + extra)
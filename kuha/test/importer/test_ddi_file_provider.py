@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ...importer import ddi_file_provider
+from ...importer.ddi_file_provider import DdiFileProvider
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for path in ['top.xml', 'notes.txt', 'a/one.xml', 'a/b/two.xml',
+                     'a/b/c/three.XML', 'd/four.xml', 'e/f/five.xml']:
+            self.create(path)
+        os.mkdir(os.path.join(self.directory, 'empty'))
+        self.provider = DdiFileProvider('example.org', self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, path):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('<codeBook/>')
+
+    def test_identifiers(self):
+        self.assertItemsEqual(
+            self.provider.identifiers(),
+            ['oai:example.org:top', 'oai:example.org:a/one',
+             'oai:example.org:a/b/two', 'oai:example.org:a/b/c/three',
+             'oai:example.org:d/four', 'oai:example.org:e/f/five'])
+
+    def test_scan_workers(self):
+        """The subdirectories scanned concurrently should be listed in
+        the same order as when they are scanned one by one."""
+        expected = list(self.provider.identifiers())
+        for workers in [2, 3, 10]:
+            provider = DdiFileProvider('example.org', self.directory,
+                                       workers)
+            self.assertEqual(list(provider.identifiers()), expected)
+        # Files directly in the directory come first, and the files of
+        # each subdirectory are listed together.
+        self.assertEqual(expected[0], 'oai:example.org:top')
+        subdirs = [i.split(':')[2].split('/')[0] for i in expected[1:]]
+        runs = [d for i, d in enumerate(subdirs)
+                if i == 0 or subdirs[i - 1] != d]
+        self.assertEqual(sorted(runs), ['a', 'd', 'e'])
+
+    def test_symbolic_links(self):
+        """Links to files should be listed but links to directories should
+        not be followed."""
+        os.symlink(os.path.join(self.directory, 'd'),
+                   os.path.join(self.directory, 'link'))
+        os.symlink(os.path.join(self.directory, 'top.xml'),
+                   os.path.join(self.directory, 'link.xml'))
+        os.symlink(os.path.join(self.directory, 'missing.xml'),
+                   os.path.join(self.directory, 'broken.xml'))
+        identifiers = list(self.provider.identifiers())
+        self.assertIn('oai:example.org:link', identifiers)
+        self.assertNotIn('oai:example.org:link/four', identifiers)
+        self.assertNotIn('oai:example.org:broken', identifiers)
+
+    def test_has_changed(self):
+        identifier = 'oai:example.org:a/one'
+        path = os.path.join(self.directory, 'a', 'one.xml')
+        changed = datetime.utcfromtimestamp(
+            ddi_file_provider._mtime(os.stat(path)))
+
+        list(self.provider.identifiers())
+        # The modification times of the scan are used.
+        with mock.patch.object(ddi_file_provider.os, 'stat',
+                               side_effect=OSError()):
+            self.assertTrue(self.provider.has_changed(
+                identifier, changed - timedelta(seconds=1)))
+            self.assertTrue(self.provider.has_changed(identifier, changed))
+            self.assertFalse(self.provider.has_changed(
+                identifier, changed + timedelta(seconds=1)))
+
+    def test_has_changed_without_scan(self):
+        identifier = 'oai:example.org:d/four'
+        now = datetime.utcnow()
+        self.assertTrue(self.provider.has_changed(
+            identifier, now - timedelta(days=1)))
+        self.assertFalse(self.provider.has_changed(
+            identifier, now + timedelta(days=1)))
@@ -1,10 +1,14 @@
 import unittest
 from datetime import datetime
 import logging
+import threading
+import time
 
+from lxml import etree
 import mock
 
 from ..util import LogCapture
+from ... import models
 from ...exception import HarvestError
 from ...importer import harvest
 
@@ -14,6 +18,12 @@ def make_item(identifier):
     return item
 
 
+def make_set(spec):
+    set_ = mock.Mock()
+    set_.spec = spec
+    return set_
+
+
 def make_format(prefix):
     format_ = mock.Mock()
     format_.prefix = prefix
@@ -53,7 +63,7 @@ class TestUpdateFormats(unittest.TestCase):
             models.Format.create_or_update.mock_calls,
             [mock.call(p, n, s) for p, (n, s) in formats.iteritems()]
         )
-        models.purge_deleted.assert_called_once_with()
+        models.purge_deleted.assert_called_once_with(commit_chunks=True)
         provider.formats.assert_called_once_with()
         models.commit.assert_called_once_with()
 
@@ -104,34 +114,43 @@ class TestUpdateItems(unittest.TestCase):
         identifiers = ['asd', u'U', 'a:b']
         provider = mock.Mock()
         provider.identifiers.return_value = identifiers
-        item_mocks = [make_item(u'1234'), make_item(u'asd')]
 
         with LogCapture(harvest) as log:
             with mock.patch.object(harvest, 'models') as models:
-                models.Item.list.return_value = item_mocks
+                models.Item.list_identifiers.return_value = set(
+                    [u'1234', u'asd'])
                 new_ids = harvest.update_items(provider, purge=True)
 
         self.assertItemsEqual(new_ids, identifiers)
         provider.identifiers.assert_called_once_with()
-        item_mocks[0].mark_as_deleted.assert_called_once_with()
-        self.assertEqual(item_mocks[1].mark_as_deleted.mock_calls, [])
-        self.assertItemsEqual(
-            models.Item.create_or_update.mock_calls,
-            [mock.call(i) for i in ['asd', u'U', 'a:b']]
-        )
-        models.purge_deleted.assert_called_once_with()
+        models.Item.list_identifiers.assert_called_once_with(
+            ignore_deleted=True)
+        models.Item.mark_as_deleted_except.assert_called_once_with(
+            frozenset(identifiers))
+        models.Item.create_or_update_all.assert_called_once_with(
+            frozenset([u'U', u'a:b']))
+        models.purge_deleted.assert_called_once_with(commit_chunks=True)
         models.commit.assert_called_once_with()
         log.assert_emitted('Removed 1 item and added 2 items.')
 
+    def test_nothing_removed(self):
+        provider = mock.Mock()
+        provider.identifiers.return_value = ['id']
+
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.list_identifiers.return_value = set([u'id'])
+            harvest.update_items(provider)
+        self.assertEqual(models.Item.mark_as_deleted_except.mock_calls, [])
+
     def test_no_identifiers(self):
         provider = mock.Mock()
         provider.identifiers.return_value = []
-        item_mock = make_item(u'id')
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = [item_mock]
+            models.Item.list_identifiers.return_value = set([u'id'])
             harvest.update_items(provider, purge=False)
-        item_mock.mark_as_deleted.assert_called_once_with()
+        models.Item.mark_as_deleted_except.assert_called_once_with(
+            frozenset())
 
     def test_provider_fails(self):
         provider = mock.Mock()
@@ -148,12 +167,10 @@ class TestUpdateItems(unittest.TestCase):
         ]
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = []
+            models.Item.list_identifiers.return_value = set()
             new_ids = harvest.update_items(provider, purge=False)
-        self.assertItemsEqual(
-            models.Item.create_or_update.mock_calls,
-            [mock.call(i) for i in ['i1', 'i2', 'i3']]
-        )
+        models.Item.create_or_update_all.assert_called_once_with(
+            frozenset(['i1', 'i2', 'i3']))
         self.assertItemsEqual(new_ids, ['i1', 'i2', 'i3'])
 
     def test_invalid_identifiers(self):
@@ -166,7 +183,7 @@ class TestUpdateItems(unittest.TestCase):
         ]
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = []
+            models.Item.list_identifiers.return_value = set()
             with self.assertRaises(HarvestError) as cm:
                 harvest.update_items(provider)
         self.assertIn('conversion failed', cm.exception.message)
@@ -174,17 +191,16 @@ class TestUpdateItems(unittest.TestCase):
     def test_dry_run(self):
         provider = mock.Mock()
         provider.identifiers.return_value = ['asd']
-        item_mock = make_item(u'1234')
 
         with LogCapture(harvest) as log:
             with mock.patch.object(harvest, 'models') as models:
-                models.Item.list.return_value = [item_mock]
+                models.Item.list_identifiers.return_value = set([u'1234'])
                 harvest.update_items(provider, purge=True, dry_run=True)
 
-        self.assertEqual(models.Item.create_or_update.mock_calls, [])
+        self.assertEqual(models.Item.create_or_update_all.mock_calls, [])
+        self.assertEqual(models.Item.mark_as_deleted_except.mock_calls, [])
         self.assertEqual(models.purge_deleted.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
-        self.assertEqual(item_mock.mark_as_deleted.mock_calls, [])
 
         log.assert_emitted('Removed 1 item and added 1 item.')
 
@@ -217,7 +233,7 @@ class TestUpdateRecords(unittest.TestCase):
         )
         self.assertItemsEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, models.SetWriter.return_value)
              for id_ in [u'item0', u'item1', u'item3']],
         )
         self.assertItemsEqual(
@@ -308,12 +324,20 @@ class TestUpdateRecords(unittest.TestCase):
 
         self.assertItemsEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, models.SetWriter.return_value)
              for id_ in [u'item1', u'item2']],
         )
         log.assert_emitted('Failed to update item "item1"')
         log.assert_emitted('Failed to update item "item2"')
         log.assert_emitted('invalid set spec')
+        # The changes buffered for the failed items are forgotten.
+        set_writer = models.SetWriter.return_value
+        self.assertEqual(set_writer.snapshot.mock_calls,
+                         [mock.call(u'item1'), mock.call(u'item2')])
+        self.assertEqual(
+            set_writer.restore.mock_calls,
+            [mock.call(set_writer.snapshot.return_value)] * 2)
+        models.savepoint.return_value.rollback.assert_called_with()
 
     def test_delete_single_record(self):
         formats = [u'oai_dc', u'ead', u'ddi']
@@ -355,12 +379,363 @@ class TestUpdateRecords(unittest.TestCase):
                         dry_run=True,
                     )
 
-        update_sets_mock.assert_called_once_with(provider, u'item1', True)
+        update_sets_mock.assert_called_once_with(
+            provider, u'item1', True, None)
+        self.assertEqual(models.SetWriter.mock_calls, [])
         self.assertEqual(models.Record.create_or_update.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
 
         log.assert_emitted('Updated 1 record.')
 
+    def test_commit_batches(self):
+        identifiers = [u'item{0}'.format(i) for i in xrange(5)]
+        provider = mock.Mock()
+        provider.get_record.return_value = '<xml ... />'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                harvest.update_records(
+                    provider, identifiers, [u'ead', u'oai_dc'],
+                    commit_batch_size=4)
+
+        # 10 records in batches of 4, 4 and 2.
+        self.assertEqual(
+            models.commit.mock_calls,
+            [mock.call() for _ in xrange(3)]
+        )
+
+    def test_failed_record_rolls_back_savepoint(self):
+        def create_or_update(id_, prefix, xml):
+            if id_ == 'id1':
+                raise ValueError('invalid data')
+        provider = mock.Mock()
+        provider.get_record.return_value = 'data'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                savepoints = [mock.Mock() for _ in xrange(4)]
+                models.savepoint.side_effect = savepoints
+                models.Record.create_or_update.side_effect = (
+                    create_or_update)
+                with LogCapture(harvest) as log:
+                    harvest.update_records(
+                        provider, ['id1', 'id2'], [u'ead'],
+                        commit_batch_size=10)
+
+        # One savepoint for the sets and one for the record of each item.
+        self.assertEqual(savepoints[0].rollback.mock_calls, [])
+        savepoints[1].rollback.assert_called_once_with()
+        self.assertEqual(savepoints[1].commit.mock_calls, [])
+        for savepoint in [savepoints[0], savepoints[2], savepoints[3]]:
+            savepoint.commit.assert_called_once_with()
+        models.commit.assert_called_once_with()
+        log.assert_emitted(
+            'Failed to disseminate format "ead" for item "id1"')
+        log.assert_emitted('Updated 1 record.')
+
+    def test_bulk(self):
+        def get_record(id_, prefix):
+            if id_ == 'id1':
+                raise ValueError('crosswalk error')
+            elif id_ == 'id2':
+                return None
+            return 'data'
+        provider = mock.Mock()
+        provider.get_record.side_effect = get_record
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                writer = models.RecordWriter.return_value
+                with LogCapture(harvest) as log:
+                    harvest.update_records(
+                        provider, ['id1', 'id2', 'id3'], [u'ead'],
+                        bulk=True, commit_batch_size=10)
+
+        writer.write.assert_called_once_with('id3', u'ead', 'data')
+        writer.mark_as_deleted.assert_called_once_with('id2', u'ead')
+        writer.flush.assert_called_once_with()
+        self.assertEqual(models.Record.create_or_update.mock_calls, [])
+        models.commit.assert_called_once_with()
+        log.assert_emitted(
+            'Failed to disseminate format "ead" for item "id1"')
+        log.assert_emitted('Updated 1 record.')
+
+    def test_bulk_flush_fails(self):
+        provider = mock.Mock()
+        provider.get_record.return_value = 'data'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                writer = models.RecordWriter.return_value
+                writer.flush.side_effect = ValueError('database error')
+                with LogCapture(harvest) as log:
+                    harvest.update_records(
+                        provider, ['id1'], [u'ead'], bulk=True)
+
+        writer.discard.assert_called_once_with()
+        self.assertEqual(models.commit.mock_calls, [])
+        log.assert_emitted('Failed to write records: database error')
+        self.assertEqual(provider.records_committed.mock_calls, [])
+
+    def test_records_committed(self):
+        """The provider should be told of the items committed."""
+        def get_record(id_, prefix):
+            if id_ == 'id1':
+                raise ValueError('crosswalk error')
+            return 'data'
+        provider = mock.Mock()
+        provider.get_record.side_effect = get_record
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                models.commit.side_effect = lambda: self.assertEqual(
+                    provider.records_committed.call_count,
+                    models.commit.call_count - 1)
+                harvest.update_records(
+                    provider, ['id1', 'id2', 'id3', 'id4'], [u'ead'],
+                    commit_batch_size=2)
+
+        # An item is reported after the commit which ends it.
+        self.assertEqual(provider.records_committed.mock_calls, [
+            mock.call(['id2']),
+            mock.call(['id3', 'id4']),
+        ])
+
+    def test_records_committed_dry_run(self):
+        provider = mock.Mock()
+        provider.get_record.return_value = 'data'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models'):
+                harvest.update_records(
+                    provider, ['id1'], [u'ead'], dry_run=True)
+
+        self.assertEqual(provider.records_committed.mock_calls, [])
+
+    def test_records_committed_optional(self):
+        provider = mock.Mock(spec=['has_changed', 'get_sets', 'get_record'])
+        provider.get_record.return_value = 'data'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                harvest.update_records(provider, ['id1'], [u'ead'])
+
+        models.commit.assert_called_once_with()
+
+    def test_records_committed_fails(self):
+        provider = mock.Mock()
+        provider.get_record.return_value = 'data'
+        provider.records_committed.side_effect = IOError('disk full')
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                with LogCapture(harvest) as log:
+                    harvest.update_records(
+                        provider, ['id1', 'id2'], [u'ead'])
+
+        self.assertEqual(models.commit.call_count, 2)
+        log.assert_emitted('Failed to notify the provider of committed '
+                           'records: disk full')
+
+
+class TestUpdateFragments(unittest.TestCase):
+
+    def test_update_fragments(self):
+        batches = [[make_item('a'), make_item('b')], [make_item('c')], []]
+        with mock.patch.object(harvest, 'models') as models:
+            models.Record.list_unserialized.side_effect = batches
+            with mock.patch.object(harvest, 'render_record',
+                                   lambda r: r.identifier.upper()):
+                harvest.update_fragments(batch_size=2)
+
+        self.assertEqual(models.Record.list_unserialized.mock_calls, [
+            mock.call(2, None),
+            mock.call(2, ('b', batches[0][1].prefix)),
+            mock.call(2, ('c', batches[1][0].prefix)),
+        ])
+        self.assertEqual(models.Record.store_fragments.mock_calls, [
+            mock.call([(batches[0][0], 'A'), (batches[0][1], 'B')]),
+            mock.call([(batches[1][0], 'C')]),
+        ])
+        self.assertEqual(models.commit.call_count, 2)
+
+    def test_record_fails(self):
+        """A record which fails to serialize should be skipped."""
+        def render(record):
+            if record.identifier == 'b':
+                raise ValueError('template error')
+            return record.identifier.upper()
+
+        batches = [[make_item('a'), make_item('b')], [make_item('c')], []]
+        with mock.patch.object(harvest, 'models') as models:
+            models.Record.list_unserialized.side_effect = batches
+            with mock.patch.object(harvest, 'render_record', render):
+                with LogCapture(harvest) as log:
+                    harvest.update_fragments(batch_size=2)
+
+        self.assertEqual(models.Record.store_fragments.mock_calls, [
+            mock.call([(batches[0][0], 'A')]),
+            mock.call([(batches[1][0], 'C')]),
+        ])
+        self.assertEqual(models.commit.call_count, 2)
+        models.rollback.assert_not_called()
+        log.assert_emitted('Failed to serialize record "b"')
+        log.assert_emitted('Serialized 2 records.')
+        log.assert_emitted('Failed to serialize 1 record.')
+
+    def test_failure(self):
+        """A failure should be logged but not raised."""
+        with mock.patch.object(harvest, 'models') as models:
+            models.Record.list_unserialized.return_value = [make_item('a')]
+            models.Record.store_fragments.side_effect = ValueError('oops')
+            with mock.patch.object(harvest, 'render_record'):
+                with LogCapture(harvest) as log:
+                    harvest.update_fragments()
+        models.rollback.assert_called_once_with()
+        log.assert_emitted('Failed to serialize records: oops')
+
+    def test_dry_run(self):
+        with mock.patch.object(harvest, 'models') as models:
+            harvest.update_fragments(dry_run=True)
+        self.assertEqual(models.mock_calls, [])
+
+
+class TestDisseminate(unittest.TestCase):
+
+    def test_disseminate(self):
+        def get_record(id_, prefix):
+            if prefix == u'ead':
+                raise ValueError('crosswalk error')
+            return 'data'
+        provider = mock.Mock()
+        provider.get_record.side_effect = get_record
+
+        identifier, records, error = harvest.disseminate(
+            provider, u'item', [u'oai_dc', u'ead'])
+
+        self.assertEqual(identifier, u'item')
+        self.assertIsNone(error)
+        self.assertEqual(records[0], (u'oai_dc', 'data', None))
+        self.assertEqual(records[1][:2], (u'ead', None))
+        self.assertIn('crosswalk error', records[1][2])
+
+    def test_element(self):
+        """Elements should be serialized as checked xml."""
+        provider = mock.Mock()
+        provider.get_record.return_value = etree.fromstring(
+            u'<dc xmlns="urn:dc"><title>\xe4</title></dc>')
+
+        _, records, _ = harvest.disseminate(provider, u'item', [u'oai_dc'])
+
+        prefix, xml, error = records[0]
+        self.assertIsInstance(xml, models.CheckedXml)
+        self.assertEqual(xml, u'<dc xmlns="urn:dc"><title>\xe4</title></dc>')
+
+    def test_checked_fragment(self):
+        provider = mock.Mock()
+        provider.get_record.side_effect = [
+            (u'<dc/>', True), (u'<dc/>', False), ('<dc/>', True)]
+
+        _, records, _ = harvest.disseminate(
+            provider, u'item', [u'a', u'b', u'c'])
+
+        self.assertEqual([r[1] for r in records], [u'<dc/>'] * 3)
+        self.assertEqual([type(r[1]) for r in records],
+                         [models.CheckedXml, unicode, str])
+
+    def test_not_changed(self):
+        provider = mock.Mock()
+        provider.has_changed.return_value = False
+        time = datetime(2014, 2, 4, 10, 54, 27)
+        self.assertEqual(
+            harvest.disseminate(provider, u'item', [u'oai_dc'], time),
+            (u'item', None, None)
+        )
+        provider.has_changed.assert_called_once_with(u'item', time)
+        self.assertEqual(provider.get_record.mock_calls, [])
+
+    def test_has_changed_fails(self):
+        provider = mock.Mock()
+        provider.has_changed.side_effect = IOError('no such file')
+        identifier, records, error = harvest.disseminate(
+            provider, u'item', [u'oai_dc'], datetime(2014, 2, 4))
+        self.assertIsNone(records)
+        self.assertIn('no such file', error)
+
+    def test_thread_pool(self):
+        identifiers = [u'item{0}'.format(i) for i in xrange(100)]
+        provider = mock.Mock()
+        provider.get_record.side_effect = lambda id_, prefix: id_
+
+        results = list(harvest._disseminate_all(
+            provider, identifiers, [u'oai_dc'], workers=4))
+
+        # The results are in the order of the identifiers.
+        self.assertEqual(
+            results,
+            [(id_, [(u'oai_dc', id_, None)], None) for id_ in identifiers]
+        )
+
+    def test_pool_kept_busy(self):
+        """Items should be submitted as soon as results are consumed, not
+        only after all the submitted items are done."""
+        identifiers = [u'item{0}'.format(i) for i in xrange(8)]
+        later_started = threading.Event()
+        waited = []
+
+        def get_record(identifier, prefix):
+            if identifier == u'item3':
+                # Wait until an item submitted after this one has started.
+                waited.append(later_started.wait(5))
+            elif identifier == u'item5':
+                later_started.set()
+            return identifier
+
+        provider = mock.Mock()
+        provider.get_record.side_effect = get_record
+        with mock.patch.object(harvest, '_TASKS_PER_WORKER', 2):
+            results = list(harvest._disseminate_all(
+                provider, identifiers, [u'oai_dc'], workers=2))
+
+        self.assertEqual([r[0] for r in results], identifiers)
+        self.assertEqual(waited, [True])
+
+    def test_pool_bounded(self):
+        """Only a bounded number of items should be submitted ahead of the
+        consumer."""
+        identifiers = [u'item{0}'.format(i) for i in xrange(100)]
+        started = []
+        provider = mock.Mock()
+        provider.get_record.side_effect = \
+            lambda id_, prefix: started.append(id_)
+
+        with mock.patch.object(harvest, '_TASKS_PER_WORKER', 2):
+            results = harvest._disseminate_all(
+                provider, identifiers, [u'oai_dc'], workers=2)
+            next(results)
+            time.sleep(0.2)
+            self.assertLessEqual(len(started), 2 * 2 + 1)
+            # Abandoning the results should stop the pool.
+            closer = threading.Thread(target=results.close)
+            closer.start()
+            closer.join(5)
+            self.assertFalse(closer.is_alive())
+
+    def test_pool_in_update_records(self):
+        identifiers = [u'item{0}'.format(i) for i in xrange(10)]
+        provider = mock.Mock()
+        provider.get_record.return_value = 'data'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                harvest.update_records(
+                    provider, identifiers, [u'oai_dc'], workers=3)
+
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, u'oai_dc', 'data') for id_ in identifiers]
+        )
+
 
 class TestUpdateSets(unittest.TestCase):
 
@@ -371,47 +746,50 @@ class TestUpdateSets(unittest.TestCase):
             ('a',   u'Set A'),
             ('a:b:c','Set C'),
         ]
+        writer = mock.Mock()
 
         with mock.patch.object(harvest, 'models') as models:
-            harvest.update_sets(provider, 'oai:example.org:item')
+            harvest.update_sets(provider, 'oai:example.org:item',
+                                writer=writer)
 
-        models.Item.get.assert_called_once_with('oai:example.org:item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
-        self.assertEqual(
-            models.Set.create_or_update.mock_calls,
-            [mock.call('a', u'Set A'),
-             mock.call(u'a:b', 'Set B'),
-             mock.call('a:b:c', 'Set C')]
-        )
-        set_ = models.Set.create_or_update.return_value
-        self.assertEqual(
-            item.add_to_set.mock_calls,
-            [mock.call(set_) for _ in xrange(3)]
-        )
+        writer.write.assert_called_once_with(
+            'oai:example.org:item',
+            [('a', u'Set A'), (u'a:b', 'Set B'), ('a:b:c', 'Set C')])
+        # The caller flushes the writer.
+        self.assertEqual(writer.flush.mock_calls, [])
+        self.assertEqual(models.SetWriter.mock_calls, [])
 
-    def test_no_sets(self):
+    def test_no_writer(self):
         provider = mock.Mock()
-        provider.get_sets.return_value = []
+        provider.get_sets.return_value = [(u'a', u'Set A')]
         with mock.patch.object(harvest, 'models') as models:
             harvest.update_sets(provider, 'item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
-        self.assertEqual(item.add_to_set.mock_calls, [])
+        writer = models.SetWriter.return_value
+        writer.write.assert_called_once_with('item', [(u'a', u'Set A')])
+        writer.flush.assert_called_once_with()
+
+    def test_changed_sets(self):
+        """Serialized records should be invalidated when sets change."""
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        writer = mock.Mock()
+        for changed in [False, True]:
+            writer.write.return_value = changed
+            with mock.patch.object(harvest, 'models') as models:
+                harvest.update_sets(provider, 'item', writer=writer)
+            self.assertEqual(models.Record.invalidate_fragments.call_count,
+                             1 if changed else 0)
 
     def test_dry_run(self):
         provider = mock.Mock()
         provider.get_sets.return_value = [(u'a', 'Set Name')]
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item
             harvest.update_sets(
                 provider,
                 'oai:example.org:item',
                 dry_run=True,
             )
-        item_mock = models.Item.get.return_value
 
-        self.assertEqual(item_mock.clear_sets.mock_calls, [])
-        self.assertEqual(models.Set.create_or_update.mock_calls, [])
-        self.assertEqual(item_mock.add_to_set.mock_calls, [])
+        provider.get_sets.assert_called_once_with('oai:example.org:item')
+        self.assertEqual(models.mock_calls, [])
@@ -0,0 +1,160 @@
+import mock
+from pyramid.renderers import render
+
+from ... import serialization
+from ...util import format_datestamp
+from ...oai import renderers
+from .test_templates import OaiTemplateTest, Record
+
+
+class TestListRecordsRenderer(OaiTemplateTest):
+
+    def setUp(self):
+        self.verb = 'ListRecords'
+        self.template = 'listrecords'
+        super(TestListRecordsRenderer, self).setUp()
+        self.config.add_renderer('listrecords',
+                                 renderers.ListRecordsRenderer)
+        self.request.params['metadataPrefix'] = 'oai_dc'
+        self.records = [Record('Rec 0', 'item0'),
+                        Record('Rec 1', 'item1', set_specs=['a', 'a:b']),
+                        Record('Rec 2', 'item2', deleted=True)]
+
+    def stream(self, records, token=None, states=None, fragments={}):
+        """Render the records and return the list of streamed chunks."""
+        if states is None:
+            states = dict((r.identifier,
+                           (r.datestamp, r.deleted, r.set_specs, r.xml))
+                          for r in records)
+
+        def read_fragments(prefix, identifiers, chunk_size):
+            for identifier in identifiers:
+                fragment = fragments.get(identifier)
+                yield (identifier,
+                       fragment,
+                       None if fragment else states[identifier])
+
+        iter_fragments = mock.Mock(side_effect=read_fragments)
+        with mock.patch.object(serialization.Record, 'iter_fragments',
+                               iter_fragments):
+            chunks = list(self.render_template({
+                'records': records,
+                'token': token,
+            }))
+        return chunks, iter_fragments
+
+    def test_list_records(self):
+        chunks, iter_fragments = self.stream(self.records, token='{1234}')
+
+        # The envelope and each record are sent separately.
+        self.assertEqual(len(chunks), 5)
+        for chunk in chunks:
+            self.assertIs(type(chunk), str)
+        self.check_response(b''.join(chunks).decode('utf-8'),
+                            {'ListRecords':
+            [('record', {
+                'header': {
+                    'identifier': 'item0',
+                    'datestamp': format_datestamp(self.records[0].datestamp),
+                },
+                'metadata': {'dc': {'title': 'Rec 0'}},
+            }),
+            ('record', {
+                'header': [
+                    ('identifier', 'item1'),
+                    ('setSpec', 'a'),
+                    ('setSpec', 'a:b'),
+                ],
+                'metadata': {'dc': {'title': 'Rec 1'}},
+            }),
+            ('record', {'header': {
+                'identifier': 'item2',
+                '@status': 'deleted',
+            }}),
+            ('resumptionToken', '{1234}')]
+        })
+        iter_fragments.assert_called_once_with(
+            u'oai_dc', ['item0', 'item1', 'item2'], None)
+
+    def test_serialized_records(self):
+        """Serialized records should be sent as is."""
+        fragments = {'item1': serialization.render_record(
+            Record('Serialized', 'item1', set_specs=['c']))}
+        chunks, _ = self.stream(self.records, fragments=fragments)
+
+        self.assertEqual(chunks[2], fragments['item1'].encode('utf-8'))
+        self.check_response(b''.join(chunks).decode('utf-8'), {
+            'ListRecords': [
+                ('record', {'metadata': {'dc': {'title': 'Rec 0'}}}),
+                ('record', {
+                    'header': {'identifier': 'item1', 'setSpec': 'c'},
+                    'metadata': {'dc': {'title': 'Serialized'}},
+                }),
+            ],
+        })
+
+    def test_removed_record(self):
+        """Records removed while streaming should be left out."""
+        r = self.records[1]
+        states = {'item0': None,
+                  'item1': (r.datestamp, r.deleted, r.set_specs, r.xml)}
+        chunks, _ = self.stream(self.records[:2], states=states)
+
+        self.check_response(b''.join(chunks).decode('utf-8'), {
+            'ListRecords': {'record': {'header': {'identifier': 'item1'}}},
+        })
+        self.assertEqual(len(chunks), 3)
+
+    def test_changed_record(self):
+        """Records changed while streaming should be sent as they are
+        when read."""
+        r = self.records[0]
+        states = {'item0': (r.datestamp, True, ['c'], None)}
+        chunks, _ = self.stream(self.records[:1], states=states)
+
+        self.check_response(b''.join(chunks).decode('utf-8'), {
+            'ListRecords': {'record': {'header': {
+                'identifier': 'item0',
+                '@status': 'deleted',
+                'setSpec': 'c',
+            }}},
+        })
+
+    def test_data_read_lazily(self):
+        """Record data should be read only when the response is sent."""
+        iter_fragments = mock.Mock(return_value=iter([]))
+        with mock.patch.object(serialization.Record, 'iter_fragments',
+                               iter_fragments):
+            result = self.render_template({
+                'records': self.records,
+                'token': None,
+            })
+            self.assertEqual(iter_fragments.mock_calls, [])
+            head = next(result)
+            self.assertIn(b'<ListRecords>', head)
+            self.assertNotIn(b'<record>', head)
+
+    def test_close(self):
+        """Closing the stream should release the database session."""
+        closed = []
+
+        def read_fragments(prefix, identifiers, chunk_size):
+            try:
+                for identifier in identifiers:
+                    yield identifier, None, (self.records[0].datestamp,
+                                             False, [],
+                                             self.records[0].xml)
+            finally:
+                closed.append(True)
+
+        with mock.patch.object(serialization.Record, 'iter_fragments',
+                               side_effect=read_fragments):
+            result = self.render_template({
+                'records': self.records,
+                'token': None,
+            })
+            next(result)
+            next(result)
+            self.assertEqual(closed, [])
+            result.close()
+        self.assertEqual(closed, [True])
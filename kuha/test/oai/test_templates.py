@@ -8,6 +8,8 @@ from pyramid.renderers import render, get_renderer
 
 from ..schema import master_schema
 
+from ...serialization import render_record
+
 from ...util import (
     format_datestamp,
     filter_illegal_chars,
@@ -57,13 +59,15 @@ class Record(object):
                  title='Test Record',
                  identifier='oai:example.org:item',
                  set_specs=[],
-                 deleted=False):
+                 deleted=False,
+                 fragment=None):
         self.identifier = identifier
         self.prefix = u'oai_dc'
         self.set_specs = set_specs
         self.datestamp = datetime(2014, 4, 2, 12, 34, 56)
         self.deleted = deleted
         self.title = title
+        self.fragment = fragment
         if deleted:
             self.xml = None
         else:
@@ -370,6 +374,20 @@ class TestGetRecord(OaiTemplateTest):
             '@status': 'deleted',
         }}}})
 
+    def test_serialized_record(self):
+        """A serialized record should be sent as is."""
+        r = Record(title='Serialized')
+        r.fragment = render_record(r)
+        r.title = r.xml = None
+        self.request.params['identifier'] = r.identifier
+        self.request.params['metadataPrefix'] = r.prefix
+
+        result = self.render_template({'record': r})
+        self.check_response(result, {'GetRecord': {'record': {
+            'header': {'identifier': r.identifier},
+            'metadata': {'dc': {'title': 'Serialized'}},
+        }}})
+
 
 class TestListRecords(OaiTemplateTest):
     """Test listrecords.pt template."""
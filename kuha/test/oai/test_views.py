@@ -4,6 +4,8 @@ import json
 
 import mock
 from pyramid import testing
+from pyramid.response import Response
+from webob import Request
 from webob.multidict import MultiDict
 
 from ...oai import views
@@ -184,7 +186,7 @@ class TestListSetsView(ViewTestCase,
     @mock.patch.object(views, 'Datestamp')
     def test_invalid_resumption(self, date_mock):
         """Using a resumption token should raise InvalidResumptionToken."""
-        date_mock.get.return_value = datetime(2000, 4, 5, 12, 3, 4)
+        date_mock.get_cached.return_value = datetime(2000, 4, 5, 12, 3, 4)
         token = {'verb': self.verb, 'date': '2015-04-01', 'offset': 'a'}
         request = testing.DummyRequest(params=MultiDict(
             verb=self.verb,
@@ -195,7 +197,7 @@ class TestListSetsView(ViewTestCase,
     @mock.patch.object(views, 'Datestamp')
     def test_expired_resumption(self, date_mock):
         """Using an expired token should raise InvalidResumptionToken."""
-        date_mock.get.return_value = datetime(3100, 4, 5, 12, 3, 4)
+        date_mock.get_cached.return_value = datetime(3100, 4, 5, 12, 3, 4)
         token = {'verb': self.verb, 'date': '2015-04-01', 'offset': 'a'}
         request = testing.DummyRequest(params=MultiDict(
             verb=self.verb,
@@ -302,7 +304,8 @@ class TestListItemsView(ViewTestCase,
             u'from': None,
             u'until': None,
         })
-        mock_func.assert_called_once_with(params, False, 4)
+        # ListRecords renders the records without their headers.
+        mock_func.assert_called_once_with(params, False, 4, False)
 
     def test_list_identifiers(self):
         """View should handle ListIdentifiers as well."""
@@ -315,14 +318,14 @@ class TestListItemsView(ViewTestCase,
             result = self.function(testing.DummyRequest(params=params))
 
         self.check_response(result, records=[1, 2])
-        mock_func.assert_called_once_with(params, False, 4)
+        mock_func.assert_called_once_with(params, False, 4, True)
 
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Record')
     @mock.patch.object(views, 'Set')
     def test_resumption(self, set_mock, record_mock, format_mock):
         set_mock.list.return_value = [mock.Mock]
-        record_mock.list.return_value = self.records
+        record_mock.iter.return_value = self.records
         format_mock.exists.return_value = True
         token_mock = mock.Mock(return_value={
             'verb': self.verb,
@@ -343,13 +346,14 @@ class TestListItemsView(ViewTestCase,
             result = self.function(request)
 
         self.check_response(result, records=self.records, token='')
-        record_mock.list.assert_called_once_with(
+        record_mock.iter.assert_called_once_with(
             metadata_prefix='dummy',
             from_date=datetime(1970, 1, 1, 0, 0, 0),
             until_date=datetime(2140, 1, 1, 23, 59, 59),
             set_='math:geometry',
             ignore_deleted=False,
-            offset='b', limit=5,
+            offset='b', limit=5, defer_xml=True, batch_size=5,
+            load_sets=False,
         )
         token_mock.assert_called_once_with(request)
 
@@ -384,7 +388,8 @@ class TestListItemsView(ViewTestCase,
                     'resumptionToken': 'token',
                 }
         token_mock.assert_called_once_with(MatchRequest())
-        format_mock.exists.assert_called_once_with('dummy', False)
+        format_mock.exists.assert_called_once_with(
+            'dummy', False, cached=True)
 
     def test_resumption_expired(self):
         request = testing.DummyRequest(params=MultiDict(
@@ -416,7 +421,8 @@ class TestGetRecords(unittest.TestCase):
         self.assertRaises(UnsupportedMetadataFormat,
                           views._get_records,
                           self.test_params, False, 10)
-        format_mock.exists.assert_called_once_with(u'prefix', False)
+        format_mock.exists.assert_called_once_with(
+            u'prefix', False, cached=True)
 
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Set')
@@ -436,17 +442,18 @@ class TestGetRecords(unittest.TestCase):
                                  format_mock):
         set_mock.list.return_value = [mock.Mock()]
         format_mock.exists.return_value = True
-        record_mock.list.return_value = []
+        record_mock.iter.return_value = []
         self.assertRaises(NoRecordsMatch,
                           views._get_records,
                           self.test_params, True, 10)
-        record_mock.list.assert_called_once_with(
+        record_mock.iter.assert_called_once_with(
             metadata_prefix='prefix',
             from_date=datetime(2014, 1, 30, 0, 0, 0),
             until_date=datetime(2014, 2, 1, 23, 59, 59),
             set_=u'abcde',
             ignore_deleted=True,
-            offset=None, limit=11,
+            offset=None, limit=11, defer_xml=True, batch_size=11,
+            load_sets=True,
         )
 
     @mock.patch.object(views, 'Format')
@@ -460,22 +467,37 @@ class TestGetRecords(unittest.TestCase):
             Data(identifier='3', prefix='prefix', xml='data'),
             Data(identifier='4', prefix='prefix', xml='data'),
         ]
-        record_mock.list.return_value = model_records
+        record_mock.iter.return_value = model_records
         format_mock.exists.return_value = True
 
         records, offset = views._get_records(self.test_params, False, 3)
 
         self.assertEqual(records, model_records[0:3])
         self.assertEqual(offset, '4')
-        record_mock.list.assert_called_once_with(
+        record_mock.iter.assert_called_once_with(
             metadata_prefix='prefix',
             from_date=datetime(2014, 1, 30, 0, 0, 0),
             until_date=datetime(2014, 2, 1, 23, 59, 59),
             set_=u'abcde',
             ignore_deleted=False,
-            offset=None, limit=4,
+            offset=None, limit=4, defer_xml=True, batch_size=4,
+            load_sets=True,
         )
 
+    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'Record')
+    @mock.patch.object(views, 'Set')
+    def test_list_identifiers(self, set_mock, record_mock, format_mock):
+        """ListIdentifiers should not load the XML data of the records."""
+        set_mock.list.return_value = [mock.Mock()]
+        record_mock.iter.return_value = [Data(identifier='1')]
+        format_mock.exists.return_value = True
+        params = dict(self.test_params, verb=u'ListIdentifiers')
+
+        views._get_records(params, False, 3)
+
+        self.assertIs(record_mock.iter.call_args[1]['defer_xml'], True)
+
 
 class TestGetResumptionToken(unittest.TestCase):
 
@@ -496,7 +518,7 @@ class TestGetResumptionToken(unittest.TestCase):
 
     @mock.patch.object(views, 'Datestamp')
     def test_valid_token(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
+        date_mock.get_cached.return_value = datetime(2000, 1, 1, 0, 0, 0)
         request = testing.DummyRequest(params=MultiDict(
             verb='ListRecords',
             resumptionToken=json.dumps(self.token_dict),
@@ -506,7 +528,7 @@ class TestGetResumptionToken(unittest.TestCase):
 
     @mock.patch.object(views, 'Datestamp')
     def test_no_token(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
+        date_mock.get_cached.return_value = datetime(2000, 1, 1, 0, 0, 0)
         request = testing.DummyRequest(params=MultiDict(
             verb='ListIdentifiers',
             metadataPrefix='oai_dc',
@@ -515,7 +537,7 @@ class TestGetResumptionToken(unittest.TestCase):
 
     @mock.patch.object(views, 'Datestamp')
     def test_token_expired(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
+        date_mock.get_cached.return_value = datetime(2000, 1, 1, 0, 0, 0)
         self.token_dict['date'] = '1970-01-01'
         request = testing.DummyRequest(params=MultiDict(
             verb='ListRecords',
@@ -599,11 +621,13 @@ class TestGetRecordView(ViewTestCase,
 
         self.check_response(result, record=self.record)
         item_mock.exists.assert_called_once_with('item', True)
-        format_mock.exists.assert_called_once_with('dummy', True)
+        format_mock.exists.assert_called_once_with(
+            'dummy', True, cached=True)
         record_mock.list.assert_called_once_with(
             identifier='item',
             metadata_prefix='dummy',
             ignore_deleted=True,
+            defer_xml=True,
         )
 
     @mock.patch.object(views, 'Format')
@@ -616,7 +640,8 @@ class TestGetRecordView(ViewTestCase,
         self.assertRaises(UnsupportedMetadataFormat,
                           self.function,
                           request)
-        format_mock.exists.assert_called_once_with('dummy', True)
+        format_mock.exists.assert_called_once_with(
+            'dummy', True, cached=True)
 
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Item')
@@ -642,6 +667,126 @@ class TestGetRecordView(ViewTestCase,
                           request)
 
 
+class TestCachedResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.add_settings(response_cache_size=2)
+        views._response_cache.clear()
+        self.date = datetime(2014, 4, 2, 12, 34, 56)
+        self.view = mock.Mock(side_effect=lambda context, request: Response(
+            body=(b'<OAI-PMH><responseDate>2014-04-02T12:34:56Z'
+                  b'</responseDate><request>' + request.path_url +
+                  b'</request></OAI-PMH>'),
+            content_type='text/xml'))
+        self.cached_view = views.cached_response(self.view)
+
+    def tearDown(self):
+        views._response_cache.clear()
+        testing.tearDown()
+
+    def call(self, date=None, url='http://example.com/oai', **params):
+        with mock.patch.object(views, 'Datestamp') as date_mock:
+            date_mock.get_cached.return_value = date or self.date
+            return self.cached_view(
+                None, testing.DummyRequest(params=MultiDict(params),
+                                           path_url=url))
+
+    def test_cached(self):
+        self.call(verb='Identify')
+        with mock.patch.object(views, 'datestamp_now',
+                               return_value=datetime(2014, 4, 3)):
+            response = self.call(verb='Identify')
+
+        self.assertEqual(self.view.call_count, 1)
+        self.assertEqual(response.body,
+                         b'<OAI-PMH><responseDate>2014-04-03T00:00:00Z'
+                         b'</responseDate><request>http://example.com/oai'
+                         b'</request></OAI-PMH>')
+        self.assertEqual(response.content_type, 'text/xml')
+        self.assertEqual(response.charset, 'utf-8')
+
+    def test_url(self):
+        """Responses to different URLs should be cached separately."""
+        self.call(verb='Identify')
+        response = self.call(url='https://example.org/oai', verb='Identify')
+        self.call(url='https://example.org/oai', verb='Identify')
+
+        self.assertEqual(self.view.call_count, 2)
+        self.assertIn(b'<request>https://example.org/oai</request>',
+                      response.body)
+
+    def test_no_response_date(self):
+        """A body without a response date should not be cached."""
+        self.view.side_effect = lambda context, request: Response(
+            body=b'<OAI-PMH/>', content_type='text/xml')
+        for _ in xrange(2):
+            self.call(verb='Identify')
+        self.assertEqual(self.view.call_count, 2)
+
+    def test_headers(self):
+        response = self.call(verb='Identify')
+        self.assertEqual(response.etag, '20140402123456000000')
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Wed, 02 Apr 2014 12:34:56 GMT')
+
+        # Conditional requests are answered by the response.
+        for headers in [{'If-None-Match': '"20140402123456000000"'},
+                        {'If-Modified-Since':
+                         'Wed, 02 Apr 2014 12:34:56 GMT'}]:
+            request = Request.blank('/oai?verb=Identify', headers=headers)
+            self.assertEqual(request.get_response(response).status_int,
+                             304)
+        request = Request.blank('/oai?verb=Identify', headers={
+            'If-None-Match': '"20140402123455000000"',
+        })
+        self.assertEqual(request.get_response(response).status_int, 200)
+
+    def test_datestamp_changes(self):
+        self.call(verb='Identify')
+        response = self.call(datetime(2015, 1, 1), verb='Identify')
+        self.assertEqual(self.view.call_count, 2)
+        self.assertEqual(response.etag, '20150101000000000000')
+
+    def test_parameters(self):
+        self.call(verb='ListMetadataFormats')
+        self.call(verb='ListMetadataFormats', identifier='a')
+        self.call(verb='ListMetadataFormats', identifier='a')
+        self.assertEqual(self.view.call_count, 2)
+
+    def test_cache_size(self):
+        """The least recently used response should be dropped."""
+        for identifier in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.call(verb='ListMetadataFormats', identifier=identifier)
+        self.assertEqual(
+            [c[0][1].params['identifier']
+             for c in self.view.call_args_list],
+            ['a', 'b', 'c', 'b']
+        )
+
+    def test_cache_disabled(self):
+        self.config.add_settings(response_cache_size=0)
+        self.call(verb='Identify')
+        response = self.call(verb='Identify')
+        self.assertEqual(self.view.call_count, 2)
+        self.assertEqual(response.etag, '20140402123456000000')
+
+    def test_no_datestamp(self):
+        with mock.patch.object(views, 'Datestamp') as date_mock:
+            date_mock.get_cached.return_value = None
+            for _ in xrange(2):
+                response = self.cached_view(None, testing.DummyRequest())
+        self.assertEqual(self.view.call_count, 2)
+        self.assertIsNone(response.etag)
+
+    def test_error(self):
+        """Errors should not be cached."""
+        self.view.side_effect = NoSetHierarchy()
+        for _ in xrange(2):
+            self.assertRaises(NoSetHierarchy, self.call, verb='ListSets')
+        self.assertEqual(self.view.call_count, 2)
+
+
 class TestCheckParams(unittest.TestCase):
     def test_valid_params(self):
         views._check_params(
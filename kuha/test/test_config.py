@@ -34,6 +34,16 @@ class TestCleanSettings(unittest.TestCase):
                           settings, cleaners)
         self.assertEqual(cleaners['a'].mock_calls, [])
 
+    def test_default_value(self):
+        settings = {'b': 'x'}
+        cleaners = {'a': mock.Mock(), 'b': mock.Mock()}
+
+        config._clean_settings(settings, cleaners, {'a': '1', 'b': '2'})
+
+        cleaners['a'].assert_called_once_with('1')
+        cleaners['b'].assert_called_once_with('x')
+        self.assertIs(settings['a'], cleaners['a'].return_value)
+
     def test_invalid_value(self):
         settings = {'setting': '   '}
         cleaners = {'setting': mock.Mock(side_effect=TypeError())}
@@ -44,6 +54,49 @@ class TestCleanSettings(unittest.TestCase):
         cleaners['setting'].assert_called_once_with('   ')
 
 
+class TestCleanImporterSettings(unittest.TestCase):
+
+    def test_optional_settings(self):
+        """Settings added after the first release should have defaults
+        which keep the old behavior."""
+        settings = {
+            'deleted_records': 'no',
+            'dry_run': 'no',
+            'force_update': 'no',
+            'logging_config': 'kuha.ini',
+            'sqlalchemy.url': 'sqlite://',
+            'timestamp_file': 'last_update',
+            'metadata_provider_args': '',
+            'metadata_provider_class': 'a.b:C',
+        }
+        config.clean_importer_settings(settings)
+        self.assertIs(settings['bulk_import'], False)
+        self.assertEqual(settings['commit_batch_size'], 1)
+        self.assertEqual(settings['dissemination_pool'], 'thread')
+        self.assertEqual(settings['dissemination_workers'], 1)
+
+        settings['commit_batch_size'] = '0'
+        self.assertRaises(ConfigurationError,
+                          config.clean_importer_settings, settings)
+
+
+class TestCleanOaiSettings(unittest.TestCase):
+
+    def test_optional_settings(self):
+        settings = {
+            'admin_emails': 'admin@example.org',
+            'deleted_records': 'no',
+            'item_list_limit': '10',
+            'logging_config': 'kuha.ini',
+            'repository_descriptions': '',
+            'repository_name': 'Test',
+            'sqlalchemy.url': 'sqlite://',
+        }
+        config.clean_oai_settings(settings)
+        self.assertEqual(settings['datestamp_cache_ttl'], 0)
+        self.assertEqual(settings['response_cache_size'], 0)
+
+
 class TestCleanAdminEmails(unittest.TestCase):
 
     def test_valid_emails(self):
@@ -114,6 +167,31 @@ class TestCleanItemListLimit(unittest.TestCase):
                               value)
 
 
+class TestCleanPositiveInteger(unittest.TestCase):
+
+    def test_valid_value(self):
+        self.assertEqual(config._clean_positive_integer('100'), 100)
+
+    def test_invalid_value(self):
+        for value in [-1, 0, '1.5', 'abc']:
+            self.assertRaises(ValueError,
+                              config._clean_positive_integer,
+                              value)
+
+
+class TestCleanNonNegativeInteger(unittest.TestCase):
+
+    def test_valid_value(self):
+        self.assertEqual(config._clean_non_negative_integer('0'), 0)
+        self.assertEqual(config._clean_non_negative_integer('5'), 5)
+
+    def test_invalid_value(self):
+        for value in [-1, '1.5', 'abc']:
+            self.assertRaises(ValueError,
+                              config._clean_non_negative_integer,
+                              value)
+
+
 class TestCleanUnicode(unittest.TestCase):
 
     def test_valid_values(self):
@@ -10,6 +10,7 @@ import sqlalchemy.orm as orm
 import mock
 
 from ..util import datestamp_now
+from .util import LogCapture
 from .. import models
 from ..models import (
     DBSession,
@@ -57,6 +58,8 @@ class ModelTestCase(unittest.TestCase):
 
         # in-memory database
         self.engine = sa.create_engine('sqlite://')
+        # Use savepoints like the application does.
+        models._enable_sqlite_savepoints(self.engine)
 
         # Wrap the test cases in a transaction.
         connection = self.engine.connect()
@@ -76,6 +79,31 @@ class ModelTestCase(unittest.TestCase):
         DBSession.remove()
 
 
+class TestCreateMissingIndexes(unittest.TestCase):
+
+    def test_create_missing_indexes(self):
+        engine = sa.create_engine('sqlite://')
+        models._Base.metadata.create_all(engine)
+        engine.execute('DROP INDEX ix_records_prefix_datestamp')
+        engine.execute('DROP INDEX ix_item_set_association_set_item')
+
+        models._create_missing_indexes(engine)
+
+        inspector = sa.inspect(engine)
+        self.assertItemsEqual(
+            [i['name'] for i in inspector.get_indexes('records')],
+            ['ix_records_prefix_identifier',
+             'ix_records_prefix_deleted_identifier',
+             'ix_records_prefix_datestamp']
+        )
+        indexes = inspector.get_indexes('item_set_association')
+        self.assertItemsEqual(
+            [i['name'] for i in indexes],
+            ['ix_item_set_association_set_item',
+             'ix_item_set_association_item_set']
+        )
+
+
 class TestCreateItem(ModelTestCase):
 
     def test_create(self):
@@ -123,6 +151,21 @@ class TestUpdateItems(ModelTestCase):
         self.assertIs(i2.deleted, False)
 
 
+    def test_create_or_update_all(self):
+        Item.create(u'deleted').deleted = True
+        Item.create(u'existing')
+
+        with mock.patch.object(models, '_IN_CLAUSE_SIZE', 2):
+            Item.create_or_update_all(
+                [u'deleted', u'existing', u'new1', u'new2'])
+
+        self.assertEqual(
+            sorted((i.identifier, i.deleted) for i in Item.list()),
+            [(u'deleted', False), (u'existing', False),
+             (u'new1', False), (u'new2', False)]
+        )
+
+
 class TestListItems(ModelTestCase):
 
     def test_list_deleted(self):
@@ -132,6 +175,13 @@ class TestListItems(ModelTestCase):
         self.assertItemsEqual(Item.list(ignore_deleted=False), [i1, i2])
         self.assertItemsEqual(Item.list(ignore_deleted=True), [i1])
 
+    def test_list_identifiers(self):
+        Item.create(u'qwe')
+        Item.create(u'rty').deleted = True
+        self.assertEqual(Item.list_identifiers(), set([u'qwe', u'rty']))
+        self.assertEqual(Item.list_identifiers(ignore_deleted=True),
+                         set([u'qwe']))
+
     def test_empty_list(self):
         self.assertEqual(Item.list(), [])
 
@@ -153,6 +203,7 @@ class TestMarkItemsAsDeleted(ModelTestCase):
         fmt2 = make_format('oai_dc')
         r1 = Record.create('hjkl', 'ead', make_xml(fmt1))
         r2 = Record.create('hjkl', 'oai_dc', make_xml(fmt2))
+        Datestamp.write()
         DBSession.query(Datestamp).one().datestamp = date
 
         item.mark_as_deleted()
@@ -169,6 +220,59 @@ class TestMarkItemsAsDeleted(ModelTestCase):
         self.assertTrue(Datestamp.get() > date)
 
 
+    def test_mark_all_except(self):
+        date = datetime(1970, 1, 1, 0, 0, 0)
+        fmt = make_format('oai_dc')
+        records = {}
+        for identifier in [u'keep', u'remove1', u'remove2']:
+            Item.create(identifier)
+            records[identifier] = Record.create(
+                identifier, u'oai_dc', make_xml(fmt))
+        Item.create(u'deleted').deleted = True
+        DBSession.flush()
+        Record.store_fragments([(records[u'remove1'], u'x'),
+                                (records[u'keep'], u'y')])
+        Datestamp.write()
+        DBSession.query(Datestamp).one().datestamp = date
+
+        with mock.patch.object(models, '_BULK_SIZE', 2):
+            removed = Item.mark_as_deleted_except(
+                [u'keep', u'deleted', u'unknown'])
+
+        self.assertEqual(removed, 2)
+        self.assertEqual(
+            sorted((i.identifier, i.deleted) for i in Item.list()),
+            [(u'deleted', True), (u'keep', False),
+             (u'remove1', True), (u'remove2', True)]
+        )
+        self.assertEqual(
+            sorted((r.identifier, r.deleted) for r in Record.list()),
+            [(u'keep', False), (u'remove1', True), (u'remove2', True)]
+        )
+        self.assertEqual(
+            DBSession.query(models.record_fragments.c.identifier).all(),
+            [(u'keep',)]
+        )
+        self.assertTrue(Datestamp.get() > date)
+
+        # The temporary table is dropped, so this can be done again.
+        self.assertEqual(Item.mark_as_deleted_except([]), 1)
+
+    def test_mark_as_deleted_except_failure(self):
+        Item.create(u'item')
+        DBSession.flush()
+        savepoint = DBSession.begin_nested()
+        with mock.patch.object(Record, 'invalidate_fragments',
+                               side_effect=ValueError('original')):
+            # The original error is raised as it is.
+            with self.assertRaisesRegexp(ValueError, 'original'):
+                Item.mark_as_deleted_except([])
+        savepoint.rollback()
+
+        # The rollback discards the temporary table.
+        self.assertEqual(Item.mark_as_deleted_except([]), 1)
+
+
 class TestCreateFormat(ModelTestCase):
 
     def test_create(self):
@@ -206,6 +310,28 @@ class TestFormatExists(ModelTestCase):
         self.assertIs(Format.exists('a', True), False)
         self.assertIs(Format.exists('b', True), True)
 
+    @mock.patch.object(Format, '_cached_registry', None)
+    def test_cached(self):
+        Format.create('a', 'urn:a', 'a.xsd').deleted = True
+        Format.create('b', 'urn:b', 'b.xsd')
+        date = datetime(2015, 1, 1, 12, 0, 0)
+
+        with mock.patch.object(Datestamp, 'get_cached') as date_mock:
+            date_mock.return_value = date
+            self.assertIs(Format.exists('a', False, cached=True), True)
+            self.assertIs(Format.exists('a', True, cached=True), False)
+            self.assertIs(Format.exists('b', True, cached=True), True)
+            self.assertIs(Format.exists('c', cached=True), False)
+
+            # The registry is not reloaded until the datestamp changes.
+            Format.create('c', 'urn:c', 'c.xsd')
+            with mock.patch.object(DBSession, 'query') as query_mock:
+                self.assertIs(Format.exists('c', cached=True), False)
+            self.assertEqual(query_mock.mock_calls, [])
+
+            date_mock.return_value = date + timedelta(seconds=1)
+            self.assertIs(Format.exists('c', cached=True), True)
+
 
 class TestListFormats(ModelTestCase):
 
@@ -252,6 +378,7 @@ class TestUpdateFormats(ModelTestCase):
         Item.create('id')
         f = make_format('ddi')
         r = Record.create('id', 'ddi', make_xml(f), date)
+        Datestamp.write()
         DBSession.query(Datestamp).one().datestamp = date
 
         # redundant update
@@ -300,6 +427,7 @@ class TestMarkFormatAsDeleted(ModelTestCase):
         r1 = Record.create('id1', 'oai_dc', make_xml(fmt), date)
         r2 = Record.create('id2', 'oai_dc', make_xml(fmt), date)
         r3 = Record.create('id1', 'ead', make_xml(ead), date)
+        Datestamp.write()
         DBSession.query(Datestamp).one().datestamp = date
 
         fmt.mark_as_deleted()
@@ -385,6 +513,31 @@ class TestCreateRecord(ModelTestCase):
             Record.create(u'id', u'oai_dc', xml)
         self.assertIn('wrong schema location', cm.exception.message)
 
+    def test_checked_xml(self):
+        """Only the root element of checked xml should be parsed."""
+        Item.create(u'id')
+        f = make_format(u'oai_dc')
+        # The end of the document is left out.
+        xml = models.CheckedXml(make_xml(f).strip()[:-len('</test>')])
+        Record.create(u'id', u'oai_dc', xml)
+        self.assertEqual(DBSession.query(Record.xml).scalar(), xml)
+
+    def test_checked_xml_wrong_schema(self):
+        Item.create(u'id')
+        f = make_format(u'oai_dc')
+        xml = models.CheckedXml(make_xml(f))
+        f.schema = u'http://wrong.location/oai_dc.xsd'
+        with self.assertRaises(ValueError) as cm:
+            Record.create(u'id', u'oai_dc', xml)
+        self.assertIn('wrong schema location', cm.exception.message)
+
+    def test_checked_xml_ill_formed_root(self):
+        Item.create(u'id')
+        make_format(u'oai_dc')
+        for xml in [u'<test:dc><invalid xml/', u'   ']:
+            with self.assertRaises((XMLSyntaxError, ValueError)):
+                Record.create(u'id', u'oai_dc', models.CheckedXml(xml))
+
     def test_non_existent_prefix(self):
         Item.create('a')
         with self.assertRaises(ValueError) as cm:
@@ -549,6 +702,74 @@ class TestListRecords(ModelTestCase):
             self.records[0:3]
         )
 
+    def test_defer_xml(self):
+        DBSession.flush()
+        DBSession.expunge_all()
+        records = Record.list(metadata_prefix='fmt1', defer_xml=True)
+        self.assertEqual([r.identifier for r in records], ['item1', 'item2'])
+        for record in records:
+            self.assertIn('xml', sa.inspect(record).unloaded)
+
+    def test_iter(self):
+        set_ = Set.create('spec', 'Set')
+        self.items[1].add_to_set(set_)
+        DBSession.flush()
+        with mock.patch.object(Record, 'load_set_specs',
+                               wraps=Record.load_set_specs) as load:
+            records = list(Record.iter(batch_size=3))
+        self.assertEqual(records, Record.list())
+        self.assertEqual([len(c[0][0]) for c in load.call_args_list],
+                         [3, 1])
+        self.assertEqual([r.set_specs for r in records],
+                         [[], [], ['spec'], []])
+
+    def test_iter_without_sets(self):
+        with mock.patch.object(Record, 'load_set_specs') as load:
+            records = list(Record.iter(batch_size=3, load_sets=False))
+        self.assertEqual(records, Record.list())
+        self.assertFalse(load.called)
+
+    def test_iter_filters(self):
+        self.assertEqual(
+            list(Record.iter(metadata_prefix='fmt1', ignore_deleted=True,
+                             offset='item2')),
+            [self.records[2]]
+        )
+        self.assertEqual(list(Record.iter(set_='invalid')), [])
+
+    def test_iter_fragments(self):
+        self.items[0].add_to_set(Set.create('a:b', 'Set'))
+        DBSession.flush()
+        Record.store_fragments([(self.records[2], u'<record/>')])
+        r = self.records[0]
+        self.assertEqual(
+            list(Record.iter_fragments('fmt1',
+                                       ['item2', 'item1', 'item3'])),
+            [('item2', u'<record/>', None),
+             ('item1', None, (r.datestamp, False, ['a:b'], r.xml)),
+             ('item3', None, None)]
+        )
+
+    def test_iter_fragments_ends_transactions(self):
+        """The transaction should end before each chunk is returned."""
+        DBSession.flush()
+        sessions = []
+        session_class = orm.Session
+
+        def make_session(**kwargs):
+            sessions.append(mock.Mock(wraps=session_class(**kwargs)))
+            return sessions[-1]
+
+        with mock.patch.object(models.orm, 'Session', make_session):
+            fragments = Record.iter_fragments(
+                'fmt1', ['item1', 'item2'], chunk_size=1)
+            next(fragments)
+            self.assertEqual(sessions[0].close.call_count, 1)
+            next(fragments)
+            self.assertEqual(sessions[0].close.call_count, 2)
+            fragments.close()
+        self.assertEqual(len(sessions), 1)
+
 
 class TestUpdateRecords(ModelTestCase):
 
@@ -605,6 +826,206 @@ class TestUpdateRecords(ModelTestCase):
             r.update('<test:dc><invalid xml/')
 
 
+class TestRecordWriter(ModelTestCase):
+
+    def setUp(self):
+        super(TestRecordWriter, self).setUp()
+        self.time = datetime(1970, 1, 1, 0, 0, 0)
+        for i in ['r', 's', 't', 'u']:
+            Item.create(i)
+        self.format_ = Format.create('a', 'http://a', 'a.xsd')
+        self.data = make_xml(self.format_)
+        self.modified_data = self.data.replace('Test Record', 'droceR tseT')
+        Record.create('r', 'a', self.data, self.time)
+        Record.create('s', 'a', self.data, self.time)
+        Record.create('t', 'a', self.data, self.time)
+        DBSession.flush()
+
+    def query_records(self):
+        DBSession.expire_all()
+        return (DBSession.query(Record.identifier,
+                                Record.xml,
+                                Record.deleted)
+                         .all())
+
+    def test_write(self):
+        writer = models.RecordWriter()
+        writer.write('u', 'a', self.modified_data)
+        writer.write('r', 'a', self.modified_data)
+        writer.write('s', 'a', self.data)
+        writer.mark_as_deleted('t', 'a')
+        # The stored data is compared only when flushing.
+        self.assertEqual(len(writer), 4)
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(len(writer), 0)
+
+        self.assertItemsEqual(self.query_records(), [
+            ('r', self.modified_data, False),
+            ('s', self.data, False),
+            ('t', self.data, True),
+            ('u', self.modified_data, False),
+        ])
+        # Datestamps of records whose data does not change should not be
+        # changed.
+        unchanged = DBSession.query(Record).filter_by(identifier='s').one()
+        self.assertEqual(unchanged.datestamp, self.time)
+        changed = DBSession.query(Record).filter_by(identifier='r').one()
+        self.assertTrue(changed.datestamp > self.time)
+        self.assertIsNotNone(Datestamp.get())
+
+    def test_write_twice(self):
+        writer = models.RecordWriter()
+        writer.write('u', 'a', self.data)
+        writer.write('u', 'a', self.modified_data)
+        writer.mark_as_deleted('u', 'a')
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(
+            DBSession.query(Record.xml, Record.deleted)
+                     .filter_by(identifier='u').one(),
+            (self.modified_data, True)
+        )
+
+    def test_nothing_changed(self):
+        old_date = datetime(2000, 1, 1, 0, 0, 0)
+        Datestamp.write()
+        DBSession.query(Datestamp).one().datestamp = old_date
+        writer = models.RecordWriter()
+        writer.write('r', 'a', self.data)
+        writer.mark_as_deleted('u', 'a')
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(Datestamp.get(), old_date)
+
+    def test_xml_read_lazily(self):
+        """Only the XML data of the written records should be read."""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(self.engine, 'before_cursor_execute', record)
+        try:
+            writer = models.RecordWriter()
+            self.assertFalse([s for s in statements if 'xml' in s])
+            writer.write('r', 'a', self.data)
+            self.assertEqual(writer.flush(), 0)
+        finally:
+            sa.event.remove(self.engine, 'before_cursor_execute', record)
+        reads = [s for s in statements if 'records.xml' in s]
+        self.assertEqual(len(reads), 1)
+        self.assertIn('IN', reads[0])
+
+        # The data is known after it has been compared once.
+        writer.write('r', 'a', self.data)
+        self.assertEqual(len(writer), 0)
+
+    def test_invalid_values(self):
+        writer = models.RecordWriter()
+        with self.assertRaises(ValueError) as cm:
+            writer.write('u', 'invalid', self.data)
+        self.assertIn('non-existent metadata prefix', cm.exception.message)
+        with self.assertRaises(ValueError) as cm:
+            writer.write('invalid', 'a', self.data)
+        self.assertIn('non-existent identifier', cm.exception.message)
+        with self.assertRaises(XMLSyntaxError):
+            writer.write('r', 'a', '<test:dc><invalid xml/')
+        self.assertEqual(len(writer), 0)
+
+    def test_discard(self):
+        writer = models.RecordWriter()
+        writer.write('u', 'a', self.data)
+        writer.mark_as_deleted('r', 'a')
+        writer.discard()
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(writer.flush(), 0)
+
+        # The discarded changes are buffered again when repeated.
+        writer.write('u', 'a', self.data)
+        writer.mark_as_deleted('r', 'a')
+        self.assertEqual(writer.flush(), 2)
+
+
+class TestRecordFragments(ModelTestCase):
+
+    def setUp(self):
+        super(TestRecordFragments, self).setUp()
+        for i in ['r', 's', 't']:
+            Item.create(i)
+        self.format_ = Format.create('a', 'http://a', 'a.xsd')
+        self.data = make_xml(self.format_)
+        self.r = Record.create('r', 'a', self.data)
+        self.s = Record.create('s', 'a', self.data)
+        DBSession.flush()
+        Record.store_fragments([(self.r, u'<record>r</record>'),
+                                (self.s, u'<record>s</record>')])
+
+    def serialized(self):
+        return sorted(
+            identifier for (identifier,) in
+            DBSession.execute(sa.select([
+                models.record_fragments.c.identifier
+            ]))
+        )
+
+    def test_fragment(self):
+        DBSession.expire_all()
+        self.assertEqual(self.r.fragment, u'<record>r</record>')
+        Record.invalidate_fragments()
+        DBSession.expire_all()
+        self.assertIsNone(self.r.fragment)
+
+    def test_list_unserialized(self):
+        t = Record.create('t', 'a', self.data)
+        Item.get('t').add_to_set(Set.create('spec', 'Set'))
+        DBSession.flush()
+
+        self.assertEqual(Record.list_unserialized(10), [t])
+        self.assertEqual(t.set_specs, ['spec'])
+
+    def test_list_unserialized_after(self):
+        data = {'a': self.data,
+                'b': make_xml(Format.create('b', 'http://b', 'b.xsd'))}
+        Item.create('u')
+        records = [Record.create(i, p, data[p])
+                   for i in ['t', 'u'] for p in ['a', 'b']]
+        DBSession.flush()
+
+        self.assertEqual(Record.list_unserialized(2), records[:2])
+        self.assertEqual(Record.list_unserialized(2, ('t', 'b')),
+                         records[2:])
+        self.assertEqual(Record.list_unserialized(10, ('t', 'a')),
+                         records[1:])
+        self.assertEqual(Record.list_unserialized(10, ('u', 'b')), [])
+
+    def test_update(self):
+        self.r.update(self.data)
+        self.assertEqual(self.serialized(), ['r', 's'])
+        self.r.update(self.data.replace('Test Record', 'Changed'))
+        self.assertEqual(self.serialized(), ['s'])
+
+    def test_mark_as_deleted(self):
+        Record.mark_as_deleted(identifier='r')
+        self.assertEqual(self.serialized(), ['s'])
+
+        # Deleted records are not invalidated again.
+        Record.store_fragments([(self.r, u'<record>r</record>')])
+        Record.mark_as_deleted(prefix='a')
+        self.assertEqual(self.serialized(), ['r'])
+
+    def test_record_writer(self):
+        writer = models.RecordWriter()
+        writer.write('s', 'a', self.data.replace('Test Record', 'Changed'))
+        writer.write('t', 'a', self.data)
+        writer.flush()
+        self.assertEqual(self.serialized(), ['r'])
+
+    def test_purge(self):
+        self.r.deleted = True
+        DBSession.flush()
+        models.purge_deleted()
+        self.assertEqual(self.serialized(), ['s'])
+        self.assertEqual(DBSession.query(Record).all(), [self.s])
+
+
 class TestDeleteRecords(ModelTestCase):
 
     def setUp(self):
@@ -643,12 +1064,52 @@ class TestDatestamp(ModelTestCase):
         self.assertIs(Datestamp.get(), None)
 
     def test_many_datestamps(self):
-        """Datestamp.update() should fix multiple datestamps."""
+        """Writing an updated datestamp should fix multiple datestamps."""
         Datestamp.create(datetime(2015, 1, 1, 12, 0, 0))
         Datestamp.create(datetime(2015, 1, 1, 22, 0, 0))
         Datestamp.update()
+        Datestamp.write()
         self.assertEqual(len(DBSession.query(Datestamp).all()), 1)
 
+    def test_write_on_commit(self):
+        """Datestamp should be written once when committing."""
+        with mock.patch.object(models, 'datestamp_now') as date_mock:
+            for second in xrange(3):
+                date_mock.return_value = datetime(2015, 1, 1, 12, 0, second)
+                Datestamp.update()
+        self.assertEqual(DBSession.query(Datestamp).all(), [])
+        self.assertEqual(Datestamp.get(), datetime(2015, 1, 1, 12, 0, 2))
+
+        # Committing a savepoint does not write the datestamp.
+        DBSession.begin_nested().commit()
+        self.assertEqual(DBSession.query(Datestamp).all(), [])
+
+        DBSession.commit()
+        self.assertEqual(
+            DBSession.query(Datestamp.datestamp).all(),
+            [(datetime(2015, 1, 1, 12, 0, 2),)]
+        )
+
+    def test_discard_on_rollback(self):
+        Datestamp.update()
+        DBSession.rollback()
+        self.assertIs(Datestamp.get(), None)
+
+    def test_get_cached(self):
+        dates = [datetime(2015, 1, 1, 12, 0, 0), datetime(2015, 1, 2, 0, 0, 0)]
+        with mock.patch.object(Datestamp, 'cache_ttl', 10):
+            with mock.patch.object(Datestamp, '_cache', None):
+                with mock.patch.object(Datestamp, 'get') as get_mock:
+                    with mock.patch.object(models.time, 'time') as time_mock:
+                        get_mock.side_effect = dates
+                        time_mock.return_value = 1000.0
+                        self.assertEqual(Datestamp.get_cached(), dates[0])
+                        time_mock.return_value = 1009.0
+                        self.assertEqual(Datestamp.get_cached(), dates[0])
+                        time_mock.return_value = 1010.0
+                        self.assertEqual(Datestamp.get_cached(), dates[1])
+        self.assertEqual(get_mock.call_count, 2)
+
     def test_datestamp_changes(self):
         """Datestamp should change whenever tokens could be invalidated."""
         second = timedelta(seconds=1)
@@ -707,6 +1168,31 @@ class TestDatestamp(ModelTestCase):
             models.purge_deleted()
         self.assertEqual(Datestamp.get(), date_mock.return_value)
 
+    def test_sets_and_formats_change_datestamp(self):
+        """Datestamp should change whenever the lists of sets and formats
+        change."""
+        date = datetime(1988, 5, 14, 9, 29, 2)
+        second = timedelta(seconds=1)
+
+        def check(changed, function, *args):
+            old = Datestamp.get()
+            new = old + second if old is not None else date
+            with mock.patch.object(models, 'datestamp_now',
+                                   return_value=new):
+                function(*args)
+            self.assertEqual(Datestamp.get(), new if changed else old)
+
+        check(True, Set.create_or_update, 'a', 'Set A')
+        check(False, Set.create_or_update, 'a', 'Set A')
+        check(True, Set.create_or_update, 'a', 'Renamed')
+        check(True, Format.create_or_update, 'x', 'urn:x', 'x.xsd')
+        check(False, Format.create_or_update, 'x', 'urn:x', 'x.xsd')
+        format_x = DBSession.query(Format).one()
+        check(True, format_x.mark_as_deleted)
+        check(False, format_x.mark_as_deleted)
+        check(True, Format.create_or_update, 'x', 'urn:x', 'x.xsd')
+        check(True, Format.create_or_update, 'x', 'urn:y', 'x.xsd')
+
 
 class TestEarliestDatestamp(ModelTestCase):
 
@@ -777,6 +1263,36 @@ class TestPurgeDeleted(ModelTestCase):
         self.assertEqual(DBSession.query(Format).all(), [format_z])
         self.assertEqual(DBSession.query(Record).all(), [existing])
 
+    def test_purge_set_memberships(self):
+        s = Set.create('spec', 'Set')
+        for identifier in ['id1', 'id2']:
+            Item.create(identifier).add_to_set(s)
+        Item.get('id1').deleted = True
+
+        self.assertEqual(models.purge_deleted(), 1)
+
+        association = models.item_set_association
+        self.assertEqual(
+            DBSession.query(association.c.item_identifier).all(),
+            [('id2',)])
+
+    def test_purge_in_chunks(self):
+        format_ = Format.create('x', 'urn:testx', 'x.xsd')
+        for i in range(5):
+            identifier = 'id{0}'.format(i)
+            Item.create(identifier).deleted = True
+            Record.create(identifier, 'x', make_xml(format_)).deleted = True
+        Item.create('id5')
+
+        with LogCapture(models) as log:
+            self.assertEqual(models.purge_deleted(chunk_size=2), 10)
+
+        log.assert_emitted('Purged 4 of 5 deleted records')
+        log.assert_emitted('Purged 5 of 5 deleted items')
+        self.assertEqual(DBSession.query(Record).all(), [])
+        self.assertEqual(
+            [i for (i,) in DBSession.query(Item.identifier)], ['id5'])
+
 
 class TestItemSetAssociations(ModelTestCase):
 
@@ -808,6 +1324,135 @@ class TestItemSetAssociations(ModelTestCase):
             []
         )
 
+
+class TestSetWriter(ModelTestCase):
+
+    def setUp(self):
+        super(TestSetWriter, self).setUp()
+        for identifier in [u'i1', u'i2', u'i3']:
+            Item.create(identifier)
+        a = Set.create(u'a', u'Set A')
+        b = Set.create(u'b', u'Set B')
+        Item.get(u'i1').add_to_set(a)
+        Item.get(u'i2').add_to_set(a)
+        Item.get(u'i2').add_to_set(b)
+        DBSession.flush()
+
+    def query_memberships(self):
+        return sorted(DBSession.query(
+            models.item_set_association.c.item_identifier,
+            models.item_set_association.c.set_spec,
+        ))
+
+    def test_write(self):
+        writer = models.SetWriter()
+        with mock.patch.object(DBSession, 'query') as query:
+            # Unchanged memberships should not query the database.
+            self.assertFalse(writer.write(u'i1', [(u'a', u'Set A')]))
+            self.assertEqual(query.mock_calls, [])
+        self.assertTrue(writer.write(u'i2', [(u'b', u'Set B')]))
+        self.assertTrue(writer.write(u'i3', [(u'c', u'Set C'),
+                                             (u'a', u'Renamed')]))
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(len(writer), 0)
+
+        self.assertEqual(self.query_memberships(), [
+            (u'i1', u'a'), (u'i2', u'b'), (u'i3', u'a'), (u'i3', u'c'),
+        ])
+        self.assertItemsEqual(
+            DBSession.query(Set.spec, Set.name).all(),
+            [(u'a', u'Renamed'), (u'b', u'Set B'), (u'c', u'Set C')]
+        )
+        # The flushed state is the new snapshot.
+        self.assertFalse(writer.write(u'i2', [(u'b', u'Set B')]))
+
+    def test_invalid_spec(self):
+        writer = models.SetWriter()
+        with self.assertRaises(ValueError):
+            writer.write(u'i1', [(u'new', u'New'), (u'a:', u'Invalid')])
+        # Nothing should have been changed.
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(len(Set.list()), 2)
+
+    def test_restore(self):
+        """Changes rolled back with a savepoint should be forgotten."""
+        writer = models.SetWriter()
+        writer.write(u'i1', [])
+
+        savepoint = models.savepoint()
+        snapshot = writer.snapshot(u'i3')
+        self.assertTrue(writer.write(u'i3', [(u'c', u'Set C'),
+                                             (u'a', u'Renamed')]))
+        savepoint.rollback()
+        writer.restore(snapshot)
+
+        # The set is created and renamed again when written again.
+        snapshot = writer.snapshot(u'i2')
+        self.assertTrue(writer.write(u'i2', [(u'c', u'Set C'),
+                                             (u'a', u'Renamed')]))
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(self.query_memberships(), [
+            (u'i2', u'a'), (u'i2', u'c'),
+        ])
+        self.assertItemsEqual(
+            DBSession.query(Set.spec, Set.name).all(),
+            [(u'a', u'Renamed'), (u'b', u'Set B'), (u'c', u'Set C')]
+        )
+
+    def test_restore_buffered_item(self):
+        writer = models.SetWriter()
+        writer.write(u'i1', [(u'b', u'Set B')])
+        snapshot = writer.snapshot(u'i1')
+        writer.write(u'i1', [])
+        writer.restore(snapshot)
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(self.query_memberships(), [
+            (u'i1', u'b'), (u'i2', u'a'), (u'i2', u'b'),
+        ])
+
+    def test_discard(self):
+        writer = models.SetWriter()
+        writer.write(u'i1', [])
+        writer.write(u'i1', [(u'b', u'Set B')])
+        writer.discard()
+        self.assertEqual(writer.flush(), 0)
+        self.assertFalse(writer.write(u'i1', [(u'a', u'Set A')]))
+        self.assertEqual(self.query_memberships(), [
+            (u'i1', u'a'), (u'i2', u'a'), (u'i2', u'b'),
+        ])
+
+
+class TestRecordSetSpecs(ModelTestCase):
+
+    def setUp(self):
+        super(TestRecordSetSpecs, self).setUp()
+        f = Format.create('test', 'urn:test', 'test.xsd')
+        self.records = []
+        for id_ in ['item1', 'item2', 'item3']:
+            Item.create(id_)
+            self.records.append(Record.create(id_, 'test', make_xml(f)))
+        a = Set.create('a', 'Set A')
+        ab = Set.create('a:b', 'Set B')
+        c = Set.create('c', 'Set C')
+        Item.get('item1').sets = [a, ab, c]
+        Item.get('item2').sets = [a]
+        DBSession.flush()
+
+    def test_set_specs(self):
+        self.assertItemsEqual(self.records[0].set_specs, ['a:b', 'c'])
+        self.assertEqual(self.records[1].set_specs, ['a'])
+        self.assertEqual(self.records[2].set_specs, [])
+
+    def test_load_set_specs(self):
+        Record.load_set_specs(self.records)
+        with mock.patch.object(DBSession, 'query') as query_mock:
+            self.assertItemsEqual(self.records[0].set_specs, ['a:b', 'c'])
+            self.assertEqual(self.records[1].set_specs, ['a'])
+            self.assertEqual(self.records[2].set_specs, [])
+        self.assertEqual(query_mock.mock_calls, [])
+
+
 class TestSets(ModelTestCase):
 
     def test_create_set(self):
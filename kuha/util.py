@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import re
 
 # A regex which matches characters that are not legal in XML.
@@ -111,3 +112,26 @@ def parse_date(text, default_time=datetime.time(0, 0, 0)):
 
     else:
         raise ValueError('unsupported date format')
+
+
+def chunks(iterable, size):
+    """Split an iterable to lists of at most the given size.
+
+    Parameters
+    ----------
+    iterable: iterable
+        The values to split.
+    size: int
+        Maximum length of a chunk.
+
+    Return
+    ------
+    iterator of list:
+        The consecutive chunks of the iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
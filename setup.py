@@ -54,6 +54,7 @@ if __name__ == '__main__':
 
             'console_scripts': [
                 'kuha_import = kuha.importer:main',
+                'kuha_export = kuha.exporter:main',
             ],
         },
     )